@@ -12,7 +12,14 @@ __version__ = '0.1'
 
 
 import os, sys
+import re
 import json
+import time
+import struct
+import zlib
+import threading
+
+from collections import OrderedDict, namedtuple
 
 from abc import ABCMeta, abstractmethod
 
@@ -33,62 +40,418 @@ class ConfigNotFound(DolfinError):
     pass
 
 
-def include_revision(func):
-    """A decorator method which returns a function for extracting the latest 
-    source control revision hash (and id if available) of a repository.
-    """  
+class ConfigError(DolfinError):
+    """The exception thrown when configuration settings don't match the
+    schema they're loaded into.
+    """
+    pass
 
-    def exec_command(cmd, **kwargs):
-        """Executes a shell command with arguments in 'cmd' and returns the
-        output as a byte string.
-        """
-        import shlex, subprocess
-        try:
-            args = shlex.split(cmd, None)
-            out = subprocess.check_output(args)
-            return out.strip()
-        except:
+
+# maximum number of symbolic refs followed when resolving git's HEAD
+_GIT_MAX_SYMREF_DEPTH = 5
+
+# mercurial's dirstate-v2 files begin with this marker before the parents
+_HG_DIRSTATE_V2_MARKER = b'dirstate-v2\n'
+_HG_NULL_NODE = b'\0' * 20
+
+# detection order and fallback command for each scc
+_REVISION_EXTRACTORS = (
+    ('.hg', 'hg.exe identify -i'),
+    ('.git', 'git.exe rev-list HEAD -1'),
+)
+_REVISION_FILES = ('REVISION', '.REVISION')
+
+# files modified within this many seconds of being cached are revalidated
+# on the next lookup as mtime granularity can hide a subsequent change
+_CACHE_RACY_WINDOW = 2
+
+
+def _read_first_line(filepath):
+    """Returns the first line of a file as a stripped byte string."""
+    with open(filepath, 'rb') as f:
+        return f.readline().strip()
+
+
+def _is_git_hash(value):
+    """Checks whether a byte string is a full sha-1 or sha-256 hex digest."""
+    if len(value) not in (40, 64):
+        return False
+    try:
+        int(value, 16)
+    except ValueError:
+        return False
+    return True
+
+
+def _git_dirs(working_dir, watch):
+    """Returns the (git_dir, common_dir) pair for the repository checked out
+    in 'working_dir'. A `.git` file (as used by worktrees and submodules) is
+    followed to the directory it points at.
+    """
+    p = os.path
+    encoding = sys.getfilesystemencoding()
+    git_dir = p.join(working_dir, '.git')
+    if p.isfile(git_dir):
+        watch.append(git_dir)
+        line = _read_first_line(git_dir)
+        if not line.startswith(b'gitdir:'):
+            raise ValueError('Unrecognised .git file: %s' % git_dir)
+        target = line[len(b'gitdir:'):].strip().decode(encoding)
+        git_dir = p.normpath(p.join(working_dir, target))
+
+    common_dir = git_dir
+    commondir_file = p.join(git_dir, 'commondir')
+    if p.isfile(commondir_file):
+        target = _read_first_line(commondir_file).decode(encoding)
+        common_dir = p.normpath(p.join(git_dir, target))
+    return git_dir, common_dir
+
+
+def _read_git_ref(git_dir, common_dir, name, watch):
+    """Returns the content of the ref 'name' looking first for a loose ref
+    file and then within packed-refs. Returns None if the ref doesn't exist.
+    """
+    parts = name.split('/')
+    for base in (git_dir, common_dir):
+        filepath = os.path.join(base, *parts)
+        watch.append(filepath)
+        if os.path.isfile(filepath):
+            return _read_first_line(filepath)
+
+    filepath = os.path.join(common_dir, 'packed-refs')
+    watch.append(filepath)
+    if os.path.isfile(filepath):
+        target = name.encode('utf-8')
+        with open(filepath, 'rb') as f:
+            for line in f:
+                if line.startswith((b'#', b'^')):
+                    continue
+                fields = line.split()
+                if len(fields) == 2 and fields[1] == target:
+                    return fields[0]
+    return None
+
+
+def _read_git_revision(working_dir, watch=None):
+    """Resolves the commit hash HEAD points at by reading the repository files
+    directly instead of invoking git. Returns None for a repository without
+    commits; raises EnvironmentError or ValueError when the repository layout
+    cannot be parsed. Paths of the files consulted are appended to 'watch'.
+    """
+    watch = [] if watch is None else watch
+    git_dir, common_dir = _git_dirs(working_dir, watch)
+    head = os.path.join(git_dir, 'HEAD')
+    watch.append(head)
+    value = _read_first_line(head)
+    for _ in range(_GIT_MAX_SYMREF_DEPTH):
+        if not value.startswith(b'ref:'):
+            if not _is_git_hash(value):
+                raise ValueError('Invalid git object name: %r' % value)
+            return value
+
+        name = value[len(b'ref:'):].strip().decode('utf-8')
+        value = _read_git_ref(git_dir, common_dir, name, watch)
+        if value is None:
+            return None     # unborn branch
+    raise ValueError('Too many levels of symbolic refs in %s' % git_dir)
+
+
+def _read_hg_revision(working_dir, watch=None):
+    """Resolves the node of the working directory's first parent by reading
+    it from `.hg/dirstate` instead of invoking hg. Returns None for a
+    repository without commits; raises EnvironmentError or ValueError when the
+    dirstate cannot be parsed. Paths of the files consulted are appended to
+    'watch'.
+    """
+    import binascii
+
+    hg_dir = os.path.join(working_dir, '.hg')
+    if not os.path.isdir(hg_dir):
+        raise ValueError('Not a mercurial repository: %s' % working_dir)
+
+    filepath = os.path.join(hg_dir, 'dirstate')
+    if watch is not None:
+        watch.append(filepath)
+    if not os.path.exists(filepath):
+        return None     # fresh repository, nothing checked out yet
+
+    with open(filepath, 'rb') as f:
+        header = f.read(len(_HG_DIRSTATE_V2_MARKER) + 20)
+    if header.startswith(_HG_DIRSTATE_V2_MARKER):
+        header = header[len(_HG_DIRSTATE_V2_MARKER):]
+
+    node = header[:20]
+    if len(node) != 20:
+        raise ValueError('Truncated mercurial dirstate: %s' % filepath)
+    if node == _HG_NULL_NODE:
+        return None
+    return binascii.hexlify(node)
+
+
+def _exec_command(cmd, **kwargs):
+    """Executes a shell command with arguments in 'cmd' and returns the
+    output as a byte string. Keyword arguments such as `cwd` are passed on
+    to `subprocess.check_output`.
+    """
+    import shlex, subprocess
+    try:
+        args = shlex.split(cmd, None)
+        out = subprocess.check_output(args, **kwargs)
+        return out.strip()
+    except:
+        return None
+
+
+async def _exec_command_async(cmd, cwd=None):
+    """Asynchronous counterpart of `_exec_command` built on
+    `asyncio.create_subprocess_exec`.
+    """
+    import asyncio, shlex, subprocess
+    try:
+        args = shlex.split(cmd, None)
+        proc = await asyncio.create_subprocess_exec(*args, cwd=cwd,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        out, _ = await proc.communicate()
+        if proc.returncode != 0:
             return None
-    
-    # defines command for extracting hash for different scc
-    extractr_for = {
-        '.hg': lambda: exec_command('hg.exe identify -i'),
-        '.git': lambda: exec_command('git.exe rev-list HEAD -1')
-    }
-
-    def extract_revision(working_dir):
-        # determine scc in use: hg or git
-        extractr_key = None
-        for key in extractr_for.keys():
-            target_dir = os.path.join(working_dir, key)
-            if os.path.exists(target_dir):
-                extractr_key = key
+        return out.strip()
+    except:
+        return None
+
+
+# native readers for each scc, keyed like _REVISION_EXTRACTORS
+_REVISION_READERS = {
+    '.hg': _read_hg_revision,
+    '.git': _read_git_revision,
+}
+
+
+def _detect_scc(working_dir, watch):
+    """Returns the (key, cmd) pair from `_REVISION_EXTRACTORS` for the scc
+    in use within 'working_dir' or None if it isn't a repository.
+    """
+    extractr = None
+    for key, cmd in _REVISION_EXTRACTORS:
+        target_dir = os.path.join(working_dir, key)
+        if os.path.exists(target_dir):
+            extractr = (key, cmd)
+            break
+        watch.append(target_dir)
+
+    if (not os.path.isdir(working_dir) and
+        not working_dir.endswith('.egg') and 
+        not working_dir.endswith('.whl')):
+        raise ValueError('Invalid path provided. Path to a repository '
+                         'directory or python .egg or .whl file expected')
+    return extractr
+
+
+def _extract_revision(working_dir, watch):
+    """Returns the revision hash of the repository in 'working_dir' as a byte
+    string or None. Paths of the files whose modification would change the
+    result are appended to 'watch'.
+    """
+    working_dir = os.path.abspath(working_dir)
+    extractr = _detect_scc(working_dir, watch)
+
+    revision = None
+    if extractr:
+        key, cmd = extractr
+        try:
+            revision = _REVISION_READERS[key](working_dir, watch)
+        except (EnvironmentError, ValueError):
+            revision = _exec_command(cmd, cwd=working_dir)
+    return _revision_or_file(working_dir, revision, watch)
+
+
+async def _extract_revision_async(working_dir, watch):
+    """Asynchronous counterpart of `_extract_revision`; only the fallback scc
+    command is awaited as the native readers never block for long.
+    """
+    working_dir = os.path.abspath(working_dir)
+    extractr = _detect_scc(working_dir, watch)
+
+    revision = None
+    if extractr:
+        key, cmd = extractr
+        try:
+            revision = _REVISION_READERS[key](working_dir, watch)
+        except (EnvironmentError, ValueError):
+            revision = await _exec_command_async(cmd, cwd=working_dir)
+    return _revision_or_file(working_dir, revision, watch)
+
+
+def _revision_or_file(working_dir, revision, watch, names=_REVISION_FILES):
+    """Returns the revision read from the scc or else from the [.]REVISION
+    file, or the first of 'names', within 'working_dir'.
+    """
+    if not revision:
+        # try reading [.]REVISION file if it exists
+        for name in names:
+            filepath = os.path.join(working_dir, name)
+            watch.append(filepath)
+            if os.path.isfile(filepath):
+                revision = _read_first_line(filepath)
                 break
+    elif revision == b'000000000000':
+        revision = None
+    return revision or None
 
-        if (not os.path.isdir(working_dir) and
-            not working_dir.endswith('.egg') and 
-            not working_dir.endswith('.whl')):
-            raise ValueError('Invalid path provided. Path to a repository '
-                             'directory or python .egg or .whl file expected')
 
-        cwd_cache = os.getcwd()     # cache working directory
-        if cwd_cache.lower() != working_dir.lower():
-            os.chdir(working_dir)
+def _read_stamped_revision(working_dir, watch, names=_REVISION_FILES):
+    """Returns the revision stamped into the [.]REVISION file, or the first
+    of 'names', within 'working_dir' at build time without consulting any
+    scc.
+    """
+    return _revision_or_file(os.path.abspath(working_dir), None, watch,
+                             names)
 
-        revision = extractr_for.get(extractr_key, lambda: None)()
-        if not revision:
-            # try reading [.]REVISION file if it exists
-            for name in ('REVISION', '.REVISION'):
-                filepath = os.path.join(working_dir, name)
-                if os.path.isfile(filepath):
-                    revision = open(filepath, 'r').readline()
-        elif revision == b'000000000000':
-            revision = None
-        
-        os.chdir(cwd_cache)         # restore working directory
+
+def _module_revision_files(module_name):
+    """Returns the name of the file stamped with the revision next to the
+    top-level module 'module_name', which isn't a package.
+    """
+    return ('%s.REVISION' % module_name,)
+
+
+def _stat_stamp(filepath):
+    """Returns a value which changes whenever the file at 'filepath' is
+    modified, created or removed.
+    """
+    try:
+        st = os.stat(filepath)
+    except EnvironmentError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def _is_racy(stamps, started):
+    """Checks whether any of the file 'stamps' was modified so close to the
+    'started' time that a later change could go unnoticed.
+    """
+    threshold = (started - _CACHE_RACY_WINDOW) * 1e9
+    return any(s is not None and s[0] >= threshold for s in stamps)
+
+
+_CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+
+class _RevisionCache(object):
+    """A bounded cache of revisions keyed by the resolved path of the working
+    directory. An entry is reused only while the files consulted in resolving
+    it remain unchanged, so a lookup costs a few `stat` calls. The cache is
+    safe to use from multiple threads; resolution happens outside the lock.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+            self.hits = self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return _CacheInfo(self.hits, self.misses, self.maxsize,
+                              len(self._entries))
+
+    def get(self, working_dir, stamped=False, names=None):
+        """Returns the revision of 'working_dir', read from the first of the
+        stamped files 'names' if given rather than [.]REVISION.
+        """
+        path = os.path.realpath(working_dir)
+        key = (path, stamped) if names is None else (path, stamped, names)
+        found, revision = self._lookup(key)
+        if not found:
+            started, paths = time.time(), []
+            if not stamped:
+                revision = _extract_revision(path, paths)
+            else:
+                revision = _read_stamped_revision(
+                    path, paths, names or _REVISION_FILES)
+            self._store(key, paths, started, revision)
         return revision
 
-    def f(*args, **kwargs):
+    async def get_async(self, working_dir, stamped=False):
+        if stamped:
+            return self.get(working_dir, stamped)
+
+        path = os.path.realpath(working_dir)
+        key = (path, stamped)
+        found, revision = self._lookup(key)
+        if not found:
+            started, paths = time.time(), []
+            revision = await _extract_revision_async(path, paths)
+            self._store(key, paths, started, revision)
+        return revision
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            paths, stamps, revision = entry
+            if stamps is not None and stamps == self._stamps(paths):
+                with self._lock:
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                    self.hits += 1
+                return True, revision
+        return False, None
+
+    def _store(self, key, paths, started, revision):
+        stamps = self._stamps(paths)
+        if _is_racy(stamps, started):
+            stamps = None   # force revalidation on the next lookup
+
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = (paths, stamps, revision)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def _stamps(paths):
+        return [_stat_stamp(path) for path in paths]
+
+
+_revision_cache = _RevisionCache()
+
+
+# default number of repositories resolved at once by `resolve_many_async`
+_REVISION_ASYNC_LIMIT = 16
+
+
+def include_revision(func=None, stamped=False):
+    """A decorator method which returns a function for extracting the latest 
+    source control revision hash (and id if available) of a repository.
+
+    The working directory defaults to the parent directory of the top-level
+    package of the decorated function's module. With `stamped=True` the
+    revision is read only from the REVISION file written into that package
+    by `revision_build_py` at build time and source control is never
+    consulted; the working directory then defaults to the package directory
+    itself. For a top-level module which isn't a package, the revision is
+    read from the `<module>.REVISION` file written next to it, and without
+    stamping the working directory defaults to the directory holding the
+    module.
+
+    Revisions are cached per working directory and revalidated against the
+    modification times of the files they were read from; `cache_info()` and
+    `cache_clear()` on the returned function expose the cache which is shared
+    by all decorated functions.
+
+    The returned function also provides `resolve_many(working_dirs)` and the
+    coroutine `resolve_many_async(working_dirs)` which stamp the version for
+    many repositories at once and return a mapping of path to version.
+    """  
+    if func is None:
+        return lambda func: include_revision(func, stamped)
+
+    def get_version():
         version = func()
         if type(version) in (list, tuple):
             if len(version) < 3:
@@ -96,31 +459,146 @@ def include_revision(func):
             elif len(version) > 3:
                 version = version[:3]
             version = '.'.join([str(x) for x in version])
+        return version
+
+    def stamp(version, revision):
+        if not revision:
+            return version
+        return '%s+%s' % (version, revision[:12].decode())
+
+    def f(*args, **kwargs):
+        version = get_version()
 
         # get scc revision number
-        working_dir = (kwargs or {}).get('working_dir')
+        working_dir, names = (kwargs or {}).get('working_dir'), None
         if working_dir:
             del kwargs['working_dir']
         else:
-            # use module to resolve working directory
-            module_path = sys.modules[func.__module__].__path__[0]
-            working_dir = os.path.abspath(os.path.join(module_path, '..'))
+            # use the top-level package or module, which revision_build_py
+            # stamps, to resolve working directory
+            top_level = func.__module__.partition('.')[0]
+            module = sys.modules[top_level]
+            if hasattr(module, '__path__'):
+                module_path = module.__path__[0]
+                working_dir = os.path.abspath(module_path if stamped else
+                                              os.path.join(module_path, '..'))
+            else:
+                working_dir = os.path.dirname(os.path.abspath(module.__file__))
+                if stamped:
+                    names = _module_revision_files(top_level)
 
-        revision = extract_revision(working_dir)
-        if not revision:
-            return version
-        return '%s+%s' % (version, revision[:12].decode())
+        revision = _revision_cache.get(working_dir, stamped, names)
+        return stamp(version, revision)
+
+    def resolve_many(working_dirs, max_workers=None):
+        """Returns a mapping of each working directory to its version, with
+        the repositories resolved concurrently on a pool of threads.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        version, working_dirs = get_version(), list(working_dirs)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            revisions = pool.map(lambda working_dir: _revision_cache.get(
+                working_dir, stamped), working_dirs)
+            return dict((working_dir, stamp(version, revision))
+                        for working_dir, revision in zip(working_dirs,
+                                                         revisions))
+
+    async def resolve_many_async(working_dirs, limit=_REVISION_ASYNC_LIMIT):
+        """Returns a mapping of each working directory to its version, with
+        at most 'limit' repositories resolved at once.
+        """
+        import asyncio
+
+        semaphore = asyncio.Semaphore(limit)
+        async def resolve(working_dir):
+            async with semaphore:
+                return await _revision_cache.get_async(working_dir, stamped)
+
+        version, working_dirs = get_version(), list(working_dirs)
+        revisions = await asyncio.gather(*[resolve(working_dir)
+                                           for working_dir in working_dirs])
+        return dict((working_dir, stamp(version, revision))
+                    for working_dir, revision in zip(working_dirs, revisions))
 
     f.__doc__ = func.__doc__
     f.__name__ = func.__name__
     f.__module__ = func.__module__
     f.__dict__.update(func.__dict__)    
+    f.cache_info = _revision_cache.info
+    f.cache_clear = _revision_cache.clear
+    f.resolve_many = resolve_many
+    f.resolve_many_async = resolve_many_async
     return f
 
 
-class Command(object):
-    """Represents the base class for Command objects."""
-    __metaclass__ = ABCMeta
+def revision_build_py(base=None):
+    """Returns a setuptools `build_py` command class (derived from 'base' if
+    provided) which resolves the revision of the project once at build time
+    and writes it into a REVISION file within each top-level package built,
+    and into a `<module>.REVISION` file next to each top-level module built
+    from `py_modules`, for reading at runtime by functions decorated with
+    `include_revision(stamped=True)`::
+
+        setup(..., cmdclass={'build_py': revision_build_py()})
+    """
+    if base is None:
+        from setuptools.command.build_py import build_py as base
+
+    class build_py(base):
+
+        def run(self):
+            base.run(self)
+            self._revision_files = []
+            if self.dry_run:
+                return
+
+            root = os.path.abspath(self.distribution.src_root or os.curdir)
+            revision = _extract_revision(root, [])
+            if not revision:
+                return
+
+            targets = []
+            for package in set(p.split('.')[0] for p in self.packages or ()):
+                package_dir = os.path.join(self.build_lib, package)
+                if os.path.isdir(package_dir):
+                    targets.append(os.path.join(package_dir,
+                                                _REVISION_FILES[0]))
+            for module in self.py_modules or ():
+                if '.' not in module and os.path.isfile(
+                        os.path.join(self.build_lib, module + '.py')):
+                    targets.append(os.path.join(
+                        self.build_lib, _module_revision_files(module)[0]))
+
+            for filepath in targets:
+                with open(filepath, 'wb') as f:
+                    f.write(revision + b'\n')
+                self._revision_files.append(filepath)
+                self.announce('writing revision to %s' % filepath, 2)
+
+        def get_outputs(self, *args, **kwargs):
+            outputs = base.get_outputs(self, *args, **kwargs)
+            return outputs + getattr(self, '_revision_files', [])
+
+    return build_py
+
+
+class Command(object, metaclass=ABCMeta):
+    """Represents the base class for Command objects.
+
+    Subcommands declared in a `SubCommandRegistry` assigned to `subcommands`
+    are only imported, and their parsers built, once selected on the command
+    line; the parser created by `_create_parser` then only needs to hold the
+    options common to all of them. The selected subcommand is set as `func`
+    on the parsed arguments for `_handle` to call.
+
+    Setting `profile_options` to True has `run_from_argv` handle the
+    options `--timings[=FILE]`, `--profile=FILE` and `--profile-memory`
+    itself, unless the parser of the command declares them, reporting the
+    time spent in each phase of the run; see `_PhaseTimer`.
+    """
+    subcommands = None
+    profile_options = False
 
     def _execute(self, args):
         """Tries to execute this command; if it raises a CommandError, intercept
@@ -143,14 +621,164 @@ class Command(object):
         """Handles default options then runs this command."""
         print('')
         argv = (sys.argv[1:] if argv is None else argv)
-        p = self._create_parser()
-        args = p.parse_args(argv)
+        if self.profile_options and _profile_options(argv)[0]:
+            return self._run_profiled(argv)
+        args = self._parse_argv(argv)
 
         self._handle_default_args(args)
         self._execute(args)
+
+    def _run_profiled(self, argv):
+        # the options found are only handled once the parser is known not
+        # to declare them itself, so the timing starts with all of them
+        timer = _PhaseTimer(argv, _profile_options(argv)[0])
+        timer.start()
+        prog = type(self).__name__
+        try:
+            p = timer.run('create_parser', self._create_parser)
+            prog = p.prog
+            options, argv = _profile_options(argv, p._option_string_actions)
+            if not timer.restrict(argv, options):
+                args = self._parse_argv(argv, p)
+                self._handle_default_args(args)
+                return self._execute(args)
+            if options.get('profile') == '':
+                p.error('--profile expects a file name')
+            args = timer.run('parse_args', self._parse_argv, argv, p)
+            timer.run('handle_default_args', self._handle_default_args, args)
+            timer.run('handle', self._execute, args)
+        except SystemExit as ex:
+            timer.exit_code = (ex.code or 0) if isinstance(
+                ex.code, (int, type(None))) else 1
+            raise
+        except BaseException:
+            timer.exit_code = 1
+            raise
+        finally:
+            if timer.options:
+                timer.stop(prog)
+
+    def run_batch(self, source=None, jobs=1, ordered=True, chunksize=64):
+        """Runs this command once for each line of 'source', a file path, an
+        iterable of lines or stdin by default, with the line split as a shell
+        would as the argv; see `iter_batch`. Outputs are printed to stdout as
+        they come, errors to stderr prefixed by the line number, followed by
+        a summary with the throughput. Returns a BatchSummary.
+        """
+        started = time.time()
+        total = failed = 0
+        f = (open(source) if isinstance(source, str) else
+             sys.stdin if source is None else None)
+        try:
+            for result in self.iter_batch(source if f is None else f, jobs,
+                                          ordered, chunksize):
+                total += 1
+                if result.error is not None:
+                    failed += 1
+                    sys.stderr.write('Error: line %d: %s\n'
+                                     % (result.lineno, result.error))
+                elif result.output:
+                    print(result.output)
+        finally:
+            if f is not None and f is not sys.stdin:
+                f.close()
+
+        summary = BatchSummary(total, failed, time.time() - started)
+        sys.stderr.write('%d lines, %d failed in %.3fs (%.1f lines/s)\n' % (
+            total, failed, summary.seconds,
+            total / summary.seconds if summary.seconds else 0.0))
+        return summary
+
+    def iter_batch(self, lines, jobs=1, ordered=True, chunksize=64):
+        """Runs `_handle` with the argv of each line of 'lines', skipping
+        blank lines and comments, and yields a BatchResult of its output or
+        error; a CommandError, invalid arguments or any other exception is
+        collected for the line rather than ending the batch. With 'jobs'
+        above 1 the lines are run in chunks of 'chunksize' by a pool of that
+        many processes, forked where supported so the command needn't be
+        picklable though its outputs must; results are yielded in the order
+        of 'lines' if 'ordered', else as each chunk completes.
+        """
+        requests = _batch_requests(lines)
+        if jobs <= 1:
+            for lineno, line in requests:
+                yield self._run_batch_line(lineno, line)
+            return
+
+        import multiprocessing
+        from concurrent import futures
+        context = (multiprocessing.get_context('fork')
+                   if 'fork' in multiprocessing.get_all_start_methods()
+                   else None)
+        chunks = _batch_chunks(requests, chunksize)
+        with futures.ProcessPoolExecutor(jobs, context, _init_batch_worker,
+                                         (self,)) as pool:
+            # bounds the lines read ahead of the results consumed
+            pending = []
+            for chunk in chunks:
+                pending.append(pool.submit(_run_batch_chunk, chunk))
+                if len(pending) == jobs * 2:
+                    break
+            while pending:
+                if ordered:
+                    future = pending.pop(0)
+                else:
+                    future = next(iter(futures.wait(
+                        pending, return_when=futures.FIRST_COMPLETED)[0]))
+                    pending.remove(future)
+                for chunk in chunks:
+                    pending.append(pool.submit(_run_batch_chunk, chunk))
+                    break
+                for result in future.result():
+                    yield result
+
+    def _parse_argv(self, argv, p=None):
+        p = self._create_parser() if p is None else p
+        if self.subcommands is None:
+            return p.parse_args(argv)
+        return self.subcommands.parse_args(self, p, argv)
+
+    def _run_batch_line(self, lineno, line):
+        import contextlib, io, shlex
+        output = io.StringIO()
+        argv = None
+        try:
+            argv = shlex.split(line, comments=True)
+            # argparse prints its help and errors before exiting
+            with contextlib.redirect_stdout(output), \
+                    contextlib.redirect_stderr(output):
+                args = self._parse_argv(argv)
+            self._handle_default_args(args)
+            return BatchResult(lineno, argv, self._handle(args), None)
+        except SystemExit as ex:
+            message = output.getvalue().strip()
+            if not ex.code:
+                return BatchResult(lineno, argv, message, None)
+            error = (message.splitlines()[-1] if message
+                     else 'exited with %s' % ex.code)
+        except CommandError as ex:
+            error = str(ex)
+        except Exception as ex:
+            error = '%s: %s' % (type(ex).__name__, ex)
+        return BatchResult(lineno, argv, None, error)
+
+    def serve(self, path):
+        """Serves this command from the Unix socket at 'path' until stopped;
+        see CommandServer and run_client.
+        """
+        CommandServer(self, path).serve_forever()
+
+    def create_subparser(self, subcommand):
+        """Creates the parser of a subcommand selected from `subcommands`,
+        to which the subcommand adds its arguments.
+        """
+        from argparse import ArgumentParser
+        return ArgumentParser(
+            prog=self._subcommand_prog,
+            description=subcommand.__doc__)
     
     def _handle_default_args(self, args):
-        if hasattr(args, 'pythonpath'):
+        if hasattr(args, 'pythonpath') and args.pythonpath not in sys.path:
             sys.path.insert(0, args.pythonpath)
 
     @abstractmethod
@@ -168,9 +796,187 @@ class Command(object):
         pass
 
 
-class SubCommand(object):
+class _PhaseTimer(object):
+    """Times the phases of a run of a Command for the options it handles
+    itself: `--timings` prints the breakdown to stderr, with `--timings=FILE`
+    also appending it as a JSON record to FILE, one per line; `--profile=FILE`
+    writes a cProfile dump of the run to FILE and `--profile-memory` adds the
+    peak memory allocated by each phase, as traced by tracemalloc. Startup,
+    the time spent by the process before the run including its imports, is
+    reported where the start time of the process is known.
+    """
+
+    def __init__(self, argv, options):
+        self.argv = argv
+        self.options = options
+        self.phases = OrderedDict()
+        self.exit_code = 0
+        self._profiler = None
+
+    def start(self):
+        import datetime
+        self.started = datetime.datetime.now().isoformat()
+        startup = _process_uptime()
+        if startup is not None:
+            self.phases['startup'] = dict(seconds=startup,
+                                          modules=len(sys.modules))
+        if self.options.get('memory'):
+            import tracemalloc
+            tracemalloc.start()
+        if self.options.get('profile'):
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def restrict(self, argv, options):
+        """Keeps only 'options' of those the timing started with, 'argv'
+        being the arguments left to parse, and returns False, having stopped
+        the timing, if there are none left.
+        """
+        if self._profiler is not None and not options.get('profile'):
+            self._profiler.disable()
+            self._profiler = None
+        if self.options.get('memory') and not options.get('memory'):
+            import tracemalloc
+            tracemalloc.stop()
+            for record in self.phases.values():
+                record.pop('memory_peak', None)
+        self.argv, self.options = argv, options
+        return bool(options)
+
+    def run(self, phase, func, *args):
+        """Calls 'func' with 'args' and records its time as 'phase'."""
+        modules = len(sys.modules)
+        if self.options.get('memory'):
+            import tracemalloc
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            record = self.phases[phase] = dict(
+                seconds=time.perf_counter() - started,
+                modules=len(sys.modules) - modules)
+            if self.options.get('memory'):
+                record['memory_peak'] = (
+                    tracemalloc.get_traced_memory()[1] - baseline)
+
+    def stop(self, prog):
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.options['profile'])
+        if self.options.get('memory'):
+            import tracemalloc
+            tracemalloc.stop()
+
+        record = OrderedDict([
+            ('prog', prog), ('argv', self.argv), ('started', self.started),
+            ('pid', os.getpid()), ('exit_code', self.exit_code),
+            ('total', sum(p['seconds'] for p in self.phases.values())),
+            ('phases', self.phases)])
+        self._report(record)
+        if self.options.get('timings'):
+            try:
+                with open(self.options['timings'], 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+            except EnvironmentError as ex:
+                sys.stderr.write('Error: cannot write timings: %s\n' % ex)
+
+    def _report(self, record):
+        lines = ['', 'timings: %s (exit code %d)' % (record['prog'],
+                                                     record['exit_code'])]
+        for phase, p in list(record['phases'].items()) + [
+                ('total', dict(seconds=record['total']))]:
+            line = '  %-20s %10.2f ms' % (phase, p['seconds'] * 1e3)
+            if 'modules' in p:
+                line += ' %6d modules' % p['modules']
+            if 'memory_peak' in p:
+                line += ' %10.1f KB peak' % (p['memory_peak'] / 1024.0)
+            lines.append(line)
+        if self._profiler is not None:
+            lines.append('  profile written to %s' % self.options['profile'])
+        sys.stderr.write('\n'.join(lines) + '\n')
+
+
+def _profile_options(argv, declared=()):
+    """Returns the options handled by `_PhaseTimer` found in 'argv', before
+    any '--' and other than those 'declared' by the parser of the command,
+    and the remaining arguments. A `--profile` without a file name is given
+    as an empty string.
+    """
+    options, remaining = {}, []
+    arguments = iter(argv)
+    for arg in arguments:
+        if arg == '--':
+            remaining.append(arg)
+            remaining.extend(arguments)
+        elif arg.partition('=')[0] in declared:
+            remaining.append(arg)
+        elif arg == '--timings' or arg.startswith('--timings='):
+            options['timings'] = arg.partition('=')[2] or None
+        elif arg == '--profile':
+            options['profile'] = next(arguments, '')
+        elif arg.startswith('--profile='):
+            options['profile'] = arg.partition('=')[2]
+        elif arg == '--profile-memory':
+            options['memory'] = True
+        else:
+            remaining.append(arg)
+    return options, remaining
+
+
+def _process_uptime():
+    """Returns the seconds since this process started, read from /proc with
+    the resolution of a clock tick, or None where it's unavailable.
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            fields = f.read().rpartition(')')[2].split()
+        started = int(fields[19]) / float(os.sysconf('SC_CLK_TCK'))
+        return max(time.clock_gettime(time.CLOCK_BOOTTIME) - started, 0.0)
+    except (EnvironmentError, ValueError, IndexError, AttributeError):
+        return None
+
+
+BatchResult = namedtuple('BatchResult', 'lineno argv output error')
+BatchSummary = namedtuple('BatchSummary', 'total failed seconds')
+
+# the command run by the processes of a batch pool
+_batch_command = None
+
+
+def _batch_requests(lines):
+    """Yields the (lineno, line) pairs of the lines of a batch to run."""
+    for lineno, line in enumerate(lines, 1):
+        stripped = line.strip()
+        if stripped and not stripped.startswith('#'):
+            yield lineno, line
+
+
+def _batch_chunks(requests, chunksize):
+    chunk = []
+    for request in requests:
+        chunk.append(request)
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _init_batch_worker(command):
+    global _batch_command
+    _batch_command = command
+
+
+def _run_batch_chunk(chunk):
+    return [_batch_command._run_batch_line(lineno, line)
+            for lineno, line in chunk]
+
+
+class SubCommand(object, metaclass=ABCMeta):
     """Represents the base class for a SubCommand object."""
-    __metaclass__ = ABCMeta
 
     def __init__(self, parent):
         self._subparser = parent.create_subparser(self)
@@ -184,6 +990,432 @@ class SubCommand(object):
         pass
 
 
+class SubCommandRegistry(object):
+    """Declares the subcommands of a Command by name and import path, such
+    as 'tool.commands.serve:ServeCommand', or by entry point, importing
+    each only when it's selected. The one-line help listed for each by the
+    top-level help is given when declared or else read from the docstring
+    of its class, which is kept in the JSON file at 'cache_path' if given
+    along with the stamp of its module so later runs needn't import it; it's
+    only read from the class once the top-level help is formatted.
+    """
+
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        self._entries = OrderedDict()
+        self._metadata = None
+        self._dirty = False
+
+    def register(self, name, target, help=None):
+        """Declares the subcommand 'name' implemented by 'target', a
+        SubCommand class or the import path of one as 'module:attribute'.
+        """
+        self._entries[name] = (target, help)
+
+    def register_entry_points(self, group):
+        """Declares the subcommands advertised by installed distributions
+        as entry points of 'group' without importing them.
+        """
+        from importlib import metadata
+        try:
+            entry_points = metadata.entry_points(group=group)
+        except TypeError:   # before Python 3.10
+            entry_points = metadata.entry_points().get(group, ())
+        for entry_point in entry_points:
+            self.register(entry_point.name, entry_point.value)
+
+    def names(self):
+        return list(self._entries)
+
+    def load(self, name):
+        """Imports and returns the SubCommand class of 'name'."""
+        target = self._entries[name][0]
+        if not isinstance(target, str):
+            return target
+        module_name, _, attribute = target.partition(':')
+        __import__(module_name)
+        value = sys.modules[module_name]
+        for part in attribute.split('.') if attribute else ():
+            value = getattr(value, part)
+        return value
+
+    def help(self, name):
+        """Returns the one-line help of 'name', importing its class only if
+        it isn't given nor cached for the current version of its module.
+        """
+        help = self._known_help(name)
+        if help is None:
+            target = self._entries[name][0]
+            help = _summary(self.load(name))
+            self._load_metadata()[target] = [
+                _module_stamp(target.partition(':')[0]), help]
+            self._dirty = True
+        return help
+
+    def _known_help(self, name):
+        """Returns the one-line help of 'name' if it's given or cached for
+        the current version of its module, or else None, without importing
+        its class.
+        """
+        target, help = self._entries[name]
+        if help is not None:
+            return help
+        if not isinstance(target, str):
+            return _summary(target)
+
+        stamp = _module_stamp(target.partition(':')[0])
+        entry = self._load_metadata().get(target)
+        if stamp is not None and entry is not None and \
+                tuple(entry[0]) == stamp:
+            return entry[1]
+        return None
+
+    def _load_metadata(self):
+        if self._metadata is None:
+            self._metadata = {}
+            if self.cache_path:
+                try:
+                    with open(self.cache_path) as f:
+                        self._metadata = json.load(f)
+                except (EnvironmentError, ValueError):
+                    pass
+        return self._metadata
+
+    def _save_metadata(self):
+        """Writes the cached help atomically, ignoring failures as the cache
+        is only an optimisation.
+        """
+        if not (self._dirty and self.cache_path):
+            return
+        import tempfile
+        try:
+            fd, temp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.cache_path)))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._metadata, f)
+            os.replace(temp_path, self.cache_path)
+            self._dirty = False
+        except EnvironmentError:
+            pass
+
+    def add_placeholders(self, parser):
+        """Adds a subparser to 'parser' for each subcommand which only lists
+        it, leaving its arguments to the parser of the subcommand itself.
+        The help of those which would have to be imported to get it is only
+        looked up once the help of 'parser' is formatted.
+        """
+        if getattr(parser, '_subcommand_registry', None) is self:
+            return
+        subparsers = parser.add_subparsers(dest='_subcommand',
+                                           metavar='<command>')
+        pending = []
+        for name in self._entries:
+            help = self._known_help(name)
+            subparsers.add_parser(name, help=help, add_help=False)
+            if help is None:
+                pending.append((subparsers._choices_actions[-1], name))
+        parser._subcommand_registry = self
+
+        if pending:
+            format_help = parser.format_help
+
+            def format_help_with_subcommands():
+                for action, name in pending:
+                    action.help = self.help(name)
+                del pending[:]
+                self._save_metadata()
+                return format_help()
+            parser.format_help = format_help_with_subcommands
+
+    def parse_args(self, command, parser, argv):
+        """Parses 'argv' with 'parser', extended with placeholders for the
+        subcommands, then with the parser of the selected subcommand which
+        is imported and created for 'command' and set as `func`.
+        """
+        self.add_placeholders(parser)
+        args, rest = parser.parse_known_args(argv)
+        name = args._subcommand
+        del args._subcommand
+        if name is None:
+            if rest:
+                parser.error('unrecognized arguments: %s' % ' '.join(rest))
+            return args
+
+        command._subcommand_prog = '%s %s' % (parser.prog, name)
+        subcommand = self.load(name)(command)
+        subcommand._subparser.parse_args(rest, namespace=args)
+        args.func = subcommand
+        return args
+
+
+def _summary(subcommand_type):
+    doc = (subcommand_type.__doc__ or '').strip()
+    return doc.splitlines()[0] if doc else ''
+
+
+def _module_stamp(module_name):
+    """Returns the stamp of the source of a module, found without importing
+    it, or None if it can't be found.
+    """
+    import importlib.util
+    try:
+        spec = importlib.util.find_spec(module_name)
+    except (ImportError, ValueError):
+        return None
+    if spec is None or not spec.origin:
+        return None
+    return _stat_stamp(spec.origin)
+
+
+# the header of a request sent to a CommandServer: length of the JSON body
+_SERVER_HEADER = struct.Struct('!I')
+_SERVER_STATUS = struct.Struct('!i')
+
+
+class CommandServer(object):
+    """Serves a Command from a resident process that has already imported
+    its modules and loaded its configs. It listens on the Unix socket at
+    'path' and forks a child per request, sent by `run_client`, which runs
+    `run_from_argv` with the argv, working directory and environment of the
+    client and writes straight to the stdin, stdout and stderr passed along
+    with it; the exit code of the child is sent back once it has exited.
+    A connection is only read from once it has data, and is dropped if its
+    request isn't received within 'request_timeout' seconds, so one idle
+    client can't hold up the others.
+    """
+
+    def __init__(self, command, path, request_timeout=5.0):
+        import socket
+        self.command = command
+        self.path = path
+        self.request_timeout = request_timeout
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(path)     # left behind by a server that was killed
+            else:
+                raise CommandError('A server is already listening on %s' % path)
+            finally:
+                probe.close()
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(path)
+        self._listener.listen(64)
+        self._children = {}
+        self._pending = {}      # connections yet to send their request
+        self._running = False
+
+    def serve_forever(self):
+        """Handles requests until `shutdown` is called or the process is
+        interrupted, then closes the server.
+        """
+        import select
+        self._running = True
+        try:
+            while self._running:
+                readable = select.select(
+                    [self._listener] + list(self._children)
+                    + list(self._pending), [], [], 0.5)[0]
+                for fd in readable:
+                    if fd is self._listener:
+                        self._accept()
+                    elif fd in self._pending:
+                        self._start(fd)
+                    else:
+                        self._reap(fd)
+                self._expire()
+        finally:
+            self.close()
+
+    def shutdown(self):
+        self._running = False
+
+    def close(self):
+        """Waits for the requests in progress then removes the socket."""
+        for fd in list(self._children):
+            self._reap(fd)
+        for conn in list(self._pending):
+            self._pending.pop(conn).close()
+        if self._listener.fileno() != -1:
+            self._listener.close()
+            try:
+                os.unlink(self.path)
+            except EnvironmentError:
+                pass
+
+    def _accept(self):
+        conn = self._listener.accept()[0]
+        self._pending[conn] = time.monotonic() + self.request_timeout
+
+    def _expire(self):
+        now = time.monotonic()
+        for conn, deadline in list(self._pending.items()):
+            if deadline < now:
+                del self._pending[conn]
+                conn.close()
+
+    def _start(self, conn):
+        """Receives the request of 'conn', which has data to read, and forks
+        the child running it.
+        """
+        deadline = self._pending.pop(conn)
+        try:
+            # the rest of a request sent in several parts may still follow
+            conn.settimeout(max(deadline - time.monotonic(), 0.001))
+            request, fds = _receive_request(conn)
+            conn.settimeout(None)
+        except (EnvironmentError, ValueError):
+            conn.close()
+            return
+        sys.stdout.flush()  # else the child inherits and repeats the buffer
+        sys.stderr.flush()
+        done_r, done_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                os.close(done_r)
+                self._listener.close()
+                for fd in list(self._children):
+                    os.close(fd)
+                for pending in self._pending:
+                    pending.close()
+                code = self._run_child(request, fds)
+            finally:
+                os._exit(code)
+
+        # the pipe reaches EOF once the child has exited, however it exits
+        os.close(done_w)
+        for fd in fds:
+            os.close(fd)
+        self._children[done_r] = (pid, conn)
+
+    def _reap(self, fd):
+        pid, conn = self._children.pop(fd)
+        os.close(fd)
+        status = os.waitpid(pid, 0)[1]
+        code = os.waitstatus_to_exitcode(status)
+        try:
+            conn.sendall(_SERVER_STATUS.pack(
+                code if code >= 0 else 128 - code))
+        except EnvironmentError:
+            pass
+        conn.close()
+
+    def _run_child(self, request, fds):
+        """Runs the request in the forked child, returning its exit code."""
+        import traceback
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        # the streams of the server may not have been writing to 0, 1 and 2
+        sys.stdin = open(0, 'r', closefd=False)
+        sys.stdout = open(1, 'w', closefd=False)
+        sys.stderr = open(2, 'w', buffering=1, closefd=False)
+        code = 1
+        try:
+            os.chdir(request['cwd'])
+            os.environ.clear()
+            os.environ.update(request['env'])
+            sys.argv = [request['prog']] + request['argv']
+            self.command.run_from_argv(request['argv'])
+            code = 0
+        except SystemExit as ex:
+            code = _exit_code(ex)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            for stream in (sys.stdout, sys.stderr):
+                try:
+                    stream.flush()
+                except Exception:
+                    pass
+        return code
+
+
+def run_client(path, argv=None, fallback=None, fds=(0, 1, 2)):
+    """Runs a command through the CommandServer listening on 'path', passing
+    it 'argv' and the file descriptors to use as its stdin, stdout and
+    stderr, and returns its exit code. When no server is running the command
+    is run in process by calling 'fallback' with 'argv' instead.
+    """
+    import socket
+    argv = list(sys.argv[1:] if argv is None else argv)
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            conn.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            if fallback is None:
+                raise CommandError('No server is listening on %s' % path)
+            try:
+                fallback(argv)
+            except SystemExit as ex:
+                return _exit_code(ex)
+            return 0
+
+        body = json.dumps(dict(
+            argv=argv, prog=sys.argv[0] if sys.argv else '',
+            cwd=os.getcwd(), env=dict(os.environ))).encode('utf-8')
+        message = _SERVER_HEADER.pack(len(body)) + body
+        sent = socket.send_fds(conn, [message], list(fds))
+        if sent < len(message):
+            conn.sendall(message[sent:])
+        status = _receive_exactly(conn, _SERVER_STATUS.size)
+        if status is None:
+            raise CommandError('The server closed the connection')
+        return _SERVER_STATUS.unpack(status)[0]
+    finally:
+        conn.close()
+
+
+def _receive_request(conn):
+    """Returns the request and the file descriptors sent by `run_client`."""
+    import socket
+    data, fds = socket.recv_fds(conn, 65536, 3)[:2]
+    try:
+        if len(fds) != 3:
+            raise ValueError('Expected stdin, stdout and stderr descriptors')
+        size = _SERVER_HEADER.size
+        if len(data) < size:
+            data += _receive_exactly(conn, size - len(data)) or b''
+        if len(data) < size:
+            raise ValueError('Truncated request')
+        length = _SERVER_HEADER.unpack(data[:size])[0]
+        body = data[size:]
+        if len(body) < length:
+            body += _receive_exactly(conn, length - len(body)) or b''
+        if len(body) != length:
+            raise ValueError('Truncated request')
+        return json.loads(body.decode('utf-8')), fds
+    except BaseException:
+        for fd in fds:
+            os.close(fd)
+        raise
+
+
+def _receive_exactly(conn, size):
+    chunks = []
+    while size:
+        chunk = conn.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _exit_code(ex):
+    """Returns the exit code of a SystemExit as the interpreter would."""
+    if ex.code is None:
+        return 0
+    if isinstance(ex.code, int):
+        return ex.code
+    sys.stderr.write('%s\n' % ex.code)
+    return 1
+
+
 class Storage(dict):
     """Represents a dictionary object whose elements can be accessed and set 
     using the dot object notation. Thus in addition to `foo['bar']`, `foo.bar` 
@@ -194,6 +1426,8 @@ class Storage(dict):
         dict.__init__(self, *args, **kwargs)
 
     def __getattr__(self, key):
+        if _config_stats is not None:
+            _config_stats._attribute_read(self, key)
         return self.__getitem__(key)
     
     def __setattr__(self, key, value):
@@ -210,81 +1444,2439 @@ class Storage(dict):
 
     def __repr__(self):
         return '<Storage %s>' % dict.__repr__(self)
+
+    def get_path(self, path, default=None):
+        """Returns the value found by following the keys of a dotted path
+        such as 'fix.mix[1].all.name' or 'default' if any of them is missing.
+        Integer keys, given in brackets or between dots, index lists.
+        """
+        try:
+            accessor = _path_accessors[path]
+        except KeyError:
+            accessor = _compile_path(path)
+        return accessor(self, default)
+
+    @staticmethod
+    def compile_path(path):
+        """Parses a dotted path as taken by `get_path` and returns a
+        function taking a Storage object and an optional default which looks
+        the path up within it. Compiled paths are kept for reuse.
+        """
+        return _compile_path(path)
     
     @staticmethod
-    def make(obj):
+    def load(source, backend=None):
+        """Decodes the JSON document read from 'source', a file object or the
+        document as bytes or text, straight into Storage objects rather than
+        into dicts converted by `make` afterwards. 'backend' selects the
+        JSON decoder as `set_json_backend` does; the standard library's is
+        used by default as only it builds Storage objects as it decodes.
+        """
+        return _load_storage(source, backend)
+
+    @staticmethod
+    def make(obj, lazy=False):
         """Converts all dict-like elements of a dict or storage object into
-        storage objects.
+        storage objects, including those nested within lists and tuples.
+        Elements referenced more than once, cycles included, are converted
+        once with the references preserved. If 'lazy' is True, only the top
+        level is converted and a `LazyStorage` is returned which converts
+        nested dicts when they are first accessed.
         """
         if not isinstance(obj, (dict,)):
             raise ValueError('obj must be a dict or dict-like object')
-        
-        _make = lambda d: Storage({ k: d[k] 
-            if not isinstance(d[k], (dict, Storage))
-            else _make(d[k])
-                for k in d.keys()
-        })
-        return _make(obj)
 
+        if lazy:
+            return LazyStorage(obj)
+        return _make_storage(obj)
 
-class Config(Storage):
-    """A dictionary which contains configuration settings."""
+    def to_dict(self):
+        """Returns a copy of the settings as plain dicts, lists and tuples,
+        read as they are by `items()`. Unlike this object, the copy can be
+        passed to `json.dumps` whatever the type of the Storage, including
+        those holding their settings in layers or shared memory which
+        `json.dumps` would take for empty.
+        """
+        return _make_storage(self, dict)
 
-    class Meta(type):
-        """Meta class for creating Config object types."""
 
-        def __new__(cls, name, bases, attrs):
-            _cls = type.__new__(cls, name, bases, attrs)
-            _cls._func_defaults = Storage()
-            _cls._defaults = Storage()
-            return _cls
+def _make_storage(obj, mapping=Storage):
+    """Performs the eager conversion for `Storage.make` using an explicit
+    stack instead of recursion so the nesting depth isn't bounded by the
+    recursion limit. Lists and tuples are copied; tuples are built once
+    their elements exist so they're the only containers converted
+    recursively. Dicts are converted into 'mapping' objects, their items
+    read as by `_storage_items` so settings held by layers or shared memory
+    are copied as well.
+    """
+    # the items read are kept so the ids memoized stay unique
+    memo, pending, read = {}, [], []
+
+    def convert(value):
+        if not isinstance(value, dict) and type(value) not in (list, tuple):
+            return value
+
+        result = memo.get(id(value))
+        if result is not None:
+            return result
+
+        if isinstance(value, dict):
+            result = mapping()
+        elif type(value) is list:
+            result = []
+        else:
+            result = tuple([convert(item) for item in value])
+            memo[id(value)] = result
+            return result
+
+        memo[id(value)] = result
+        pending.append((value, result))
+        return result
+
+    containers = (dict, list, tuple)
+    result = convert(obj)
+    while pending:
+        source, target = pending.pop()
+        if type(target) is list:
+            target.extend([convert(v) if isinstance(v, containers) else v
+                           for v in source])
+        else:
+            items = _storage_items(source)
+            read.append(items)
+            dict.update(target, {
+                k: convert(v) if isinstance(v, containers) else v
+                    for k, v in items
+            })
+    return result
+
+
+def _wrap_lazy(storage, key, value):
+    """Replaces a plain dict 'value' held under 'key' in 'storage' with a
+    `LazyStorage` wrapping it, so subsequent reads return the same object.
+    Lists and tuples are converted eagerly by `_make_storage` on first read.
+    """
+    if type(value) is dict:
+        value = LazyStorage(value)
+        dict.__setitem__(storage, key, value)
+    elif type(value) in (list, tuple):
+        value = _make_storage(value)
+        dict.__setitem__(storage, key, value)
+    return value
+
+
+class LazyStorage(Storage):
+    """A Storage object whose nested dicts are converted into LazyStorage
+    objects only when first accessed rather than all at once by
+    `Storage.make`. The nested dicts are not copied until then, so they
+    shouldn't be modified through other references afterwards; copies made
+    by `dict()`, `{**storage}` or `copy()` read them through `__getitem__`
+    to that end.
+    """
+
+    def __getitem__(self, key):
+        return _wrap_lazy(self, key, dict.get(self, key, None))
+
+    def __iter__(self):
+        # overriding __iter__ takes dict() off its fast path which copies
+        # the stored values, possibly shared nested dicts, as they are
+        return dict.__iter__(self)
+
+    def copy(self):
+        return dict(self)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def __repr__(self):
+        return '<LazyStorage %s>' % dict.__repr__(self)
+
+
+# a step of a dotted path: a key optionally followed by list indices
+_PATH_STEP = re.compile(r'([^.\[\]]*)((?:\[-?\d+\])*)$')
+_PATH_INDEX = re.compile(r'-?\d+')
+_PATH_INTEGER = re.compile(r'-?\d+$')
+
+# the maximum number of compiled path accessors kept
+_PATH_CACHE_SIZE = 1024
+_path_accessors = {}
+
+
+def _parse_path(path):
+    """Splits a dotted path such as 'fix.mix[1].all.name' or
+    'fix.mix.1.all.name' into its keys. An integer key indexes lists and
+    tuples and otherwise is looked up as a string, so each step is returned
+    as a (key, index) pair where index is None unless the key is an integer.
+    """
+    steps = []
+    for part in path.split('.'):
+        match = _PATH_STEP.match(part)
+        if not match or not any(match.groups()):
+            raise ValueError('Invalid path: %r' % path)
+
+        name, indices = match.groups()
+        keys = ([name] if name else []) + _PATH_INDEX.findall(indices)
+        for key in keys:
+            index = int(key) if _PATH_INTEGER.match(key) else None
+            steps.append((key, index))
+    return tuple(steps)
+
+
+def _compile_path(path):
+    """Returns the accessor for 'path', which is parsed once and kept.
+    The accessor takes a Storage object and a default returned when a key
+    along the path is missing or set to None.
+    """
+    accessor = _path_accessors.get(path)
+    if accessor is not None:
+        return accessor
+
+    steps = _parse_path(path)
+    _get = dict.get
+
+    def accessor(obj, default=None):
+        for key, index in steps:
+            cls = type(obj)
+            if cls is Storage:
+                obj = _get(obj, key)
+            elif cls is list or cls is tuple:
+                if index is None:
+                    return default
+                try:
+                    obj = obj[index]
+                except IndexError:
+                    return default
+            elif (cls is Config or isinstance(obj, Config)) and not obj._lazy:
+                # a value held by a Config is final unless deferred, deleted
+                # from an overlay, read while computing a func default or
+                # counted by ConfigStats
+                value = _get(obj, key)
+                if (value is None or value is _TOMBSTONE
+                        or _config_stats is not None
+                        or type(value) is _Deferred or _computing.frames):
+                    value = obj[key]
+                obj = value
+            elif isinstance(obj, dict):
+                obj = obj[key]  # applies lazy conversions and overlays
+            else:
+                return default
+            if obj is None:
+                return default
+        return obj
+
+    accessor.path = path
+    if len(_path_accessors) >= _PATH_CACHE_SIZE:
+        _path_accessors.clear()
+    _path_accessors[path] = accessor
+    return accessor
+
+
+class FrozenStorage(Storage):
+    """An immutable Storage object whose nested dicts are FrozenStorage
+    objects as well and whose lists are turned into tuples, so it can be
+    hashed, its hash being computed once, and shared between threads
+    without being copied. `set_path` and `evolve` return new versions which
+    share every unchanged subtree with this one.
+    """
+
+    _hash = None
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, _freeze(dict(*args, **kwargs)))
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('FrozenStorage objects are immutable')
+
+    __setitem__ = __delitem__ = __setattr__ = __delattr__ = _immutable
+    update = pop = popitem = clear = setdefault = __ior__ = _immutable
+
+    def __hash__(self):
+        if self._hash is None:
+            object.__setattr__(self, '_hash',
+                               hash(frozenset(dict.items(self))))
+        return self._hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if (isinstance(other, FrozenStorage) and self._hash is not None
+                and other._hash is not None and self._hash != other._hash):
+            return False
+        if type(other) in (dict, Storage, FrozenStorage):
+            return dict.__eq__(self, other)
+        if isinstance(other, dict):
+            return dict.__eq__(self, dict(_storage_items(other)))
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __reduce__(self):
+        return (FrozenStorage, (dict(self),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def evolve(self, *args, **changes):
+        """Returns a FrozenStorage with the top-level settings given as for
+        `dict.update` changed and everything else shared with this one.
+        """
+        changes = _freeze(dict(*args, **changes))
+        if all(dict.get(self, key, changes) is value
+               for key, value in changes.items()):
+            return self
+        frozen = dict(self)
+        frozen.update(changes)
+        return _frozen_storage(frozen)
+
+    def set_path(self, path, value):
+        """Returns a FrozenStorage with the setting at the dotted 'path', as
+        taken by `get_path`, set to 'value'. Only the dicts and tuples along
+        the path are copied, missing dicts being created.
+        """
+        return _set_path(self, _parse_path(path), _freeze(value), path)
+
+    def __repr__(self):
+        return '<FrozenStorage %s>' % dict.__repr__(self)
+
+
+def _frozen_storage(items):
+    storage = FrozenStorage.__new__(FrozenStorage)
+    dict.__init__(storage, items)
+    return storage
+
+
+def _freeze(value):
+    """Returns 'value' with its dicts turned into FrozenStorage objects, its
+    lists and tuples into tuples and its sets into frozensets. Those already
+    frozen are kept and containers referenced more than once are frozen once.
+    An explicit stack is used instead of recursion so the nesting depth isn't
+    bounded by the recursion limit.
+    """
+    def children(item):
+        if isinstance(item, dict):
+            return list(_storage_items(item))
+        return [(None, child) for child in item]
+
+    def needs_freezing(item):
+        return (isinstance(item, (dict, list, tuple, set))
+                and type(item) is not FrozenStorage)
+
+    if not needs_freezing(value):
+        return value
+
+    memo, active = {}, set()
+    pending = [(value, None)]
+    while pending:
+        item, items = pending.pop()
+        if items is None:
+            if id(item) in memo:
+                continue
+            if id(item) in active:
+                raise ValueError('Cyclic structures cannot be frozen')
+            active.add(id(item))
+            items = children(item)
+            pending.append((item, items))
+            pending.extend((child, None) for _, child in items
+                           if needs_freezing(child))
+            continue
+
+        frozen = [(key, memo.get(id(child), child)) for key, child in items]
+        if isinstance(item, dict):
+            memo[id(item)] = _frozen_storage(frozen)
+        elif isinstance(item, (set, frozenset)):
+            memo[id(item)] = frozenset(child for _, child in frozen)
+        else:
+            memo[id(item)] = tuple(child for _, child in frozen)
+        active.discard(id(item))
+    return memo[id(value)]
+
+
+def _storage_items(storage):
+    """Returns the items of a dict or of a Storage object whose values are
+    resolved or merged when read.
+    """
+    if type(storage) in (dict, Storage, FrozenStorage):
+        return dict.items(storage)
+    return storage.items()
+
+
+def _same_settings(a, b):
+    """Returns whether 'a' and 'b' hold the same settings, taking a list and
+    a tuple of equal elements as equal and reading the items of dicts as by
+    `_storage_items`.
+    """
+    if isinstance(a, dict) and isinstance(b, dict):
+        a, b = dict(_storage_items(a)), dict(_storage_items(b))
+        return a.keys() == b.keys() and all(
+            _same_settings(value, b[key]) for key, value in a.items())
+    if type(a) in (list, tuple) and type(b) in (list, tuple):
+        return len(a) == len(b) and all(
+            _same_settings(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+def _set_path(node, steps, value, path):
+    (key, index), rest = steps[0], steps[1:]
+    if isinstance(node, tuple) and index is not None:
+        if not -len(node) <= index < len(node):
+            raise IndexError('Index out of range in path: %r' % path)
+        items = list(node)
+        items[index] = _set_path(node[index], rest, value, path) \
+                       if rest else value
+        return tuple(items)
+
+    if node is None:
+        node = _frozen_storage(())
+    if not isinstance(node, FrozenStorage):
+        raise TypeError('Cannot set %r within %s in path: %r'
+                        % (key, type(node).__name__, path))
+    return node.evolve({key: _set_path(dict.get(node, key), rest, value, path)
+                        if rest else value})
+
+
+# JSON decoders used when installed, fastest first; json is always present
+_JSON_BACKENDS = ('orjson', 'ujson', 'json')
+_json_backend = None
+
+
+def _json_decoder(backend=None):
+    """Returns the decoding function for 'backend', a module name, a module
+    or a function taking a JSON document as bytes or text, or the decoder
+    selected for the process if 'backend' isn't given.
+    """
+    if backend is None:
+        return _json_backend or set_json_backend()
+    if isinstance(backend, str):
+        backend = __import__(backend)
+    return getattr(backend, 'loads', backend)
+
+
+def set_json_backend(backend=None):
+    """Selects the JSON decoder used to load configuration files when a
+    Config type doesn't set its own with `_json_backend`: a module name
+    such as 'orjson', a module or a function taking the document as bytes
+    or text. Without one, the fastest installed among orjson, ujson and the
+    standard library's json is selected. Returns the decoding function.
+    """
+    global _json_backend
+    if backend is None:
+        for name in _JSON_BACKENDS:
+            try:
+                backend = __import__(name)
+                break
+            except ImportError:
+                continue
+    _json_backend = _json_decoder(backend)
+    return _json_backend
+
+
+def _decode_json(data, decoder):
+    """Decodes 'data' with 'decoder' falling back to the standard library,
+    which also accepts NaN, Infinity and integers of any size, when it
+    fails to.
+    """
+    try:
+        return decoder(data)
+    except ValueError:
+        if decoder is json.loads:
+            raise
+        return json.loads(data)
+
+
+def _read_source(source):
+    if hasattr(source, 'read'):
+        source = source.read()
+    if not isinstance(source, (bytes, bytearray, memoryview, str)):
+        raise TypeError('Expected a file object, bytes or text, got %s'
+                        % type(source).__name__)
+    return bytes(source) if isinstance(source, memoryview) else source
+
+
+def _load_storage(source, backend=None):
+    """Decodes the JSON document read from 'source', a file object or bytes
+    or text, into Storage objects. The standard library's decoder builds
+    them as it goes, which is faster than decoding plain dicts with a
+    faster backend and converting them afterwards, so it's used unless a
+    backend is given.
+    """
+    data = _read_source(source)
+    decoder = json.loads if backend is None else _json_decoder(backend)
+    if decoder is json.loads:
+        return json.loads(data, object_hook=Storage)
+    document = _decode_json(data, decoder)
+    return _make_storage(document) if isinstance(document, dict) else document
+
+
+# identifies the layout of config snapshot files; bump when it changes
+_SNAPSHOT_MAGIC = 'dolfin-snapshot-1'
+_STORAGE_SNAPSHOT_MAGIC = 'dolfin-storage-snapshot-1'
+
+
+def _snapshot_path(filepath, snapshot, storage=False):
+    """Returns the path of the snapshot of the configuration file at
+    'filepath', either next to it or within the 'snapshot' directory. The
+    snapshots of Storage trees are kept apart from those of parsed
+    documents.
+    """
+    suffix = '.storage.snapshot' if storage else '.snapshot'
+    if snapshot is True:
+        return filepath + suffix
+
+    import hashlib
+    digest = hashlib.sha1(os.fsencode(filepath)).hexdigest()[:16]
+    name = '%s-%s%s' % (os.path.basename(filepath), digest, suffix)
+    return os.path.join(snapshot, name)
+
+
+def _write_snapshot(snapshot_path, header, payload):
+    """Atomically writes a snapshot, ignoring failures as snapshots are only
+    an optimisation.
+    """
+    import marshal, tempfile
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(snapshot_path))
+        with os.fdopen(fd, 'wb') as f:
+            header = marshal.dumps(header)
+            f.write(struct.pack('<I', len(header)) + header)
+            f.write(payload)
+        os.replace(temp_path, snapshot_path)
+    except (EnvironmentError, ValueError):
+        pass
+
+
+def _reduce_storage(storage):
+    # pickles the items of a Storage object only once, rather than also as
+    # the state returned by __getstate__, and restores them without calling
+    # __setstate__
+    return (Storage, (), None, None, iter(dict.items(storage)))
+
+
+def _dump_storage(document):
+    """Returns 'document' converted into Storage objects and pickled."""
+    import copyreg, io, pickle
+    f = io.BytesIO()
+    pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+    pickler.dispatch_table = copyreg.dispatch_table.copy()
+    pickler.dispatch_table[Storage] = _reduce_storage
+    pickler.dump(_make_storage(document))
+    return f.getvalue()
+
+
+class _PickledStorage(object):
+    """A parsed configuration file converted into Storage objects and
+    pickled, which is unpickled into a new copy for each Config built from
+    it rather than being copied by `Storage.make`.
+    """
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def load(self):
+        import pickle
+        return pickle.loads(self.data)
+
+
+def _load_document(filepath, snapshot=None, decoder=json.loads,
+                   storage=False):
+    """Parses the JSON configuration file at 'filepath' with 'decoder'. If
+    'snapshot' is
+    True or a directory path, the parsed document is also kept in a marshal
+    snapshot (a length-prefixed header followed by the document) which is
+    loaded instead of parsing the file for as long as the file's size and
+    hash match; a snapshot whose recorded mtime also matches is trusted
+    without hashing the file. Stale snapshots are rebuilt. If 'storage' is
+    True, the snapshot instead holds the document converted into Storage
+    objects and pickled, and a `_PickledStorage` of it is returned.
+    """
+    if not snapshot:
+        with open(filepath, 'rb') as f:
+            return _decode_json(f.read(), decoder)
+
+    import hashlib, marshal
+    started, st = time.time(), os.stat(filepath)
+    snapshot_path = _snapshot_path(filepath, snapshot, storage)
+    expected = _STORAGE_SNAPSHOT_MAGIC if storage else _SNAPSHOT_MAGIC
+    content = stored = None
+    try:
+        with open(snapshot_path, 'rb') as f:
+            length, = struct.unpack('<I', f.read(4))
+            stored = marshal.loads(f.read(length))
+            magic, size, mtime, digest = stored
+            fresh = magic == expected and size == st.st_size
+            if fresh and mtime != st.st_mtime_ns:
+                with open(filepath, 'rb') as source:
+                    content = source.read()
+                fresh = hashlib.sha1(content).hexdigest() == digest
+            if fresh:
+                payload = f.read()
+                document = (_PickledStorage(payload) if storage else
+                            marshal.loads(payload))
+                if mtime == st.st_mtime_ns:
+                    return document
+    except (EnvironmentError, EOFError, ValueError, TypeError, struct.error):
+        fresh = False
+
+    if content is None:
+        with open(filepath, 'rb') as source:
+            content = source.read()
+    if not fresh:
+        document = _decode_json(content, decoder)
+        if storage:
+            payload = _dump_storage(document)
+            document = _PickledStorage(payload)
+        else:
+            payload = marshal.dumps(document)
+
+    # a racy mtime isn't recorded so the next load verifies the hash
+    mtime = None if _is_racy([(st.st_mtime_ns,)], started) else st.st_mtime_ns
+    header = (expected, st.st_size, mtime, hashlib.sha1(content).hexdigest())
+    if header != stored:
+        _write_snapshot(snapshot_path, header, payload)
+    return document
+
+
+_JSON_WHITESPACE = re.compile(br'[ \t\n\r]*')
+_JSON_STRING = re.compile(br'"[^"\\]*(?:\\.[^"\\]*)*"')
+_JSON_SCALAR = re.compile(br'[^,}\] \t\n\r]+')
+# matches everything up to the next bracket which isn't within a string
+_JSON_NESTED_TEXT = re.compile(
+    br'[^"{}\[\]]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"{}\[\]]*)*')
+
+
+class _JsonIndex(object):
+    """An index of where the value of each top-level key of a JSON object
+    starts and ends within a memory-mapped file, from which values are
+    decoded only when first requested. Decoded values are shared by all
+    users of the index and so must be copied before being handed out.
+
+    The file must be replaced rather than modified in place while indexed
+    as the index reads from the mapping for as long as it is alive.
+    """
+
+    def __init__(self, filepath, decoder=json.loads):
+        import mmap
+        self.filepath, self._decoder = filepath, decoder
+        self._decoded = {}
+        with open(filepath, 'rb') as f:
+            try:
+                self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                self._buffer = b''      # empty files can't be mapped
+        self.spans = self._scan(self._buffer)
+
+    def decode(self, key):
+        try:
+            return self._decoded[key]
+        except KeyError:
+            start, end = self.spans[key]
+            value = self._decoded[key] = _decode_json(
+                self._buffer[start:end], self._decoder)
+            return value
+
+    def placeholders(self):
+        return dict((key, _Deferred(self, key)) for key in self.spans)
+
+    def _error(self, pos):
+        return ValueError('Invalid JSON object in %s at offset %d'
+                          % (self.filepath, pos))
+
+    def _scan(self, buf):
+        skip = lambda pos: _JSON_WHITESPACE.match(buf, pos).end()
+        if buf[:3] == b'\xef\xbb\xbf':
+            pos = skip(3)   # utf-8 byte order mark
+        else:
+            pos = skip(0)
+        if buf[pos:pos + 1] != b'{':
+            raise self._error(pos)
+
+        spans, pos = {}, skip(pos + 1)
+        if buf[pos:pos + 1] == b'}' and skip(pos + 1) == len(buf):
+            return spans
+        while True:
+            match = _JSON_STRING.match(buf, pos)
+            if match is None:
+                raise self._error(pos)
+            key = match.group()[1:-1]
+            if b'\\' in key:
+                key = json.loads(match.group())
+            else:
+                key = key.decode('utf-8')
+            pos = skip(match.end())
+            if buf[pos:pos + 1] != b':':
+                raise self._error(pos)
+
+            start = skip(pos + 1)
+            end = self._skip_value(buf, start)
+            spans[key] = (start, end)
+
+            pos = skip(end)
+            token = buf[pos:pos + 1]
+            if token == b'}' and skip(pos + 1) == len(buf):
+                return spans
+            if token != b',':
+                raise self._error(pos)
+            pos = skip(pos + 1)
+
+    def _skip_value(self, buf, pos):
+        token = buf[pos:pos + 1]
+        if token == b'"':
+            match = _JSON_STRING.match(buf, pos)
+        elif token in (b'{', b'['):
+            depth = 0
+            while True:
+                token = buf[pos:pos + 1]
+                if token in (b'{', b'['):
+                    depth += 1
+                elif token in (b'}', b']'):
+                    depth -= 1
+                    if depth == 0:
+                        return pos + 1
+                else:
+                    raise self._error(pos)
+                pos = _JSON_NESTED_TEXT.match(buf, pos + 1).end()
+        else:
+            match = _JSON_SCALAR.match(buf, pos)
+        if match is None:
+            raise self._error(pos)
+        return match.end()
+
+
+class _Deferred(object):
+    """A placeholder for the value of a top-level key within a `_JsonIndex`
+    which is yet to be decoded.
+    """
+    __slots__ = ('index', 'key')
+
+    def __init__(self, index, key):
+        self.index, self.key = index, key
+
+    def resolve(self, lazy):
+        value = self.index.decode(self.key)
+        if lazy and type(value) is dict:
+            return LazyStorage(value)
+        return _make_storage(value)
+
+    def __repr__(self):
+        return '<deferred %r>' % self.key
+
+
+class _ConfigFileCache(object):
+    """A bounded cache of parsed configuration files keyed by absolute path
+    and validated against the file's modification time and size. Parsed
+    documents are shared by all callers and so must never be handed out
+    without being copied.
+    """
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+            self.hits = self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return _CacheInfo(self.hits, self.misses, self.maxsize,
+                              len(self._entries))
+
+    def load(self, filepath, snapshot=None, indexed=False, backend=None,
+             storage=False):
+        """Returns the parsed document of the file at 'filepath' or, if
+        'indexed' is True, a `_JsonIndex` of its top-level keys, decoded
+        with the JSON 'backend' or the one selected for the process. If
+        'storage' is True and 'snapshot' is set, a `_PickledStorage` is
+        returned instead of the parsed document.
+        """
+        path = os.path.abspath(filepath)
+        decoder = _json_decoder(backend)
+        storage = bool(storage and snapshot and not indexed)
+        key = (path, bool(indexed), decoder, storage)
+        started, stamp = time.time(), _stat_stamp(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == stamp:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+        if indexed:
+            document = _JsonIndex(path, decoder)
+        else:
+            document = _load_document(path, snapshot, decoder, storage)
+        with self._lock:
+            self.misses += 1
+            if _is_racy([stamp], started):
+                self._entries.pop(key, None)
+            else:
+                self._entries[key] = (stamp, document)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return document
+
+
+_config_cache = _ConfigFileCache()
+
+
+def _ensure_config_exists(filepath):
+    """Raises ConfigNotFound if there's no configuration file at 'filepath'."""
+    p = os.path
+    if not p.exists(filepath):
+        relpath = p.relpath(p.dirname(filepath), os.getcwd())
+        basename = p.basename(filepath)
+        msg = '%s was not found in %s'                
         
-        def register_defaults(cls, **defaults):
-            """Registers default configurations."""
-            cls._defaults.update(Storage.make(defaults))
+        if relpath == '.':
+            raise ConfigNotFound(msg % (basename, 'current directory'))
+        raise ConfigNotFound(msg % (basename, relpath))
+
+
+# guards creating the locks of each Config object
+_config_locks = threading.Lock()
+
+class _ComputingDefaults(threading.local):
+    """Holds the func defaults being computed by the current thread,
+    innermost last, each with its Config and the version of each key its
+    function has read.
+    """
+
+    def __init__(self):
+        self.frames = []
+
+
+_computing = _ComputingDefaults()
+
+
+# the ConfigStats collecting reads, if one was started
+_config_stats = None
 
-        def register_func_default(cls, key, function):
-            """Registers a default function for a given key."""
-            cls._func_defaults[key] = function
+# where a read Config setting was found, as counted by ConfigStats
+_READ_SOURCES = ('materialized', 'default', 'func_default', 'missing')
+
+
+def _overlay_holds(overlay, key, defaults):
+    """Returns whether 'key' is held by 'overlay' or by any of its layers,
+    nested overlays included, other than the registered 'defaults'.
+    """
+    if dict.__contains__(overlay, key):
+        return dict.__getitem__(overlay, key) is not _TOMBSTONE
+    for layer in overlay._layers:
+        if layer is defaults:
+            continue
+        if isinstance(layer, StorageOverlay):
+            if _overlay_holds(layer, key, defaults):
+                return True
+        elif key in layer:
+            return True
+    return False
+
+
+class ConfigStats(object):
+    """Counts how the settings of Config objects are read once started, for
+    deciding which to precompute: the reads of each key by Config type and
+    whether it was found among the settings held, registered defaults or
+    func defaults or was missing, the time taken by each func default to be
+    computed, including the func defaults it reads, and the attributes read
+    from nested Storage sections. Reads of missing keys, which return None,
+    are also warned about if 'warn_missing' is True. Until started, reads
+    are only slowed by checking whether it is.
+    """
+
+    def __init__(self, warn_missing=False):
+        self.warn_missing = warn_missing
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.reads = {}
+            self.func_defaults = {}
+            self.attributes = {}
+
+    def start(self):
+        """Starts counting reads, in place of any ConfigStats started before,
+        and returns this object.
+        """
+        global _config_stats
+        _config_stats = self
+        return self
+
+    def stop(self):
+        global _config_stats
+        if _config_stats is self:
+            _config_stats = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _read(self, config, key):
+        if isinstance(config, StorageOverlay):
+            held = _overlay_holds(config, key, config._defaults)
+        else:
+            held = key in config
+        if held:
+            source = 1
+        elif key in config._defaults:
+            source = 2
+        elif key in config._func_defaults:
+            source = 3
+        else:
+            source = 4
+        name = (type(config).__name__, key)
+        with self._lock:
+            counts = self.reads.get(name)
+            if counts is None:
+                counts = self.reads[name] = [0] * (len(_READ_SOURCES) + 1)
+            counts[0] += 1
+            counts[source] += 1
+        if source == 4 and self.warn_missing:
+            self._warn_missing(name)
+
+    def _attribute_read(self, storage, key):
+        if isinstance(storage, Config) or key.startswith('__'):
+            return      # counted by Config.__getitem__ or a special lookup
+        missing = not dict.__contains__(storage, key)
+        name = (type(storage).__name__, key)
+        with self._lock:
+            counts = self.attributes.setdefault(name, [0, 0])
+            counts[0] += 1
+            counts[1] += missing
+        if missing and self.warn_missing:
+            self._warn_missing(name)
+
+    def _func_default_computed(self, config, key, seconds):
+        name = (type(config).__name__, key)
+        with self._lock:
+            timings = self.func_defaults.setdefault(name, [0, 0.0, 0.0])
+            timings[0] += 1
+            timings[1] += seconds
+            timings[2] = max(timings[2], seconds)
+
+    def _warn_missing(self, name):
+        import warnings
+        # attributes the warning to the first caller outside this module
+        frame, stacklevel = sys._getframe(1), 2
+        while frame is not None and frame.f_globals is globals():
+            frame, stacklevel = frame.f_back, stacklevel + 1
+        warnings.warn('%s.%s is missing and read as None' % name,
+                      stacklevel=stacklevel)
+
+    def as_dict(self):
+        """Returns the counts as a dict which can be serialized to JSON:
+        `reads` and `attributes` most read first, `func_defaults` most time
+        taken first.
+        """
+        with self._lock:
+            reads = sorted(self.reads.items(), key=lambda i: -i[1][0])
+            timings = sorted(self.func_defaults.items(),
+                             key=lambda i: -i[1][1])
+            attributes = sorted(self.attributes.items(),
+                                key=lambda i: -i[1][0])
+            return dict(
+                reads=[dict(dict(zip(_READ_SOURCES, counts[1:])), type=t,
+                            key=k, reads=counts[0])
+                       for (t, k), counts in reads],
+                func_defaults=[dict(type=t, key=k, count=count,
+                                    seconds=total, max_seconds=longest)
+                               for (t, k), (count, total, longest) in timings],
+                attributes=[dict(type=t, key=k, reads=count, missing=missing)
+                            for (t, k), (count, missing) in attributes])
+
+    def export(self, filepath):
+        """Writes the counts returned by `as_dict` to 'filepath' as JSON."""
+        with open(filepath, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    def report(self, top=20):
+        """Returns a text report of the 'top' most read keys and attributes
+        and the func defaults taking the most time, followed by the missing
+        keys read.
+        """
+        stats = self.as_dict()
+        lines = ['config reads:', '  %-40s %8s %12s %12s %12s %12s' % (
+            ('key', 'reads') + _READ_SOURCES)]
+        for read in stats['reads'][:top]:
+            lines.append('  %-40s %8d %12d %12d %12d %12d' % (
+                ('%(type)s.%(key)s' % read, read['reads'])
+                + tuple(read[s] for s in _READ_SOURCES)))
+        lines.extend(['config func defaults:', '  %-40s %8s %10s %10s'
+                      % ('key', 'count', 'total ms', 'max ms')])
+        for timing in stats['func_defaults'][:top]:
+            lines.append('  %-40s %8d %10.3f %10.3f' % (
+                '%(type)s.%(key)s' % timing, timing['count'],
+                timing['seconds'] * 1e3, timing['max_seconds'] * 1e3))
+        lines.extend(['storage attributes:', '  %-40s %8s %8s'
+                      % ('key', 'reads', 'missing')])
+        for attribute in stats['attributes'][:top]:
+            lines.append('  %-40s %8d %8d' % (
+                '%(type)s.%(key)s' % attribute, attribute['reads'],
+                attribute['missing']))
+        missing = ['%(type)s.%(key)s' % read for read in stats['reads']
+                   if read['missing']]
+        missing += ['%(type)s.%(key)s' % attribute
+                    for attribute in stats['attributes']
+                    if attribute['missing']]
+        lines.append('missing keys read: %s' % (', '.join(missing) or 'none'))
+        return '\n'.join(lines)
+
+
+class _IndexedConfig(object):
+    """Mixed into the Config types setting `_indexed` so that the values of
+    their instances are read through `__getitem__`, which decodes those yet
+    to be, when they're copied by `dict()` or `{**config}`, compared or
+    printed, as they would be with eager loading.
+    """
+
+    def __iter__(self):
+        # overriding __iter__ takes dict() off its fast path which copies
+        # the stored values, placeholders included, as they are
+        return dict.__iter__(self)
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            other = dict(other)
+        return dict.__eq__(dict(self), other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def copy(self):
+        return dict(self)
+
+    def __repr__(self):
+        return '<Storage %s>' % dict.__repr__(dict(self))
+
+
+class _LazyConfig(object):
+    """Mixed into the Config types setting `_lazy` so that copies of their
+    instances made by `dict()`, `{**config}` or `copy()` read the values
+    through `__getitem__`, which wraps the nested dicts shared with the
+    cached file rather than handing them out.
+    """
+
+    def __iter__(self):
+        # overriding __iter__ takes dict() off its fast path
+        return super().__iter__()
+
+    def copy(self):
+        return dict(self)
+
+
+class _ConfigMeta(type):
+    """Meta class for creating Config object types."""
+
+    def __new__(cls, name, bases, attrs):
+        if attrs.get('_indexed') and not any(
+                issubclass(base, _IndexedConfig) for base in bases):
+            bases = (_IndexedConfig,) + bases
+        if attrs.get('_lazy') and not any(
+                issubclass(base, _LazyConfig) for base in bases):
+            bases = (_LazyConfig,) + bases
+        _cls = type.__new__(cls, name, bases, attrs)
+        _cls._func_defaults = Storage()
+        _cls._defaults = Storage()
+        return _cls
     
+    def register_defaults(cls, **defaults):
+        """Registers default configurations."""
+        cls._defaults.update(Storage.make(defaults))
+
+    def register_func_default(cls, key, function):
+        """Registers a default function for a given key."""
+        cls._func_defaults[key] = function
 
-    __metaclass__ = Meta
+    def cache_info(cls):
+        """Returns the hit and miss counts of the process-wide cache of
+        parsed configuration files shared by all Config types.
+        """
+        return _config_cache.info()
+
+    def cache_clear(cls):
+        """Clears the process-wide cache of parsed configuration files."""
+        _config_cache.clear()
+
+    def compile_schema(cls, fields, name=None):
+        """Compiles a schema, a dict of fields by name, into a `SchemaConfig`
+        class with a slot for each field. A field is given as a type, a `(type, default)` tuple, a dict
+        of fields for a nested section, a SchemaConfig class or a one item
+        list holding any of those for a list of them. Fields without a
+        default fall back to the defaults and func defaults registered for
+        this Config type and are otherwise required.
+        """
+        return _compile_schema(name or cls.__name__ + 'Schema', fields, cls)
+
+
+class Config(Storage, metaclass=_ConfigMeta):
+    """A dictionary which contains configuration settings.
+
+    Files are parsed once per process and then served from a cache until
+    they are modified; each Config still holds its own copy of the settings
+    so changes made through one instance aren't seen by others.
+
+    Setting `_lazy` to True, in the body of a Config type, defers converting
+    nested dicts of the loaded configuration into Storage objects until they
+    are first accessed. Setting `_snapshot` to True, or to a cache directory, keeps a
+    binary snapshot of each parsed file next to it, or in that directory,
+    which later processes load in place of parsing the file; unless `_lazy`
+    is set too, the snapshot holds the settings already converted into
+    Storage objects and each Config unpickles its own copy of them. Setting
+    `_indexed` to True, in the body of a Config type, memory-maps the file
+    and only indexes where the value of each top-level key lies, decoding a
+    value when it's first read, copied or compared; the file must then be
+    replaced rather than modified in place. Setting
+    `_json_backend` to a module name such as 'orjson', or to a decoding
+    function, overrides the JSON decoder selected by `set_json_backend`.
+    `Config.load` builds a Config from a file object, bytes or text instead.
+
+    A func default is computed when its key is first read and the top-level
+    keys read by its function are recorded; setting or deleting any of them
+    discards the computed value, and those derived from it, so it's computed
+    again when next read. Setting `_eager` to True on a Config type computes
+    every func default, those depended upon first, once the file is loaded.
+    A func default is computed once however many threads read it at the
+    same time, and it's only kept if none of the keys it read were set
+    meanwhile; computed values are read without taking a lock.
+    """
+
+    Meta = _ConfigMeta
+    _lazy = False
+    _snapshot = None
+    _indexed = False
+    _eager = False
+    _json_backend = None
+
+    # keys read by each computed func default, the number of times each key
+    # was set or deleted and the locks guarding them, set per instance
+    _derived = None
+    _versions = None
+    _locks = None
     
     def __init__(self, filepath=None, **config):
-        p = os.path
-        config.update(meta=Storage(name=None, path=None))
+        document = None
         if filepath:            
-            if not p.exists(filepath):
-                relpath = p.relpath(p.dirname(filepath), os.getcwd())
-                basename = p.basename(filepath)
-                msg = '%s was not found in %s'                
-                
-                if relpath == '.':
-                    raise ConfigNotFound(msg % (basename, 'current directory'))
-                raise ConfigNotFound(msg % (basename, relpath))
-
-            with open(filepath) as f:
-                _config = Storage(json.load(f)) or Storage()
-
-            _config.update(config)
-            _config.meta = Storage(
-                name = p.basename(filepath),
-                path = p.dirname(filepath),
-            )
+            _ensure_config_exists(filepath)
+            document = _config_cache.load(filepath, self._snapshot,
+                                          self._indexed, self._json_backend,
+                                          not self._lazy)
+        self._build(filepath, document, config)
+
+    @classmethod
+    def load(cls, source, **config):
+        """Returns a Config of this type holding the JSON document read from
+        'source', a file object or the document as bytes or text, overridden
+        by the settings within 'config'. The document is decoded straight
+        into Storage objects and isn't cached; meta holds the name of the
+        file object if it has one.
+        """
+        document = _load_storage(source, cls._json_backend)
+        if not isinstance(document, dict):
+            raise ValueError('Expected a JSON object, got %s'
+                             % type(document).__name__)
+        name = getattr(source, 'name', None)
+        conf = cls.__new__(cls)
+        conf._build(name if isinstance(name, str) else None, document,
+                    config, copy=False)
+        return conf
+
+    def _build(self, filepath, document, config, copy=True, compute=True):
+        """Initializes this Config from 'document', the parsed content of the
+        file at 'filepath', overridden by the settings within 'config'. If
+        'copy' is False, 'document' is already made of Storage objects owned
+        by this Config and is used as it is. If 'compute' is False, the func
+        defaults of an `_eager` Config type are left for the caller to
+        compute.
+        """
+        if type(document) is _PickledStorage:
+            document, copy = document.load(), False
+        p = os.path
+        meta = Storage(name=None, path=None)
+        if filepath:
+            meta = Storage(name=p.basename(filepath), path=p.dirname(filepath))
+        if document is not None:
+            if isinstance(document, _JsonIndex):
+                document = document.placeholders()
+            _config = Storage(document) or Storage()
+            _config.update(config if copy else _make_storage(config))
             config = _config
+        config['meta'] = meta
 
-        Storage.__init__(self, Storage.make(config))
+        Storage.__init__(self, Storage.make(config, self._lazy)
+                               if copy else config)
+        if self._eager and compute:
+            self._compute_defaults()
 
     def __getitem__(self, key):
-        if key not in self:
+        if _config_stats is not None:
+            _config_stats._read(self, key)
+        frames = _computing.frames
+        if frames:
+            self._record_read(frames[-1], key)
+        if not dict.__contains__(self, key):
             if key in self._defaults:
-                self[key] = self._defaults[key]
+                dict.setdefault(self, key, self._defaults[key])
             elif key in self._func_defaults:
-                self[key] = self._func_defaults[key](self, key)
-        return dict.get(self, key, None)
+                value = self._compute_default(key)
+                if not dict.__contains__(self, key):
+                    return value    # a key it read was set meanwhile
+        value = dict.get(self, key, None)
+        if type(value) is _Deferred:
+            value = value.resolve(self._lazy)
+            dict.__setitem__(self, key, value)
+        elif self._lazy:
+            value = _wrap_lazy(self, key, value)
+        return value
+
+    def __contains__(self, key):
+        frames = _computing.frames
+        if frames:
+            self._record_read(frames[-1], key)
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        # a func default testing for the key depends on it all the same
+        return self[key] if key in self else default
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def pop(self, key, *default):
+        with self._lock():
+            if key not in self:
+                if default:
+                    return default[0]
+                raise KeyError(key)
+            value = self[key]
+            del self[key]
+            return value
+
+    def popitem(self):
+        with self._lock():
+            keys = list(self)
+            if not keys:
+                raise KeyError('popitem(): dictionary is empty')
+            return keys[-1], self.pop(keys[-1])
+
+    def setdefault(self, key, default=None):
+        with self._lock():
+            if key in self:
+                return self[key]
+            self[key] = default
+            return default
+
+    def clear(self):
+        with self._lock():
+            for key in list(self):
+                del self[key]
     
+    def __setitem__(self, key, value):
+        if not self._func_defaults:
+            return dict.__setitem__(self, key, value)
+        with self._lock():
+            dict.__setitem__(self, key, value)
+            self._invalidate(key)
+
     def __delitem__(self, key):
         if key not in self:
             return # fail silently
-        return dict.__delitem__(self, key)
+        if not self._func_defaults:
+            return dict.__delitem__(self, key)
+        with self._lock():
+            dict.pop(self, key, None)
+            self._invalidate(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
 
+    def _lock(self, key=None):
+        """Returns the lock guarding the computation of the func default of
+        'key' or, if no key is given, the keys computed and their versions.
+        """
+        locks = self._locks
+        if locks is None or key not in locks:
+            with _config_locks:
+                locks = self.__dict__.setdefault('_locks', {})
+                return locks.setdefault(key, threading.RLock())
+        return locks[key]
+
+    def _record_read(self, frame, key):
+        config, _, reads = frame
+        if config is self and key not in reads:
+            reads[key] = (self._versions or {}).get(key, 0)
+
+    def _compute_default(self, key):
+        """Computes the func default of 'key' unless another thread has just
+        done so and keeps it, along with the keys its function read, if
+        neither 'key' nor any of those were set while it was computed; a
+        value set for 'key' meanwhile is returned instead.
+        """
+        with self._lock(key):
+            if dict.__contains__(self, key):
+                return dict.get(self, key)
+
+            frames = _computing.frames
+            keys = [k for config, k, _ in frames if config is self]
+            if key in keys:
+                raise DolfinError('Func defaults depend on each other: %s'
+                                  % ' -> '.join(keys[keys.index(key):] + [key]))
+
+            version = (self._versions or {}).get(key, 0)
+            frames.append((self, key, {}))
+            stats = _config_stats
+            started = time.perf_counter()
+            try:
+                value = self._func_defaults[key](self, key)
+            finally:
+                reads = frames.pop()[2]
+                if stats is not None:
+                    stats._func_default_computed(
+                        self, key, time.perf_counter() - started)
+            reads.pop(key, None)
+
+            with self._lock():
+                versions = self._versions or {}
+                if dict.__contains__(self, key):
+                    return dict.get(self, key)  # set while it was computed
+                if versions.get(key, 0) == version and all(
+                        versions.get(k, 0) == v for k, v in reads.items()):
+                    dict.__setitem__(self, key, value)
+                    derived = self.__dict__.setdefault('_derived', {})
+                    derived[key] = frozenset(reads)
+            return value
+
+    def __reduce__(self):
+        # registered defaults are kept as settings as they may only have
+        # been registered at runtime in this process
+        settings = dict((key, self[key]) for key in self._defaults)
+        settings.update(self.items())
+        return (_restore_config, (type(self), settings))
+
+    def freeze(self):
+        """Returns a FrozenStorage snapshot of the settings, including the
+        registered defaults and func defaults, which are materialized first.
+        """
+        for key in self._defaults:
+            self[key]
+        self._compute_defaults()
+        return _freeze(dict(self.items()))
+
+    def publish(self, path=None):
+        """Publishes a read-only snapshot of the settings, taken as by
+        `freeze`, into a shared-memory segment, or a memory-mapped file at
+        'path' if given, and returns the `SharedConfigSegment`. Processes
+        attach to it by name with `SharedConfig.attach` or by unpickling
+        its Config, reading the settings in place without copying them.
+        """
+        config_type = type(self)
+        if issubclass(config_type, SharedConfig):
+            config_type = _import_type(self._segment.type_name)
+        data = _encode_shared(self.freeze(), config_type)
+        return SharedConfigSegment.create(data, path)._register()
+
+    def _compute_defaults(self):
+        """Computes every func default not yet computed or set; those another
+        depends upon are computed first as they're read by its function.
+        """
+        for key in self._func_defaults:
+            self[key]
+
+    def _invalidate(self, key):
+        """Discards the computed func defaults which depend on 'key', which
+        itself is no longer taken as computed, directly or through others.
+        Called with the lock of this Config held.
+        """
+        versions = self.__dict__.setdefault('_versions', {})
+        derived = self.__dict__.setdefault('_derived', {})
+        derived.pop(key, None)
+        pending = [key]
+        while pending:
+            changed = pending.pop()
+            versions[changed] = versions.get(changed, 0) + 1
+            for k, depends in list(derived.items()):
+                if changed in depends:
+                    del derived[k]
+                    dict.pop(self, k, None)
+                    pending.append(k)
+
+
+def _restore_config(config_type, settings):
+    config = config_type.__new__(config_type)
+    dict.__init__(config, settings)
+    return config
+
+
+# marks a schema field without a default
+_REQUIRED = object()
+
+
+class SchemaConfig(object):
+    """Base of the classes compiled by `Config.Meta.compile_schema`, which
+    hold each setting in a slot rather than a dict. Settings are validated
+    against the schema once, when loaded, and then read as plain attributes.
+    Nested sections are SchemaConfig objects as well; `to_storage` converts
+    one back into Storage objects, sharing the values of dict fields.
+    """
+
+    __slots__ = ()
+    _fields = ()
+    _config_type = None
+
+    def __init__(self, filepath=None, **config):
+        document = {}
+        if filepath:
+            _ensure_config_exists(filepath)
+            snapshot = self._config_type._snapshot if self._config_type \
+                       else None
+            backend = self._config_type._json_backend \
+                      if self._config_type else None
+            document = _config_cache.load(filepath, snapshot, False, backend)
+        if config:
+            document = dict(document, **config)
+        self._load(document, '')
+
+    @classmethod
+    def from_mapping(cls, mapping, path=''):
+        """Returns an object of this class holding the settings of 'mapping',
+        whose errors are reported under the dotted 'path' if given.
+        """
+        obj = cls.__new__(cls)
+        obj._load(mapping, path + '.' if path else '')
+        return obj
+
+    def _load(self, mapping, prefix):
+        if not isinstance(mapping, dict):
+            raise ConfigError('%s: expected a mapping, got %s'
+                              % (prefix.rstrip('.') or '<root>',
+                                 type(mapping).__name__))
+        unknown = set(mapping).difference(self.__slots__)
+        if unknown:
+            raise ConfigError('%sunknown settings: %s'
+                              % (prefix, ', '.join(sorted(unknown))))
+
+        config_type = self._config_type
+        defaults = config_type._defaults if config_type else {}
+        func_defaults = config_type._func_defaults if config_type else {}
+        computed, loaded = [], []
+        for name, spec, default in self._fields:
+            if name in mapping:
+                value = mapping[name]
+            elif default is not _REQUIRED:
+                value = default
+            elif name in defaults:
+                value = defaults[name]
+            elif name in func_defaults:
+                computed.append((name, spec, default))
+                continue
+            else:
+                raise ConfigError('%s%s: missing required setting'
+                                  % (prefix, name))
+            loaded.append(name)
+            if value is None and default is None:
+                object.__setattr__(self, name, None)
+            else:
+                object.__setattr__(self, name,
+                                   _check_field(spec, value, prefix + name))
+
+        if not computed:
+            return
+        # computed by a Config of the type they're registered with, holding
+        # the settings loaded, so that they read it as they were written to
+        # and each computes those it reads first
+        config = _restore_config(config_type, dict(
+            (name, _field_storage(getattr(self, name))) for name in loaded))
+        for name, spec, default in computed:
+            object.__setattr__(self, name,
+                               _check_field(spec, config[name], prefix + name))
+
+    def to_storage(self):
+        """Returns the settings held by this object as a Storage object."""
+        return Storage((name, _field_storage(getattr(self, name)))
+                       for name in self.__slots__)
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name)
+                   for name in self.__slots__)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, ', '.join(
+            '%s=%r' % (name, getattr(self, name)) for name in self.__slots__))
+
+
+def _compile_schema(name, fields, config_type):
+    """Returns a SchemaConfig class named 'name' with a slot for each of the
+    'fields'; nested sections are compiled into classes of their own.
+    """
+    reserved = set(dir(SchemaConfig))
+    specs = []
+    for key, field in fields.items():
+        if not _IDENTIFIER.match(key) or key in reserved:
+            raise ValueError('Invalid schema field name: %r' % key)
+        spec, default = field if type(field) is tuple else (field, _REQUIRED)
+        specs.append((key, _schema_spec(spec, '%s_%s' % (name, key)),
+                      default))
+    return type(name, (SchemaConfig,), dict(
+        __slots__=tuple(fields), _fields=tuple(specs),
+        _config_type=config_type))
+
+
+_IDENTIFIER = re.compile(r'[A-Za-z][A-Za-z0-9_]*$')
+
+
+def _schema_spec(spec, name):
+    if isinstance(spec, dict):
+        return _compile_schema(name, spec, None)
+    if isinstance(spec, list) and len(spec) == 1:
+        return [_schema_spec(spec[0], name)]
+    if isinstance(spec, type):
+        return spec
+    raise ValueError('Invalid schema for %s: %r' % (name, spec))
+
+
+def _check_field(spec, value, path):
+    """Returns 'value' validated against the field 'spec', converted into a
+    SchemaConfig object for a nested section and copied if it's mutable.
+    """
+    if type(spec) is list:
+        if not isinstance(value, (list, tuple)):
+            raise ConfigError('%s: expected a list, got %s'
+                              % (path, type(value).__name__))
+        return [_check_field(spec[0], item, '%s[%d]' % (path, i))
+                for i, item in enumerate(value)]
+    if issubclass(spec, SchemaConfig):
+        if isinstance(value, spec):
+            return value
+        return spec.from_mapping(value, path)
+    if spec is float and type(value) in (int, float):
+        return float(value)
+    if not isinstance(value, spec) or (type(value) is bool and spec is int):
+        raise ConfigError('%s: expected %s, got %s'
+                          % (path, spec.__name__, type(value).__name__))
+    if isinstance(value, (dict, list)):
+        return _make_storage(value)
+    return value
+
+
+def _field_storage(value):
+    if isinstance(value, SchemaConfig):
+        return value.to_storage()
+    if type(value) is list:
+        return [_field_storage(item) for item in value]
+    return value
+
+
+# marks a key deleted from a StorageOverlay while present in its layers
+_TOMBSTONE = object()
+
+
+class StorageOverlay(Storage):
+    """A Storage object layered over mappings, given bottom layer first,
+    without copying them. A read resolves from the topmost layer holding the
+    key and dicts found under the same key in several layers are merged into
+    a nested StorageOverlay. Writes and deletions are kept by the overlay
+    itself so the layers are never modified; lists read from the layers are
+    copied on first read for the same reason. A nested StorageOverlay is
+    reused while the layers still hold the same dicts under its key, and
+    otherwise replaced by one over the new dicts, keeping what was written
+    to it, so only writes shadow the layers. As the settings of the layers
+    aren't held by the dict itself, it's serialized with
+    `json.dumps(overlay.to_dict())`.
+    """
+
+    _layers = ()
+    # the nested overlays read, with the dicts they were merged from
+    _views = None
+
+    def __init__(self, *layers, **settings):
+        dict.__init__(self, settings)
+        # an empty layer is dropped, without sizing up an overlay to tell
+        object.__setattr__(self, '_layers', tuple(
+            layer for layer in reversed(layers)
+            if isinstance(layer, StorageOverlay) or layer))
+
+    def __getitem__(self, key):
+        if dict.__contains__(self, key):
+            value = dict.__getitem__(self, key)
+            return None if value is _TOMBSTONE else value
+
+        found = []
+        for layer in self._layers:
+            if key not in layer:
+                continue
+            value = layer[key]
+            if isinstance(value, dict):
+                found.append(value)
+                continue
+            if found:
+                break   # shadows the dicts in the layers beneath
+            if type(value) in (list, tuple):
+                value = _make_storage(value)
+                dict.__setitem__(self, key, value)
+            return value
+
+        if not found:
+            return None
+        views = self._views
+        if views is None:
+            views = self.__dict__.setdefault('_views', {})
+        merged, view = views.get(key, ((), None))
+        if len(merged) == len(found) and all(
+                a is b for a, b in zip(merged, found)):
+            return view
+        # empty dicts are kept as layers as they may be filled later
+        new_view = StorageOverlay.__new__(StorageOverlay)
+        object.__setattr__(new_view, '_layers', tuple(found))
+        if view is not None:
+            dict.update(new_view, dict.items(view))
+        views[key] = (tuple(found), new_view)
+        return new_view
+
+    def __delitem__(self, key):
+        if key in self:
+            dict.__setitem__(self, key, _TOMBSTONE)
+
+    def __contains__(self, key):
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key) is not _TOMBSTONE
+        return any(key in layer for layer in self._layers)
+
+    def __iter__(self):
+        seen = set()
+        for layer in reversed(self._layers):
+            for key in layer:
+                if key not in seen:
+                    seen.add(key)
+                    if key in self:
+                        yield key
+        for key in dict.keys(self):
+            if key not in seen and dict.__getitem__(self, key) is not _TOMBSTONE:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    __hash__ = None
+
+    def keys(self):
+        return list(self)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def __getstate__(self):
+        return dict(self.items())
+
+    def __setstate__(self, value):
+        dict.__init__(self, value)
+        object.__setattr__(self, '_layers', ())
+
+    def __repr__(self):
+        return '<StorageOverlay %s>' % dict.__repr__(dict(self.items()))
+
+
+def _environ_settings(prefix, environ=None):
+    """Returns the settings given by the environment variables whose names
+    start with 'prefix'; a double underscore in the rest of the name nests
+    the setting, so APP_DB__HOST gives db.host for the prefix APP_. Values
+    are decoded as JSON where possible and kept as strings otherwise.
+    """
+    settings = {}
+    environ = os.environ if environ is None else environ
+    for name, value in environ.items():
+        if not name.startswith(prefix) or name == prefix:
+            continue
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+
+        path = name[len(prefix):].lower().split('__')
+        target = settings
+        for key in path[:-1]:
+            if not isinstance(target.get(key), dict):
+                target[key] = {}
+            target = target[key]
+        target[path[-1]] = value
+    return settings
+
+
+class OverlayConfig(StorageOverlay, Config):
+    """A Config which layers its settings instead of copying them into
+    itself: registered defaults, then the parsed file as cached for the
+    process, then environment variables named with the `_env_prefix` of the
+    Config type if set, then the constructor settings. Settings assigned to
+    it are kept in its own top layer, and `overlay()` cheaply derives a new
+    Config with more settings, such as those of a request, on top of it.
+    """
+
+    _env_prefix = None
+
+    def __init__(self, filepath=None, **config):
+        document = None
+        if filepath:
+            _ensure_config_exists(filepath)
+            document = _config_cache.load(filepath, self._snapshot, False,
+                                          self._json_backend)
+        self._build(filepath, document, config)
+
+    def _build(self, filepath, document, config, copy=True, compute=True):
+        p = os.path
+        layers = [self._defaults]
+        meta = Storage(name=None, path=None)
+        if filepath:
+            meta = Storage(name=p.basename(filepath), path=p.dirname(filepath))
+        if type(document) is _PickledStorage:
+            document = document.load()
+        if document is not None:
+            layers.append(document)
+        if self._env_prefix:
+            layers.append(_environ_settings(self._env_prefix))
+        layers.extend([config, dict(meta=meta)])
+        StorageOverlay.__init__(self, *layers)
+        if self._eager and compute:
+            self._compute_defaults()
+
+    def overlay(self, **settings):
+        """Returns a new Config of the same type with 'settings' layered on
+        top of this one, which it neither copies nor modifies.
+        """
+        config = type(self).__new__(type(self))
+        StorageOverlay.__init__(config, self, settings)
+        return config
+
+    def __getitem__(self, key):
+        if _config_stats is not None:
+            _config_stats._read(self, key)
+        frames = _computing.frames
+        if frames:
+            self._record_read(frames[-1], key)
+        if (key in self._func_defaults and not dict.__contains__(self, key)
+                and (key not in self or self._derived_beneath(key))):
+            value = self._compute_default(key)
+            if not dict.__contains__(self, key):
+                return value    # a key it read was set meanwhile
+        return StorageOverlay.__getitem__(self, key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            return # fail silently
+        with self._lock():
+            StorageOverlay.__delitem__(self, key)
+            self._invalidate(key)
+
+    def __contains__(self, key):
+        frames = _computing.frames
+        if frames:
+            self._record_read(frames[-1], key)
+        return StorageOverlay.__contains__(self, key)
+
+    def _is_derived(self, key):
+        if dict.__contains__(self, key):
+            return bool(self._derived) and key in self._derived
+        return self._derived_beneath(key)
+
+    def _derived_beneath(self, key):
+        """Tells whether the value of 'key' in the layers is a func default
+        computed by a Config beneath this one, which then computes its own
+        as the keys it depends upon may differ here.
+        """
+        for layer in self._layers:
+            if key in layer:
+                return (isinstance(layer, OverlayConfig)
+                        and layer._is_derived(key))
+        return False
+
+    def __repr__(self):
+        return '<OverlayConfig %s>' % dict.__repr__(dict(self.items()))
+
+
+# inotify constants from <sys/inotify.h>
+_IN_MODIFY, _IN_ATTRIB, _IN_CLOSE_WRITE = 0x002, 0x004, 0x008
+_IN_MOVED_TO, _IN_CREATE, _IN_DELETE = 0x080, 0x100, 0x200
+_IN_CLOEXEC, _IN_NONBLOCK = 0o2000000, 0o4000
+
+
+def _inotify_watch(dirpath):
+    """Returns an inotify file descriptor watching 'dirpath' for changes to
+    the files within it or None if inotify isn't available.
+    """
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(_IN_CLOEXEC | _IN_NONBLOCK)
+    except (AttributeError, EnvironmentError):
+        return None
+    if fd < 0:
+        return None
+
+    mask = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_TO |
+            _IN_CREATE | _IN_DELETE)
+    if libc.inotify_add_watch(fd, os.fsencode(dirpath), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class _FileWatcher(threading.Thread):
+    """A daemon thread which calls 'callback' whenever the file at 'filepath'
+    may have changed. Watching the containing directory with inotify also
+    catches editors which replace the file; where inotify isn't available
+    the file is checked every 'interval' seconds instead.
+    """
+
+    def __init__(self, filepath, callback, interval):
+        threading.Thread.__init__(self, name='dolfin-config-watcher')
+        self.daemon = True
+        self.filepath = os.path.abspath(filepath)
+        self.callback = callback
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        fd = _inotify_watch(os.path.dirname(self.filepath))
+        if fd is None:
+            while not self._stopped.wait(self.interval):
+                self.callback()
+            return
+
+        import select, struct
+        name = os.fsencode(os.path.basename(self.filepath))
+        header = struct.Struct('iIII')
+        try:
+            while not self._stopped.is_set():
+                ready, _, _ = select.select([fd], [], [], self.interval)
+                if not ready:
+                    continue
+
+                data, names = os.read(fd, 64 * 1024), set()
+                offset = 0
+                while offset < len(data):
+                    _, _, _, length = header.unpack_from(data, offset)
+                    offset += header.size
+                    names.add(data[offset:offset + length].rstrip(b'\0'))
+                    offset += length
+                if name in names:
+                    self.callback()
+        finally:
+            os.close(fd)
+
+
+def _changed_keys(old, new, prefix=''):
+    """Returns the dotted paths of the keys whose values differ between the
+    'old' and 'new' dicts, descending into values which are dicts in both.
+    """
+    changed = set()
+    for key in set(old) | set(new):
+        a, b = old.get(key), new.get(key)
+        if isinstance(a, dict) and isinstance(b, dict):
+            changed |= _changed_keys(a, b, prefix + key + '.')
+        elif key not in old or key not in new or a != b:
+            changed.add(prefix + key)
+    return changed
+
+
+class ReloadableConfig(object):
+    """A handle to a Config which is reloaded whenever its source file
+    changes. Each reload builds a complete new Config which is then swapped
+    in with a single assignment, so readers always see either the old or the
+    new settings and never a partially built tree; subscribers are notified
+    with the dotted paths of the settings which changed.
+
+    Values already computed by func defaults are carried over to the new
+    Config rather than computed again. Settings are read through `config`
+    or directly from the handle.
+    """
+
+    def __init__(self, filepath, config_type=Config, interval=1.0, **config):
+        self.filepath = os.path.abspath(filepath)
+        self.config_type = config_type
+        self.interval = interval
+        self._overrides = config
+        self._subscribers = []
+        self._watcher = None
+        self._lock = threading.Lock()
+
+        _ensure_config_exists(self.filepath)
+        self._stamp = _stat_stamp(self.filepath)
+        self._document = self._load()
+        self._config = self._build(self._document)
+
+    @property
+    def config(self):
+        """The current Config."""
+        return self._config
+
+    def __getitem__(self, key):
+        return self._config[key]
+
+    def __getattr__(self, key):
+        if key.startswith('_'):
+            raise AttributeError(key)
+        return self._config[key]
+
+    def subscribe(self, callback):
+        """Registers 'callback' to be called as `callback(config, changed)`
+        after every reload which changes any setting.
+        """
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def reload(self):
+        """Reloads the settings if the source file has changed and returns
+        the set of dotted paths of the settings which changed. The current
+        settings are kept if the file can't be read or parsed.
+        """
+        with self._lock:
+            stamp = _stat_stamp(self.filepath)
+            if stamp is None or stamp == self._stamp:
+                return set()
+
+            try:
+                document = self._load()
+            except (EnvironmentError, ValueError):
+                return set()    # possibly caught mid-write; retry later
+
+            self._stamp = stamp
+            changed = _changed_keys(self._document, document)
+            if not changed:
+                return changed
+
+            # func defaults still valid are carried over before those of an
+            # _eager type are computed, so they aren't computed again
+            old, new = self._config, self._build(document, compute=False)
+            changed_keys = set(path.split('.', 1)[0] for path in changed)
+            for key, depends in list((old._derived or {}).items()):
+                if key not in new and not depends & changed_keys:
+                    dict.__setitem__(new, key, dict.__getitem__(old, key))
+                    new.__dict__.setdefault('_derived', {})[key] = depends
+            if new._eager:
+                new._compute_defaults()
+
+            self._config, self._document = new, document
+            subscribers = list(self._subscribers)
+
+        for callback in subscribers:
+            try:
+                callback(new, changed)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+        return changed
+
+    def _load(self):
+        config_type = self.config_type
+        return _config_cache.load(self.filepath, config_type._snapshot, False,
+                                  config_type._json_backend)
+
+    def _build(self, document, compute=True):
+        config = self.config_type.__new__(self.config_type)
+        config._build(self.filepath, document, dict(self._overrides),
+                      compute=compute)
+        return config
+
+    def start(self):
+        """Starts watching the source file for changes in the background."""
+        if self._watcher is None:
+            self._watcher = _FileWatcher(self.filepath, self.reload,
+                                         self.interval)
+            self._watcher.start()
+        return self
+
+    def stop(self):
+        """Stops watching the source file for changes."""
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher.join()
+            self._watcher = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+# identifies the layout of shared config segments; bump when it changes
+_SHARED_MAGIC = b'DOLFSHM1'
+
+# segments attached by this process by name
+_shared_segments = {}
+_shared_segments_lock = threading.Lock()
+
+
+def _encode_shared(value, config_type):
+    """Encodes 'value', a FrozenStorage, into the layout of a shared config
+    segment which is read in place: the magic, the offsets of the root node
+    and of the name of 'config_type', then the nodes. Each node is a tag
+    followed by its data; a dict holds the offsets of its keys and values
+    in order followed by a hash table of their positions, indexed by the
+    crc32 of the key, and a tuple the offsets of its items. Nodes referenced
+    more than once are written once.
+    """
+    import marshal
+    data = bytearray(_SHARED_MAGIC + b'\0' * 16)
+    memo = {}
+
+    def write(node):
+        offset = len(data)
+        data.extend(node)
+        return offset
+
+    def write_scalar(item):
+        if item is None:
+            return write(b'N')
+        if isinstance(item, bool):
+            return write(b'B' + struct.pack('<?', item))
+        if isinstance(item, str):
+            encoded = item.encode('utf-8')
+            return write(b'S' + struct.pack('<I', len(encoded)) + encoded)
+        if isinstance(item, int) and -2 ** 63 <= item < 2 ** 63:
+            return write(b'I' + struct.pack('<q', item))
+        if isinstance(item, float):
+            return write(b'F' + struct.pack('<d', item))
+        try:
+            encoded = marshal.dumps(item)
+        except ValueError:
+            raise ValueError('Cannot share values of type %s'
+                             % type(item).__name__)
+        return write(b'M' + struct.pack('<I', len(encoded)) + encoded)
+
+    pending = [(value, None)]
+    while pending:
+        item, items = pending.pop()
+        if id(item) in memo:
+            continue
+        if not isinstance(item, (dict, tuple)):
+            memo[id(item)] = write_scalar(item)
+            continue
+        if items is None:
+            if isinstance(item, dict):
+                for key in item:
+                    if not isinstance(key, str):
+                        raise ValueError('Cannot share non-string key: %r'
+                                         % (key,))
+                items = list(_storage_items(item))
+            else:
+                items = list(item)
+            pending.append((item, items))
+            children = [v for _, v in items] if isinstance(item, dict) \
+                       else items
+            pending.extend((child, None) for child in children
+                           if id(child) not in memo)
+            continue
+
+        if isinstance(item, dict):
+            entries = [(write_scalar(key), memo[id(child)])
+                       for key, child in items]
+            size = 1
+            while size < len(items) * 2:
+                size *= 2
+            slots = [0] * size
+            for position, (key, _) in enumerate(items):
+                slot = zlib.crc32(key.encode('utf-8')) & (size - 1)
+                while slots[slot]:
+                    slot = (slot + 1) & (size - 1)
+                slots[slot] = position + 1
+            memo[id(item)] = write(
+                b'D' + struct.pack('<II', len(entries), size) + b''.join(
+                    struct.pack('<QQ', *entry) for entry in entries)
+                + struct.pack('<%dI' % size, *slots))
+        else:
+            memo[id(item)] = write(
+                b'L' + struct.pack('<I', len(items)) + b''.join(
+                    struct.pack('<Q', memo[id(child)]) for child in items))
+
+    type_name = '%s:%s' % (config_type.__module__, config_type.__qualname__)
+    struct.pack_into('<QQ', data, len(_SHARED_MAGIC), memo[id(value)],
+                     write_scalar(type_name))
+    return bytes(data)
+
+
+class SharedConfigSegment(object):
+    """A shared-memory segment, or memory-mapped file, holding a Config
+    published by `Config.publish` which other processes attach to by name
+    with `SharedConfig.attach`; `config` reads it in place. The process
+    which published it should `unlink` it once the workers are done.
+    """
+
+    def __init__(self, name, buffer, handle):
+        self.name, self.buffer, self._handle = name, buffer, handle
+        magic = bytes(buffer[:len(_SHARED_MAGIC)])
+        if magic != _SHARED_MAGIC:
+            raise ValueError('Not a shared config segment: %s' % name)
+        self.root, type_offset = struct.unpack_from(
+            '<QQ', buffer, len(_SHARED_MAGIC))
+        self.type_name = _shared_value(self, type_offset)
+        self._config = None
+
+    @classmethod
+    def create(cls, data, path=None):
+        """Creates a segment holding 'data', a memory-mapped file at 'path'
+        if given or a shared-memory segment otherwise.
+        """
+        if path is not None:
+            import tempfile
+            fd, temp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(path)))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+            return cls.open(path)
+
+        from multiprocessing import shared_memory
+        memory = shared_memory.SharedMemory(create=True, size=len(data))
+        memory.buf[:len(data)] = data
+        return cls(memory.name, memory.buf, memory)
+
+    @classmethod
+    def open(cls, name):
+        """Opens the segment called 'name', a file path or the name of a
+        shared-memory segment.
+        """
+        if os.sep in name or (os.altsep and os.altsep in name):
+            import mmap
+            with open(name, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return cls(name, mapped, mapped)
+
+        from multiprocessing import resource_tracker, shared_memory
+        try:
+            memory = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # before Python 3.13 attaching registers the segment with the
+            # resource tracker, which unlinks it when its processes exit; a
+            # tracker started just now serves an unrelated process only
+            tracker = getattr(resource_tracker, '_resource_tracker', None)
+            untracked = getattr(tracker, '_fd', None) is None
+            memory = shared_memory.SharedMemory(name)
+            if untracked:
+                resource_tracker.unregister(memory._name, 'shared_memory')
+        return cls(name, memory.buf, memory)
+
+    def _register(self):
+        with _shared_segments_lock:
+            _shared_segments.setdefault(self.name, self)
+        return self
+
+    @property
+    def config(self):
+        """The Config held by this segment, of the type it was published
+        from if that type can be imported here.
+        """
+        if self._config is None:
+            config_type = _shared_type(_import_type(self.type_name))
+            config = config_type.__new__(config_type)
+            object.__setattr__(config, '_segment', self)
+            object.__setattr__(config, '_offset', self.root)
+            self._config = config
+        return self._config
+
+    def close(self):
+        """Detaches this process from the segment; settings read from it
+        must no longer be used.
+        """
+        with _shared_segments_lock:
+            if _shared_segments.get(self.name) is self:
+                del _shared_segments[self.name]
+        self._config = self.buffer = None
+        self._handle.close()
+
+    def unlink(self):
+        """Closes the segment and removes it once every process detaches."""
+        handle = self._handle
+        self.close()
+        if hasattr(handle, 'unlink'):
+            handle.unlink()
+        else:
+            os.remove(self.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.unlink()
+
+
+def _attach_segment(name):
+    with _shared_segments_lock:
+        segment = _shared_segments.get(name)
+        if segment is None:
+            segment = _shared_segments[name] = SharedConfigSegment.open(name)
+        return segment
+
+
+def _import_type(type_name):
+    """Returns the Config type named 'module:qualname' or Config itself if
+    it can't be imported.
+    """
+    module_name, _, qualname = type_name.partition(':')
+    try:
+        __import__(module_name)
+        config_type = sys.modules[module_name]
+        for name in qualname.split('.'):
+            config_type = getattr(config_type, name)
+    except (ImportError, AttributeError):
+        return Config
+    return config_type if isinstance(config_type, _ConfigMeta) else Config
+
+
+def _shared_value(segment, offset):
+    """Decodes the node at 'offset' of 'segment'; dicts are returned as
+    SharedStorage objects reading the segment in place.
+    """
+    buffer = segment.buffer
+    tag = buffer[offset]
+    if tag == 0x44:     # D
+        storage = SharedStorage.__new__(SharedStorage)
+        object.__setattr__(storage, '_segment', segment)
+        object.__setattr__(storage, '_offset', offset)
+        return storage
+    if tag == 0x53:     # S
+        size, = struct.unpack_from('<I', buffer, offset + 1)
+        return str(buffer[offset + 5:offset + 5 + size], 'utf-8')
+    if tag == 0x49:     # I
+        return struct.unpack_from('<q', buffer, offset + 1)[0]
+    if tag == 0x46:     # F
+        return struct.unpack_from('<d', buffer, offset + 1)[0]
+    if tag == 0x4c:     # L
+        size, = struct.unpack_from('<I', buffer, offset + 1)
+        return tuple(_shared_value(segment, item) for item in
+                     struct.unpack_from('<%dQ' % size, buffer, offset + 5))
+    if tag == 0x42:     # B
+        return buffer[offset + 1] != 0
+    if tag == 0x4e:     # N
+        return None
+    import marshal
+    size, = struct.unpack_from('<I', buffer, offset + 1)
+    return marshal.loads(buffer[offset + 5:offset + 5 + size])
+
+
+def _shared_key(buffer, offset):
+    size, = struct.unpack_from('<I', buffer, offset + 1)
+    return buffer[offset + 5:offset + 5 + size]
+
+
+class SharedStorage(Storage):
+    """A read-only Storage object reading a dict of a shared config segment
+    in place, whose keys are looked up in its hash table. Values are decoded
+    when read: nested dicts are SharedStorage objects and lists tuples,
+    which compare equal to the lists they were published from. Pickling one
+    attaches the unpickled copy to the same segment. As the settings aren't
+    held by the dict itself, it's serialized with
+    `json.dumps(storage.to_dict())`.
+    """
+
+    _segment = None
+    _offset = None
+
+    def _entries(self):
+        buffer = self._segment.buffer
+        size, = struct.unpack_from('<I', buffer, self._offset + 1)
+        return buffer, size, self._offset + 9
+
+    def _lookup(self, key):
+        """Returns the offset of the value of 'key' or None."""
+        if not isinstance(key, str):
+            return None
+        buffer, offset = self._segment.buffer, self._offset
+        size, slots = struct.unpack_from('<II', buffer, offset + 1)
+        entries, table = offset + 9, offset + 9 + size * 16
+        encoded = key.encode('utf-8')
+        slot = zlib.crc32(encoded) & (slots - 1)
+        while True:
+            position, = struct.unpack_from('<I', buffer, table + slot * 4)
+            if not position:
+                return None
+            key_offset, value_offset = struct.unpack_from(
+                '<QQ', buffer, entries + (position - 1) * 16)
+            if _shared_key(buffer, key_offset) == encoded:
+                return value_offset
+            slot = (slot + 1) & (slots - 1)
+
+    def __getitem__(self, key):
+        offset = self._lookup(key)
+        return None if offset is None else _shared_value(self._segment, offset)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def __iter__(self):
+        buffer, size, start = self._entries()
+        for i in range(size):
+            key_offset, = struct.unpack_from('<Q', buffer, start + i * 16)
+            yield _shared_value(self._segment, key_offset)
+
+    def __len__(self):
+        return self._entries()[1]
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('%s objects are read-only' % type(self).__name__)
+
+    __setitem__ = __delitem__ = __setattr__ = __delattr__ = _immutable
+    update = pop = popitem = clear = setdefault = __ior__ = _immutable
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            return _same_settings(self, other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def keys(self):
+        return list(self)
+
+    def get(self, key, default=None):
+        offset = self._lookup(key)
+        if offset is None:
+            return default
+        return _shared_value(self._segment, offset)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def __reduce__(self):
+        return (_attach_shared, (self._segment.name, self._offset))
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__,
+                            dict.__repr__(dict(self.items())))
+
+
+def _attach_shared(name, offset):
+    segment = _attach_segment(name)
+    if offset == segment.root:
+        return segment.config
+    return _shared_value(segment, offset)
+
+
+class SharedConfig(SharedStorage, Config):
+    """A read-only Config reading a segment published by `Config.publish`
+    in place. A segment is attached to once per process; Config objects
+    unpickled from one are attached to the same segment. Func defaults
+    registered after the Config was published are computed per process.
+    """
+
+    @staticmethod
+    def attach(name):
+        """Returns the Config held by the segment called 'name' as given by
+        `SharedConfigSegment.name`.
+        """
+        return _attach_segment(name).config
+
+    def __getitem__(self, key):
+        if _config_stats is not None:
+            _config_stats._read(self, key)
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        offset = self._lookup(key)
+        if offset is not None:
+            return _shared_value(self._segment, offset)
+        if key in self._defaults:
+            return self._defaults[key]
+        if key in self._func_defaults:
+            value = self._compute_default(key)
+            return dict.get(self, key, value)
+        return None
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or self._lookup(key) is not None
+
+    def __iter__(self):
+        for key in SharedStorage.__iter__(self):
+            yield key
+        for key in dict.keys(self):
+            if self._lookup(key) is None:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def freeze(self):
+        return _freeze(dict(self.items()))
+
+    def publish(self, path=None):
+        return Config.publish(self, path)
+
+
+# shared variants of the Config types published by name
+_shared_types = {}
+
+
+def _shared_type(config_type):
+    """Returns the SharedConfig type deriving from 'config_type' so that
+    attached Config objects keep their type and registered defaults.
+    """
+    if issubclass(config_type, SharedConfig) or config_type is Config:
+        return SharedConfig
+    shared_type = _shared_types.get(config_type)
+    if shared_type is None:
+        shared_type = type('Shared' + config_type.__name__,
+                           (SharedConfig, config_type),
+                           dict(__module__=config_type.__module__))
+        shared_type._defaults = config_type._defaults
+        shared_type._func_defaults = config_type._func_defaults
+        _shared_types[config_type] = shared_type
+    return shared_type
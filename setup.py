@@ -12,6 +12,7 @@ setup(
     author_email='hkmshb@gmail.com',
     url='http://hazeltek.com/',
     py_modules=['dolfin'],
+    cmdclass={'build_py': dolfin.revision_build_py()},
     license='MIT',
     platforms='any',
     classifiers=[
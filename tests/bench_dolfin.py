@@ -0,0 +1,557 @@
+"""
+Defines benchmarks for dolfin. Run all benchmarks or only those named:
+
+    python tests/bench_dolfin.py [name ...]
+"""
+import os, sys, time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import dolfin
+
+
+
+def report(label, seconds, number, unit='ms'):
+    scale = dict(ms=1e3, us=1e6)[unit]
+    print('  %-40s %10.3f %s' % (label, seconds * scale / number, unit))
+
+
+def recursive_make(obj):
+    """Storage.make as implemented before conversion became iterative."""
+    _make = lambda d: dolfin.Storage({ k: d[k]
+        if not isinstance(d[k], (dict, dolfin.Storage))
+        else _make(d[k])
+            for k in d.keys()
+    })
+    return _make(obj)
+
+
+def bench_storage_make():
+    ""
+    wide = dict(('section%d' % i, dict(('key%d' % j, j) for j in range(20)))
+                for i in range(5000))
+    deep = leaf = dict()
+    for _ in range(300):
+        leaf['next'] = dict(value=1)
+        leaf = leaf['next']
+
+    common = dict(('key%d' % j, j) for j in range(200))
+    shared = dict(('section%d' % i, common) for i in range(1000))
+
+    for label, doc, number in (('wide (5000 x 20)', wide, 10),
+                               ('deep (300 levels)', deep, 200),
+                               ('shared (1000 x same 200)', shared, 10)):
+        print('storage make: %s' % label)
+        for name, make in (('recursive', recursive_make),
+                           ('iterative', dolfin.Storage.make)):
+            seconds = timeit.timeit(lambda: make(doc), number=number)
+            report(name, seconds, number)
+
+    # beyond the recursion limit only the iterative conversion completes
+    for _ in range(sys.getrecursionlimit() * 10):
+        leaf['next'] = dict(value=1)
+        leaf = leaf['next']
+    print('storage make: deep (%d levels)' % (sys.getrecursionlimit() * 10))
+    seconds = timeit.timeit(lambda: dolfin.Storage.make(deep), number=10)
+    report('iterative', seconds, 10)
+
+
+
+def bench_config_snapshot():
+    ""
+    import json, shutil, tempfile
+
+    tenants = dict(('tenant%d' % i, dict(
+        name='Tenant %d' % i, quota=i, enabled=bool(i % 2),
+        hosts=['host%d.example.com' % j for j in range(10)],
+        limits=dict(('limit%d' % j, j * 1.5) for j in range(20)),
+    )) for i in range(10000))
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        conf_path = os.path.join(cache_dir, 'tenants.conf')
+        with open(conf_path, 'w') as f:
+            json.dump(tenants, f)
+        past = time.time() - 3600
+        os.utime(conf_path, (past, past))
+        print('config snapshot: %.1f MB file'
+              % (os.path.getsize(conf_path) / 1024.0 / 1024.0))
+
+        def load(conf_type):
+            dolfin.Config.cache_clear()     # as in a freshly started process
+            return conf_type(conf_path)
+
+        number = 5
+        snapshot = type('SnapshotConfig', (dolfin.Config,),
+                        dict(_snapshot=cache_dir))
+        lazy = type('LazySnapshotConfig', (snapshot,), dict(_lazy=True))
+        LazyConfig = type('LazyConfig', (dolfin.Config,), dict(_lazy=True))
+        load(snapshot)  # builds the snapshot
+        for label, conf_type in (('cold: json', dolfin.Config),
+                                 ('cold: json, lazy', LazyConfig),
+                                 ('warm: snapshot', snapshot),
+                                 ('warm: snapshot, lazy', lazy)):
+            seconds = timeit.timeit(lambda: load(conf_type), number=number)
+            report(label, seconds, number)
+    finally:
+        shutil.rmtree(cache_dir)
+
+def bench_config_overlay():
+    ""
+    import json, shutil, tempfile, tracemalloc
+
+    services = dict(('service%d' % i, dict(
+        host='10.0.%d.%d' % (i // 256, i % 256), port=8000 + i,
+        options=dict(('option%d' % j, j) for j in range(10)),
+    )) for i in range(2000))
+
+    conf_dir = tempfile.mkdtemp()
+    try:
+        conf_path = os.path.join(conf_dir, 'services.conf')
+        with open(conf_path, 'w') as f:
+            json.dump(services, f)
+        past = time.time() - 3600
+        os.utime(conf_path, (past, past))
+        base = dolfin.OverlayConfig(conf_path)
+
+        def per_request(make):
+            config = make(user='bob', service0=dict(port=1))
+            return config.service0.port + config.service1.port
+
+        number = 200
+        print('config overlay: per-request config, 2000 services')
+        for label, make in (
+                ('copying Config', lambda **kw: dolfin.Config(conf_path, **kw)),
+                ('base.overlay', base.overlay)):
+            seconds = timeit.timeit(lambda: per_request(make), number=number)
+            report(label, seconds, number)
+            tracemalloc.start()
+            per_request(make)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print('  %-40s %10.1f KB peak' % (label, peak / 1024.0))
+    finally:
+        shutil.rmtree(conf_dir)
+
+
+def bench_config_path():
+    ""
+    conf_path = os.path.join(os.path.dirname(__file__), 'data', 'complex.conf')
+    config = dolfin.Config(conf_path)
+    name = config.compile_path('fix.mix[1].all.name')
+    number = 100000
+
+    cases = (('chained attributes', lambda: config.fix.mix[1].all.name),
+             ('get_path', lambda: config.get_path('fix.mix[1].all.name')),
+             ('compile_path', lambda: name(config)))
+    # interleaved so the timings are comparable on a noisy machine
+    best = [min(timings) for timings in zip(*[
+        [timeit.timeit(stmt, number=number) for _, stmt in cases]
+        for _ in range(7)])]
+
+    print('config path: fix.mix[1].all.name')
+    for (label, _), seconds in zip(cases, best):
+        report('%s (%.1fx)' % (label, best[0] / seconds), seconds, number,
+               'us')
+
+
+def bench_config_schema():
+    ""
+    import tracemalloc
+
+    tenants = [dict(
+        name='Tenant %d' % i, quota=i, enabled=bool(i % 2),
+        hosts=['host%d.example.com' % j for j in range(3)],
+        limits=dict(('limit%d' % j, j * 1.5) for j in range(10)),
+    ) for i in range(10000)]
+    Tenant = dolfin.Config.compile_schema(dict(
+        name=str, quota=int, enabled=bool, hosts=[str],
+        limits=dict(('limit%d' % j, float) for j in range(10)),
+    ), 'Tenant')
+
+    print('config schema: 10000 tenants')
+    for label, load in (
+            ('Storage', lambda: [dolfin.Storage.make(t) for t in tenants]),
+            ('SchemaConfig', lambda: [Tenant.from_mapping(t)
+                                      for t in tenants])):
+        tracemalloc.start()
+        objects = load()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print('  %-40s %10.1f KB' % (label + ' memory', size / 1024.0))
+
+        seconds = timeit.timeit(load, number=1)
+        report(label + ' load', seconds, 1)
+        obj = objects[0]
+        seconds = min(timeit.repeat(lambda: obj.limits.limit9, number=100000,
+                                    repeat=5))
+        report(label + ' read limits.limit9', seconds, 100000, 'us')
+
+
+def bench_config_shared():
+    ""
+    import pickle, tracemalloc
+
+    tenants = dict(('tenant%d' % i, dict(
+        name='Tenant %d' % i, quota=i, enabled=bool(i % 2),
+        hosts=['host%d.example.com' % j for j in range(10)],
+        limits=dict(('limit%d' % j, j * 1.5) for j in range(20)),
+    )) for i in range(10000))
+    config = dolfin.Config(**tenants)
+    pickled = pickle.dumps(config)
+
+    with config.publish() as segment:
+        print('config shared: 10000 tenants, per worker')
+        for label, attach in (
+                ('unpickled copy', lambda: pickle.loads(pickled)),
+                ('attached segment', lambda: dolfin.SharedConfigSegment.open(
+                    segment.name).config)):
+            tracemalloc.start()
+            worker_config = attach()
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            print('  %-40s %10.1f KB' % (label + ' memory', size / 1024.0))
+            seconds = timeit.timeit(attach, number=5)
+            report(label + ' attach', seconds, 5)
+            seconds = min(timeit.repeat(
+                lambda: worker_config.tenant5000.limits.limit9,
+                number=10000, repeat=5))
+            report(label + ' read', seconds, 10000, 'us')
+            if isinstance(worker_config, dolfin.SharedConfig):
+                worker_config._segment.close()
+
+
+def bench_config_load():
+    ""
+    import json, shutil, tempfile
+
+    tenants = dict(('tenant%d' % i, dict(
+        name='Tenant %d' % i, quota=i, enabled=bool(i % 2),
+        hosts=['host%d.example.com' % j for j in range(10)],
+        limits=dict(('limit%d' % j, j * 1.5) for j in range(20)),
+    )) for i in range(10000))
+    data = json.dumps(tenants).encode('utf-8')
+
+    conf_dir = tempfile.mkdtemp()
+    try:
+        conf_path = os.path.join(conf_dir, 'tenants.conf')
+        with open(conf_path, 'wb') as f:
+            f.write(data)
+        print('config load: %.1f MB document'
+              % (len(data) / 1024.0 / 1024.0))
+
+        def load(conf_type):
+            dolfin.Config.cache_clear()
+            return conf_type(conf_path)
+
+        number = 5
+        for backend in ('json', dolfin.set_json_backend().__module__):
+            conf_type = type('BackendConfig', (dolfin.Config,),
+                             dict(_json_backend=backend))
+            seconds = timeit.timeit(lambda: load(conf_type), number=number)
+            report('Config(path), %s' % backend, seconds, number)
+
+        seconds = timeit.timeit(
+            lambda: dolfin.Storage.make(json.loads(data)), number=number)
+        report('Storage.make(json.loads(bytes))', seconds, number)
+        seconds = timeit.timeit(lambda: dolfin.Config.load(data),
+                                number=number)
+        report('Config.load(bytes)', seconds, number)
+    finally:
+        shutil.rmtree(conf_dir)
+
+
+STARTUP_SUBCOMMAND = '''
+import dolfin
+import %(module)s
+
+class Command%(i)d(dolfin.SubCommand):
+    """Runs task %(i)d"""
+
+    def __init__(self, parent):
+        super(Command%(i)d, self).__init__(parent)
+        for j in range(30):
+            self._subparser.add_argument('--option%%d' %% j, help='option')
+
+    def __call__(self, args):
+        return 'task %(i)d'
+'''
+
+STARTUP_CLI = '''
+import sys
+sys.path[:0] = [%(root)r, %(tree)r]
+import dolfin
+
+class Tool(dolfin.Command):
+
+    def __init__(self, lazy):
+        self.p = None
+        if lazy:
+            self.subcommands = dolfin.SubCommandRegistry(%(cache)r)
+            for i in range(50):
+                self.subcommands.register('task%%d' %% i,
+                                          'tasks.task%%d:Command%%d' %% (i, i))
+
+    def _create_parser(self):
+        if self.p is None:
+            from argparse import ArgumentParser
+            self.p = ArgumentParser(prog='tool')
+            if self.subcommands is None:    # today's eager construction
+                self._subparsers = self.p.add_subparsers()
+                for i in range(50):
+                    module = __import__('tasks.task%%d' %% i, fromlist=['_'])
+                    getattr(module, 'Command%%d' %% i)(self)
+        return self.p
+
+    def create_subparser(self, subcommand):
+        if self.subcommands is not None:
+            return super(Tool, self).create_subparser(subcommand)
+        name = 'task' + type(subcommand).__name__[7:]
+        parser = self._subparsers.add_parser(name, help=subcommand.__doc__)
+        parser.set_defaults(func=subcommand)
+        return parser
+
+    def _handle(self, args):
+        return args.func(args)
+
+if sys.argv[1] == 'serve':
+    tool = Tool(False)
+    tool._create_parser()   # imported once by the server
+    tool.serve(sys.argv[2])
+else:
+    Tool(sys.argv[1] == 'lazy').run_from_argv(sys.argv[2:])
+'''
+
+STARTUP_CLIENT = '''
+import sys
+sys.path.insert(0, %(root)r)
+import dolfin
+sys.exit(dolfin.run_client(%(path)r, sys.argv[1:]))
+'''
+
+
+def make_startup_cli(tree):
+    """Writes a CLI with 50 subcommands to 'tree' and returns its script."""
+    # stdlib modules standing in for the dependencies of each subcommand
+    modules = ('json', 'csv', 'decimal', 'fractions', 'email.mime.text',
+               'http.client', 'xml.etree.ElementTree', 'sqlite3', 'asyncio',
+               'logging.handlers', 'difflib', 'tarfile', 'zipfile', 'smtplib',
+               'unittest', 'pydoc', 'statistics', 'ipaddress', 'urllib.request',
+               'uuid', 'gzip', 'bz2', 'lzma', 'ftplib', 'imaplib')
+    os.mkdir(os.path.join(tree, 'tasks'))
+    open(os.path.join(tree, 'tasks', '__init__.py'), 'w').close()
+    for i in range(50):
+        with open(os.path.join(tree, 'tasks', 'task%d.py' % i), 'w') as f:
+            f.write(STARTUP_SUBCOMMAND % dict(
+                i=i, module=modules[i % len(modules)]))
+    script = os.path.join(tree, 'tool.py')
+    with open(script, 'w') as f:
+        f.write(STARTUP_CLI % dict(
+            root=os.path.join(os.path.dirname(__file__), '..'), tree=tree,
+            cache=os.path.join(tree, 'commands.json')))
+    return script
+
+
+def bench_command_startup():
+    ""
+    import shutil, subprocess, tempfile
+
+    tree = tempfile.mkdtemp()
+    try:
+        script = make_startup_cli(tree)
+
+        def run(mode, *argv):
+            start = time.time()
+            subprocess.check_output((sys.executable, script, mode) + argv)
+            return time.time() - start
+
+        run('eager', '--help')  # compiles bytecode and writes the cache
+        run('lazy', '--help')
+        number = 5
+        print('command startup: time to output, 50 subcommands')
+        for label, argv in (('--help', ('--help',)),
+                            ('task7 --help', ('task7', '--help')),
+                            ('task7', ('task7',))):
+            for mode in ('eager', 'lazy'):
+                seconds = min(run(mode, *argv) for _ in range(number))
+                report('%s, %s' % (label, mode), seconds, 1)
+    finally:
+        shutil.rmtree(tree)
+
+
+def bench_command_server():
+    ""
+    import shutil, subprocess, tempfile
+
+    tree = tempfile.mkdtemp()
+    try:
+        script = make_startup_cli(tree)
+        path = os.path.join(tree, 'tool.sock')
+        client = os.path.join(tree, 'client.py')
+        with open(client, 'w') as f:
+            f.write(STARTUP_CLIENT % dict(
+                root=os.path.join(os.path.dirname(__file__), '..'), path=path))
+
+        def run(*command):
+            start = time.time()
+            subprocess.check_output((sys.executable,) + command)
+            return time.time() - start
+
+        run(script, 'eager', 'task7')   # compiles bytecode
+        server = subprocess.Popen((sys.executable, script, 'serve', path))
+        try:
+            while not os.path.exists(path):
+                time.sleep(0.01)
+            number = 10
+            print('command server: time to output, 50 subcommands, eager')
+            for label, command in (
+                    ('in process', (script, 'eager', 'task7')),
+                    ('thin client, forked by server', (client, 'task7'))):
+                seconds = min(run(*command) for _ in range(number))
+                report(label, seconds, 1)
+        finally:
+            server.terminate()
+            server.wait()
+    finally:
+        shutil.rmtree(tree)
+
+
+BATCH_TOOL = '''
+import hashlib, sys
+sys.path.insert(0, %(root)r)
+import dolfin
+
+class DigestCommand(dolfin.Command):
+
+    def _create_parser(self):
+        from argparse import ArgumentParser
+        p = ArgumentParser(prog='digest')
+        p.add_argument('name')
+        p.add_argument('--rounds', type=int, default=100)
+        return p
+
+    def _handle(self, args):
+        digest = args.name.encode()
+        for _ in range(args.rounds):
+            digest = hashlib.sha256(digest).digest()
+        return '%%s %%s' %% (args.name, digest.hex()[:16])
+
+if __name__ == '__main__':
+    DigestCommand().run_from_argv()
+'''
+
+
+def bench_command_batch():
+    ""
+    import contextlib, io, shutil, subprocess, tempfile
+
+    tree = tempfile.mkdtemp()
+    try:
+        script = os.path.join(tree, 'batch_tool.py')
+        with open(script, 'w') as f:
+            f.write(BATCH_TOOL % dict(
+                root=os.path.join(os.path.dirname(__file__), '..')))
+        sys.path.insert(0, tree)
+        import batch_tool
+        lines = ['item%d' % i for i in range(10000)]
+
+        print('command batch: 10000 lines')
+        launches = 20
+        start = time.time()
+        for line in lines[:launches]:
+            subprocess.check_output((sys.executable, script, line))
+        report('process per line (from %d)' % launches,
+               (time.time() - start) * len(lines) / launches, 1)
+        for label, kwargs in (('run_batch, in process', dict()),
+                              ('run_batch, 4 jobs, ordered', dict(jobs=4)),
+                              ('run_batch, 4 jobs, streamed',
+                               dict(jobs=4, ordered=False))):
+            with contextlib.redirect_stdout(io.StringIO()), \
+                    contextlib.redirect_stderr(io.StringIO()):
+                start = time.time()
+                batch_tool.DigestCommand().run_batch(lines, **kwargs)
+            report(label, time.time() - start, 1)
+    finally:
+        sys.path.remove(tree)
+        shutil.rmtree(tree)
+
+
+def bench_command_timings():
+    ""
+    import contextlib, io, shutil, tempfile
+
+    tree = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(tree, 'batch_tool.py'), 'w') as f:
+            f.write(BATCH_TOOL % dict(
+                root=os.path.join(os.path.dirname(__file__), '..')))
+        sys.path.insert(0, tree)
+        import batch_tool
+        timings_path = os.path.join(tree, 'timings.jsonl')
+
+        number = 500
+        print('command timings: run_from_argv overhead')
+        for label, argv in (
+                ('plain', ['item']),
+                ('--timings', ['--timings', 'item']),
+                ('--timings=FILE', ['--timings=' + timings_path, 'item'])):
+            command = batch_tool.DigestCommand()
+            command.profile_options = True
+            with contextlib.redirect_stdout(io.StringIO()), \
+                    contextlib.redirect_stderr(io.StringIO()):
+                seconds = timeit.timeit(lambda: command.run_from_argv(argv),
+                                        number=number)
+            report(label, seconds, number, 'us')
+    finally:
+        sys.path.remove(tree)
+        shutil.rmtree(tree)
+
+
+class UninstrumentedConfig(dolfin.Config):
+    """Config.__getitem__ as implemented before ConfigStats."""
+
+    def __getitem__(self, key):
+        frames = dolfin._computing.frames
+        if frames:
+            self._record_read(frames[-1], key)
+        if key not in self:
+            if key in self._defaults:
+                dict.setdefault(self, key, self._defaults[key])
+            elif key in self._func_defaults:
+                value = self._compute_default(key)
+                if not dict.__contains__(self, key):
+                    return value
+        value = dict.get(self, key, None)
+        if type(value) is dolfin._Deferred:
+            value = value.resolve(self._lazy)
+            dict.__setitem__(self, key, value)
+        elif self._lazy:
+            value = dolfin._wrap_lazy(self, key, value)
+        return value
+
+
+def bench_config_stats():
+    ""
+    settings = dict(host='localhost', db=dict(name='main', port=5432))
+    configs = (('uninstrumented', UninstrumentedConfig(**settings)),
+               ('ConfigStats stopped', dolfin.Config(**settings)))
+    number = 200000
+
+    print('config stats: config.host + config.db.port')
+    for label, config in configs:
+        seconds = min(timeit.repeat(lambda: config.host + str(config.db.port),
+                                    number=number, repeat=5))
+        report(label, seconds, number, 'us')
+    config = configs[1][1]
+    with dolfin.ConfigStats() as stats:
+        seconds = min(timeit.repeat(lambda: config.host + str(config.db.port),
+                                    number=number, repeat=5))
+    report('ConfigStats started', seconds, number, 'us')
+    print('\n'.join('  ' + line for line in stats.report(5).splitlines()))
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:]
+    for name, bench in sorted(globals().items()):
+        if name.startswith('bench_') and (not names or name[6:] in names):
+            bench()
@@ -1,7 +1,8 @@
 """
 Defines unit tests for dolfin.
 """
-import os, sys
+import os, sys, time
+import threading
 import unittest
 
 import dolfin
@@ -107,6 +108,352 @@ class GitRevisionTest(RepositoryRevisionTest):
         self.assertEqual('0.1.0+7f9de9327817', version)
 
 
+class TempRepositoryTest(unittest.TestCase):
+    ""
+
+    def setUp(self):
+        import tempfile
+        self.working_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.working_dir)
+
+    def write(self, relpath, content):
+        filepath = os.path.join(self.working_dir, *relpath.split('/'))
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        with open(filepath, 'wb') as f:
+            f.write(content)
+
+
+class GitNativeRevisionTest(TempRepositoryTest):
+    ""
+    commit = b'7f9de93278170d6ea1d5b4a1cbd36b6e4a3f3c11'
+
+    def test_resolves_head_from_loose_ref(self):
+        self.write('.git/HEAD', b'ref: refs/heads/master\n')
+        self.write('.git/refs/heads/master', self.commit + b'\n')
+        version = get_localver(working_dir=self.working_dir)
+        self.assertEqual('0.1.0+7f9de9327817', version)
+
+    def test_resolves_head_from_packed_refs(self):
+        self.write('.git/HEAD', b'ref: refs/heads/master\n')
+        self.write('.git/packed-refs', (
+            b'# pack-refs with: peeled fully-peeled sorted\n' +
+            b'1' * 40 + b' refs/heads/develop\n' +
+            self.commit + b' refs/heads/master\n' +
+            b'^' + b'2' * 40 + b'\n'))
+        version = get_localver(working_dir=self.working_dir)
+        self.assertEqual('0.1.0+7f9de9327817', version)
+
+    def test_resolves_detached_head(self):
+        self.write('.git/HEAD', self.commit + b'\n')
+        version = get_localver(working_dir=self.working_dir)
+        self.assertEqual('0.1.0+7f9de9327817', version)
+
+    def test_resolves_head_through_gitdir_file(self):
+        self.write('.git', b'gitdir: main/.git/worktrees/wt\n')
+        self.write('main/.git/worktrees/wt/HEAD', b'ref: refs/heads/wt\n')
+        self.write('main/.git/worktrees/wt/commondir', b'../..\n')
+        self.write('main/.git/refs/heads/wt', self.commit + b'\n')
+        version = get_localver(working_dir=self.working_dir)
+        self.assertEqual('0.1.0+7f9de9327817', version)
+
+    def test_blank_repo_has_no_revision(self):
+        self.write('.git/HEAD', b'ref: refs/heads/master\n')
+        os.makedirs(os.path.join(self.working_dir, '.git', 'refs', 'heads'))
+        version = get_localver(working_dir=self.working_dir)
+        self.assertEqual('0.1.0', version)
+
+    def test_native_reader_matches_git_output(self):
+        import shutil, subprocess
+        if not shutil.which('git'):
+            self.skipTest('git is not installed')
+
+        run = lambda *a: subprocess.check_output(
+            ('git',) + a, cwd=self.working_dir, stderr=subprocess.STDOUT)
+        run('init', '-q')
+        self.write('lyrics.txt', b'Sweetie pie\n')
+        run('add', '.')
+        run('-c', 'user.name=hkmshb', '-c', 'user.email=hkmshb@test.com',
+            'commit', '-q', '-m', 'First lines')
+        expected = run('rev-list', 'HEAD', '-1').strip()
+        self.assertEqual(expected, 
+            dolfin._read_git_revision(self.working_dir))
+
+    def test_unparsable_layout_raises(self):
+        self.write('.git/HEAD', b'garbage\n')
+        self.assertRaises(ValueError, 
+            dolfin._read_git_revision, self.working_dir)
+
+
+class HgNativeRevisionTest(TempRepositoryTest):
+    ""
+    node = b'\xe7\xe5\xf5\x81\xb9\x91' + b'\x11' * 14
+
+    def test_resolves_parent_from_dirstate(self):
+        self.write('.hg/dirstate', self.node + b'\0' * 20 + b'entries...')
+        version = get_localver(working_dir=self.working_dir)
+        self.assertEqual('0.1.0+e7e5f581b991', version)
+
+    def test_resolves_parent_from_dirstate_v2(self):
+        self.write('.hg/dirstate', b'dirstate-v2\n' + self.node + b'\0' * 20)
+        version = get_localver(working_dir=self.working_dir)
+        self.assertEqual('0.1.0+e7e5f581b991', version)
+
+    def test_null_parent_has_no_revision(self):
+        self.write('.hg/dirstate', b'\0' * 40)
+        version = get_localver(working_dir=self.working_dir)
+        self.assertEqual('0.1.0', version)
+
+    def test_blank_repo_has_no_revision(self):
+        os.makedirs(os.path.join(self.working_dir, '.hg'))
+        version = get_localver(working_dir=self.working_dir)
+        self.assertEqual('0.1.0', version)
+
+    def test_unparsable_layout_raises(self):
+        self.write('.hg/dirstate', b'\x01\x02')
+        self.assertRaises(ValueError, 
+            dolfin._read_hg_revision, self.working_dir)
+
+
+class RevisionCacheTest(TempRepositoryTest):
+    ""
+    commits = (b'7f9de93278170d6ea1d5b4a1cbd36b6e4a3f3c11',
+               b'e7e5f581b991aa6ea1d5b4a1cbd36b6e4a3f3c11')
+
+    def setUp(self):
+        super(RevisionCacheTest, self).setUp()
+        self.write('.git/HEAD', b'ref: refs/heads/master\n')
+        self.write('.git/refs/heads/master', self.commits[0] + b'\n')
+        self.age_files()
+        get_localver.cache_clear()
+
+    def age_files(self):
+        past = time.time() - 3600
+        for dirpath, _, filenames in os.walk(self.working_dir):
+            for name in filenames:
+                os.utime(os.path.join(dirpath, name), (past, past))
+
+    def test_repeated_lookups_hit_the_cache(self):
+        for _ in range(3):
+            version = get_localver(working_dir=self.working_dir)
+            self.assertEqual('0.1.0+7f9de9327817', version)
+
+        info = get_localver.cache_info()
+        self.assertEqual((2, 1, 1), (info.hits, info.misses, info.currsize))
+
+    def test_ref_change_invalidates_cache(self):
+        get_localver(working_dir=self.working_dir)
+        self.write('.git/refs/heads/master', self.commits[1] + b'\n')
+        version = get_localver(working_dir=self.working_dir)
+        self.assertEqual('0.1.0+e7e5f581b991', version)
+
+    def test_head_change_invalidates_cache(self):
+        get_localver(working_dir=self.working_dir)
+        self.write('.git/packed-refs', self.commits[1] + b' refs/heads/dev\n')
+        self.age_files()
+        self.assertEqual('0.1.0+7f9de9327817', 
+            get_localver(working_dir=self.working_dir))
+
+        self.write('.git/HEAD', b'ref: refs/heads/dev\n')
+        version = get_localver(working_dir=self.working_dir)
+        self.assertEqual('0.1.0+e7e5f581b991', version)
+
+    def test_recently_modified_files_are_revalidated(self):
+        self.write('.git/refs/heads/master', self.commits[1] + b'\n')
+        get_localver(working_dir=self.working_dir)
+        get_localver(working_dir=self.working_dir)
+        self.assertEqual(0, get_localver.cache_info().hits)
+
+    def test_cache_is_bounded(self):
+        cache = dolfin._RevisionCache(maxsize=2)
+        for name in ('a', 'b', 'c'):
+            os.makedirs(os.path.join(self.working_dir, name))
+            cache.get(os.path.join(self.working_dir, name))
+        self.assertEqual(2, cache.info().currsize)
+
+    def test_cache_clear_resets_entries_and_counters(self):
+        get_localver(working_dir=self.working_dir)
+        get_localver.cache_clear()
+        self.assertEqual((0, 0, 128, 0), tuple(get_localver.cache_info()))
+
+
+class ConcurrentRevisionTest(TempRepositoryTest):
+    ""
+
+    def make_repos(self, count):
+        import binascii
+
+        expected = {}
+        for i in range(count):
+            name = 'repo%02d' % i
+            commit = ('%02d' % (i + 1)).encode() * 20
+            if i % 3 == 0:
+                self.write(name + '/.hg/dirstate',
+                    binascii.unhexlify(commit) + b'\0' * 20)
+            elif i % 3 == 1:
+                self.write(name + '/.git/HEAD', b'ref: refs/heads/master\n')
+                self.write(name + '/.git/refs/heads/master', commit + b'\n')
+            else:
+                self.write(name + '/.git/HEAD', b'unparsable\n')
+                commit = None
+            path = os.path.join(self.working_dir, name)
+            expected[path] = ('0.1.0+%s' % commit[:12].decode()
+                              if commit else '0.1.0')
+        return expected
+
+    def test_concurrent_lookups_never_change_working_directory(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        expected = self.make_repos(60)
+        cwd = os.getcwd()
+        def resolve(path):
+            version = get_localver(working_dir=path)
+            return version, os.getcwd()
+
+        paths = sorted(expected) * 5
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            results = list(pool.map(resolve, paths))
+
+        self.assertEqual([expected[p] for p in paths],
+                         [version for version, _ in results])
+        self.assertEqual(set([cwd]), set(c for _, c in results))
+        self.assertEqual(cwd, os.getcwd())
+
+    def test_resolve_many_returns_version_per_path(self):
+        expected = self.make_repos(30)
+        versions = get_localver.resolve_many(expected, max_workers=8)
+        self.assertDictEqual(expected, versions)
+
+    def test_resolve_many_async_returns_version_per_path(self):
+        import asyncio
+
+        expected = self.make_repos(30)
+        versions = asyncio.run(
+            get_localver.resolve_many_async(expected, limit=4))
+        self.assertDictEqual(expected, versions)
+
+
+@dolfin.include_revision(stamped=True)
+def get_stampedver():
+    return (0, 1)
+
+
+class StampedRevisionTest(TempRepositoryTest):
+    ""
+    commit = b'7f9de93278170d6ea1d5b4a1cbd36b6e4a3f3c11'
+
+    def test_reads_revision_file(self):
+        self.write('REVISION', self.commit + b'\n')
+        version = get_stampedver(working_dir=self.working_dir)
+        self.assertEqual('0.1.0+7f9de9327817', version)
+
+    def test_never_consults_source_control(self):
+        self.write('.git/HEAD', self.commit + b'\n')
+        version = get_stampedver(working_dir=self.working_dir)
+        self.assertEqual('0.1.0', version)
+
+    def test_revision_file_is_fallback_for_non_repo(self):
+        self.write('.REVISION', self.commit + b'\n')
+        version = get_localver(working_dir=self.working_dir)
+        self.assertEqual('0.1.0+7f9de9327817', version)
+
+    def test_build_py_stamps_revision_into_packages(self):
+        try:
+            from setuptools import Distribution
+        except ImportError:
+            self.skipTest('setuptools is not installed')
+
+        self.write('.git/HEAD', self.commit + b'\n')
+        self.write('src/pkg/__init__.py', b'')
+        self.write('src/pkg/sub/__init__.py', b'')
+        build_lib = os.path.join(self.working_dir, 'build')
+
+        dist = Distribution(dict(
+            name='pkg', packages=['pkg', 'pkg.sub'], script_args=[],
+            script_name=os.path.join(self.working_dir, 'setup.py'),
+            package_dir={'': os.path.join(self.working_dir, 'src')},
+            cmdclass={'build_py': dolfin.revision_build_py()},
+        ))
+        dist.src_root = self.working_dir
+        cmd = dist.get_command_obj('build_py')
+        cmd.build_lib = build_lib
+        dist.run_command('build_py')
+
+        version = get_stampedver(working_dir=os.path.join(build_lib, 'pkg'))
+        self.assertEqual('0.1.0+7f9de9327817', version)
+        self.assertIn(os.path.join(build_lib, 'pkg', 'REVISION'),
+                      cmd.get_outputs())
+        self.assertFalse(os.path.exists(
+            os.path.join(build_lib, 'pkg', 'sub', 'REVISION')))
+
+    def test_build_py_stamps_revision_next_to_modules(self):
+        try:
+            from setuptools import Distribution
+        except ImportError:
+            self.skipTest('setuptools is not installed')
+
+        self.write('.git/HEAD', self.commit + b'\n')
+        self.write('src/mod.py', b'')
+        build_lib = os.path.join(self.working_dir, 'build')
+
+        dist = Distribution(dict(
+            name='mod', py_modules=['mod'], script_args=[],
+            script_name=os.path.join(self.working_dir, 'setup.py'),
+            package_dir={'': os.path.join(self.working_dir, 'src')},
+            cmdclass={'build_py': dolfin.revision_build_py()},
+        ))
+        dist.src_root = self.working_dir
+        cmd = dist.get_command_obj('build_py')
+        cmd.build_lib = build_lib
+        dist.run_command('build_py')
+
+        filepath = os.path.join(build_lib, 'mod.REVISION')
+        with open(filepath, 'rb') as f:
+            self.assertEqual(self.commit + b'\n', f.read())
+        self.assertIn(filepath, cmd.get_outputs())
+
+    def test_submodule_reads_revision_file_of_top_level_package(self):
+        import importlib
+        package = 'stampedpkg%d' % id(self)
+        self.write(package + '/__init__.py', b'')
+        self.write(package + '/_version.py',
+                   b'import dolfin\n'
+                   b'@dolfin.include_revision(stamped=True)\n'
+                   b'def get_version():\n'
+                   b'    return (1, 2)\n')
+        self.write(package + '/REVISION', self.commit + b'\n')
+        sys.path.insert(0, self.working_dir)
+        try:
+            module = importlib.import_module(package + '._version')
+            self.assertEqual('1.2.0+7f9de9327817', module.get_version())
+        finally:
+            sys.path.remove(self.working_dir)
+            for name in [m for m in sys.modules if m.startswith(package)]:
+                del sys.modules[name]
+
+    def test_reads_revision_file_next_to_module(self):
+        import types
+
+        module = types.ModuleType('stamped_mod')
+        module.__file__ = os.path.join(self.working_dir, 'stamped_mod.py')
+        self.write('stamped_mod.REVISION', self.commit + b'\n')
+        self.write('REVISION', b'0000000000000000000000000000000000000000\n')
+
+        def version():
+            return (0, 1)
+        version.__module__ = module.__name__
+        version = dolfin.include_revision(stamped=True)(version)
+
+        sys.modules[module.__name__] = module
+        try:
+            self.assertEqual('0.1.0+7f9de9327817', version())
+        finally:
+            del sys.modules[module.__name__]
+
+
 class StorageTest(unittest.TestCase):
 
     def test_storage_is_instance_of_dict(self):
@@ -166,7 +513,149 @@ class StorageTest(unittest.TestCase):
         self.assertIsInstance(obj, dolfin.Storage)
         self.assertIsInstance(obj.baz, dolfin.Storage)
         self.assertIsInstance(obj.baz.meta, dolfin.Storage)
-    
+
+
+    def test_make_lazy_wraps_nested_dicts_on_access(self):
+        source = dict(baz=dict(quux='norf', meta=dict(name='simple.conf')))
+        obj = dolfin.Storage.make(source, lazy=True)
+        self.assertIsInstance(obj, dolfin.Storage)
+        self.assertIs(source['baz'], dict.get(obj, 'baz'))
+
+        self.assertIsInstance(obj.baz, dolfin.Storage)
+        self.assertIsInstance(obj.baz.meta, dolfin.Storage)
+        self.assertEqual('simple.conf', obj.baz.meta.name)
+        self.assertIs(obj.baz, obj['baz'])
+        self.assertIs(obj.baz.meta, obj.get('baz').meta)
+        self.assertNotIsInstance(source['baz'], dolfin.Storage)
+
+    def test_make_lazy_wraps_nested_dicts_on_iteration(self):
+        obj = dolfin.Storage.make(dict(foo=dict(bar=1)), lazy=True)
+        self.assertIsInstance(list(obj.values())[0], dolfin.Storage)
+        self.assertIsInstance(dict(obj.items())['foo'], dolfin.Storage)
+
+
+    def test_make_converts_dicts_within_lists_and_tuples(self):
+        obj = dolfin.Storage.make(dict(
+            mix = [3, dict(all=dict(name=11))],
+            tup = (dict(foo='bar'),),
+        ))
+        self.assertIsInstance(obj.mix[1], dolfin.Storage)
+        self.assertIsInstance(obj.mix[1].all, dolfin.Storage)
+        self.assertEqual(11, obj.mix[1].all.name)
+        self.assertIsInstance(obj.tup, tuple)
+        self.assertEqual('bar', obj.tup[0].foo)
+
+    def test_make_preserves_shared_references(self):
+        shared = dict(foo='bar')
+        obj = dolfin.Storage.make(dict(a=shared, b=[shared]))
+        self.assertIs(obj.a, obj.b[0])
+        self.assertIsNot(shared, obj.a)
+
+    def test_make_preserves_cycles(self):
+        source = dict(name='root', children=[])
+        source['children'].append(dict(parent=source))
+        source['self'] = source
+        obj = dolfin.Storage.make(source)
+        self.assertIs(obj, obj.self)
+        self.assertIs(obj, obj.children[0].parent)
+
+    def test_make_handles_nesting_beyond_recursion_limit(self):
+        source = leaf = dict()
+        for _ in range(sys.getrecursionlimit() * 2):
+            leaf['next'] = dict()
+            leaf = leaf['next']
+        leaf['name'] = 'leaf'
+
+        obj = dolfin.Storage.make(source)
+        while 'next' in obj:
+            self.assertIsInstance(obj, dolfin.Storage)
+            obj = obj.next
+        self.assertEqual('leaf', obj.name)
+
+class FrozenStorageTest(unittest.TestCase):
+    ""
+
+    def setUp(self):
+        self.frozen = dolfin.FrozenStorage(
+            foo='bar', baz=dict(quux=['a', dict(b=1)]), fix=dict(bug=1))
+
+    def test_nested_values_are_frozen(self):
+        self.assertIsInstance(self.frozen.baz, dolfin.FrozenStorage)
+        self.assertEqual(('a', dict(b=1)), self.frozen.baz.quux)
+        self.assertIsInstance(self.frozen.baz.quux[1], dolfin.FrozenStorage)
+        self.assertEqual(frozenset([1]), dolfin.FrozenStorage(s=set([1])).s)
+
+    def test_cannot_be_modified(self):
+        for modify in (lambda f: setattr(f, 'foo', 1),
+                       lambda f: f.__setitem__('foo', 1),
+                       lambda f: f.__delitem__('foo'),
+                       lambda f: f.update(foo=1),
+                       lambda f: f.pop('foo'),
+                       lambda f: f.setdefault('new', 1),
+                       lambda f: f.clear(),
+                       lambda f: f.__ior__(dict(foo=1))):
+            self.assertRaises(TypeError, modify, self.frozen)
+            self.assertRaises(TypeError, modify, self.frozen.fix)
+        self.assertEqual('bar', self.frozen.foo)
+
+        frozen, hashed = self.frozen, hash(self.frozen)
+        def merge():
+            f = frozen
+            f |= dict(foo=1)
+        self.assertRaises(TypeError, merge)
+        self.assertEqual(('bar', hashed), (frozen.foo, hash(frozen)))
+
+    def test_hashable_and_comparable(self):
+        other = dolfin.FrozenStorage(
+            foo='bar', baz=dict(quux=('a', dict(b=1))), fix=dict(bug=1))
+        self.assertEqual(hash(self.frozen), hash(other))
+        self.assertEqual(self.frozen, other)
+        self.assertEqual(1, len(set([self.frozen, other])))
+        self.assertNotEqual(self.frozen, self.frozen.evolve(foo='baz'))
+        self.assertEqual(dolfin.FrozenStorage(a=1), dict(a=1))
+
+    def test_shared_and_frozen_values_are_reused(self):
+        shared = dict(x=1)
+        frozen = dolfin.FrozenStorage(a=shared, b=shared, c=self.frozen.fix)
+        self.assertIs(frozen.a, frozen.b)
+        self.assertIs(self.frozen.fix, frozen.c)
+
+        cyclic = dict()
+        cyclic['self'] = cyclic
+        self.assertRaises(ValueError, dolfin.FrozenStorage, cyclic)
+
+    def test_copies_are_not_made(self):
+        import copy, pickle
+        self.assertIs(self.frozen, copy.copy(self.frozen))
+        self.assertIs(self.frozen, copy.deepcopy(self.frozen))
+        loaded = pickle.loads(pickle.dumps(self.frozen))
+        self.assertIsInstance(loaded.baz, dolfin.FrozenStorage)
+        self.assertEqual(self.frozen, loaded)
+
+    def test_evolve_shares_unchanged_subtrees(self):
+        evolved = self.frozen.evolve(foo='baz', new=dict(x=[1]))
+        self.assertEqual('bar', self.frozen.foo)
+        self.assertEqual('baz', evolved.foo)
+        self.assertEqual((1,), evolved.new.x)
+        self.assertIs(self.frozen.baz, evolved.baz)
+        self.assertIs(self.frozen, self.frozen.evolve(foo='bar'))
+
+    def test_set_path_copies_only_the_path(self):
+        evolved = self.frozen.set_path('baz.quux[1].b', 2)
+        self.assertEqual(2, evolved.baz.quux[1].b)
+        self.assertEqual(1, self.frozen.baz.quux[1].b)
+        self.assertIs(self.frozen.fix, evolved.fix)
+        self.assertEqual('a', evolved.baz.quux[0])
+
+        created = self.frozen.set_path('new.section', dict(x=1))
+        self.assertEqual(dict(x=1), created.new.section)
+        self.assertRaises(IndexError, self.frozen.set_path, 'baz.quux[5]', 1)
+        self.assertRaises(TypeError, self.frozen.set_path, 'foo.bar', 1)
+
+
+class LazyConfig(dolfin.Config):
+    _lazy = True
+
 
 class ConfigTest(unittest.TestCase):
     ""
@@ -267,6 +756,68 @@ class ConfigTest(unittest.TestCase):
             )
         ))
     
+    def test_lazy_config_matches_eager_config(self):
+        conf_path = os.path.join(self.base_dir, 'complex.conf')
+        conf = LazyConfig(conf_path)
+        self.assertDictEqual(dolfin.Config(conf_path), conf)
+        self.assertIsInstance(conf.fix, dolfin.Storage)
+        self.assertIs(conf.fix, conf.fix)
+        self.assertEqual('complex.conf', conf.meta.name)
+    
+    def test_file_is_parsed_once_while_unchanged(self):
+        conf_path = os.path.join(self.base_dir, 'simple.conf')
+        dolfin.Config.cache_clear()
+        first, second = dolfin.Config(conf_path), LazyConfig(conf_path)
+        self.assertDictEqual(first, second)
+
+        info = dolfin.Config.cache_info()
+        self.assertEqual((1, 1, 1), (info.hits, info.misses, info.currsize))
+
+    def test_cached_file_changes_are_instance_local(self):
+        conf_path = os.path.join(self.base_dir, 'complex.conf')
+        for conf_type in (dolfin.Config, LazyConfig):
+            conf = conf_type(conf_path)
+            conf.fix.bug.append('changed')
+            conf.fix.inf = 'changed'
+            conf.baz.append('changed')
+
+            conf = conf_type(conf_path)
+            self.assertEqual([1, 'details go here'], conf.fix.bug)
+            self.assertEqual([2, 'details go here'], conf.fix.inf)
+            self.assertEqual(['quux', 'norf'], conf.baz)
+
+    def test_copies_of_lazy_config_are_instance_local(self):
+        conf_path = os.path.join(self.base_dir, 'complex.conf')
+        conf = LazyConfig(conf_path)
+        dict(conf)['fix']['zzz'] = 1
+        conf.copy()['fix']['mix'][1]['all']['yyy'] = 1
+        {**conf}['baz'].append('changed')
+        dict(conf.fix)['mix'][1]['xxx'] = 1
+
+        for conf_type in (dolfin.Config, LazyConfig):
+            conf = conf_type(conf_path)
+            self.assertIsNone(conf.fix.zzz)
+            self.assertIsNone(conf.fix.mix[1].xxx)
+            self.assertEqual(dict(name=11), conf.fix.mix[1].all)
+            self.assertEqual(['quux', 'norf'], conf.baz)
+
+    def test_modified_file_is_parsed_again(self):
+        import tempfile
+
+        fd, conf_path = tempfile.mkstemp(suffix='.conf')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('{"foo": "bar"}')
+            past = time.time() - 3600
+            os.utime(conf_path, (past, past))
+            self.assertEqual('bar', dolfin.Config(conf_path).foo)
+
+            with open(conf_path, 'w') as f:
+                f.write('{"foo": "baz"}')
+            self.assertEqual('baz', dolfin.Config(conf_path).foo)
+        finally:
+            os.remove(conf_path)
+    
     def test_can_register_default_config_values(self):
         conf = dolfin.Config()
         self.assertIsNone(conf.factory)
@@ -290,6 +841,1167 @@ class ConfigTest(unittest.TestCase):
         self.assertEqual('factory-location', conf.factory)
 
 
+class CountingConfig(dolfin.Config):
+    calls = []
+
+CountingConfig.register_func_default('secret',
+    lambda s, k: CountingConfig.calls.append(k) or 'computed')
+
+
+class FuncDefaultTest(unittest.TestCase):
+    ""
+
+    def make_type(self, **attrs):
+        calls = []
+        DerivedConfig = type('DerivedConfig', (dolfin.Config,), attrs)
+        def func(compute):
+            return lambda s, k: calls.append(k) or compute(s)
+        DerivedConfig.register_func_default('url', func(
+            lambda s: 'http://%s:%s' % (s.host, s.port)))
+        DerivedConfig.register_func_default('login', func(
+            lambda s: '%s@%s' % (s.user, s.url)))
+        return DerivedConfig, calls
+
+    def test_func_default_is_computed_once(self):
+        DerivedConfig, calls = self.make_type()
+        conf = DerivedConfig(host='localhost', port=80, user='bob')
+        self.assertEqual('http://localhost:80', conf.url)
+        self.assertEqual('http://localhost:80', conf['url'])
+        self.assertEqual(['url'], calls)
+
+    def test_absent_keys_read_with_get_are_dependencies(self):
+        for config_type in (dolfin.Config, dolfin.OverlayConfig):
+            DoubledConfig = type('DoubledConfig', (config_type,), {})
+            DoubledConfig.register_func_default(
+                'doubled', lambda s, k: s.get('x', 5) * 2)
+            conf = DoubledConfig()
+            self.assertEqual(10, conf.doubled)
+            conf.x = 10
+            self.assertEqual(20, conf.doubled)
+            del conf['x']
+            self.assertEqual(10, conf.doubled)
+
+    def test_dict_mutators_recompute_dependents(self):
+        DerivedConfig = self.make_type()[0]
+        conf = DerivedConfig(host='localhost', port=80)
+        self.assertEqual('http://localhost:80', conf.url)
+        self.assertEqual(80, conf.pop('port'))
+        self.assertEqual('http://localhost:None', conf.url)
+        self.assertEqual(7, conf.setdefault('port', 7))
+        self.assertEqual(7, conf.setdefault('port', 8))
+        self.assertEqual('http://localhost:7', conf.url)
+        self.assertEqual(None, conf.pop('missing', None))
+        self.assertRaises(KeyError, conf.pop, 'missing')
+
+        conf.clear()
+        self.assertEqual([], list(conf))
+        conf.update(host='remote', port=1)
+        self.assertEqual('http://remote:1', conf.url)
+        self.assertEqual(('url', 'http://remote:1'), conf.popitem())
+        conf.host = 'other'
+        self.assertEqual('http://other:1', conf.url)
+
+    def test_setting_dependency_recomputes_dependents(self):
+        DerivedConfig, calls = self.make_type()
+        conf = DerivedConfig(host='localhost', port=80, user='bob')
+        self.assertEqual('bob@http://localhost:80', conf.login)
+
+        conf.user = 'alice'
+        self.assertEqual('http://localhost:80', conf.url)
+        self.assertEqual('alice@http://localhost:80', conf.login)
+        conf.port = 8080
+        self.assertEqual('alice@http://localhost:8080', conf.login)
+        self.assertEqual(['login', 'url', 'login', 'login', 'url'], calls)
+
+    def test_deleting_dependency_recomputes_dependents(self):
+        DerivedConfig, _ = self.make_type()
+        conf = DerivedConfig(host='localhost', port=80)
+        self.assertEqual('http://localhost:80', conf.url)
+        del conf['port']
+        self.assertEqual('http://localhost:None', conf.url)
+        conf.update(port=1)
+        self.assertEqual('http://localhost:1', conf.url)
+
+    def test_set_value_is_kept_when_dependency_changes(self):
+        DerivedConfig, _ = self.make_type()
+        conf = DerivedConfig(host='localhost', port=80)
+        conf.url
+        conf.url = 'http://example.com'
+        conf.host = 'other'
+        self.assertEqual('http://example.com', conf.url)
+
+    def test_eager_config_computes_defaults_at_load(self):
+        DerivedConfig, calls = self.make_type(_eager=True)
+        conf = DerivedConfig(host='localhost', port=80, user='bob')
+        self.assertEqual(set(['login', 'url']), set(calls))
+        self.assertEqual('bob@http://localhost:80', dict.get(conf, 'login'))
+        self.assertEqual('http://localhost:80', dict.get(conf, 'url'))
+
+    def test_cyclic_func_defaults_cause_error(self):
+        CyclicConfig = type('CyclicConfig', (dolfin.Config,), {})
+        CyclicConfig.register_func_default('a', lambda s, k: s.b)
+        CyclicConfig.register_func_default('b', lambda s, k: s.a)
+        with self.assertRaises(dolfin.DolfinError):
+            CyclicConfig().a
+
+
+class ConcurrentFuncDefaultTest(unittest.TestCase):
+    ""
+
+    def test_func_default_is_computed_once_by_concurrent_readers(self):
+        calls, barrier = [], threading.Barrier(64)
+        SlowConfig = type('SlowConfig', (dolfin.Config,), {})
+        SlowConfig.register_func_default('token',
+            lambda s, k: calls.append(k) or time.sleep(0.05) or object())
+        conf = SlowConfig()
+
+        results = []
+        def read():
+            barrier.wait()
+            results.append(conf.token)
+        threads = [threading.Thread(target=read) for _ in range(64)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(['token'], calls)
+        self.assertEqual(64, len(results))
+        self.assertTrue(all(result is conf.token for result in results))
+
+    def test_value_computed_from_replaced_setting_is_not_kept(self):
+        started, proceed = threading.Event(), threading.Event()
+        def compute(s, k):
+            host = s.host
+            started.set()
+            proceed.wait()
+            return 'http://%s' % host
+        SlowConfig = type('SlowConfig', (dolfin.Config,), {})
+        SlowConfig.register_func_default('url', compute)
+        conf = SlowConfig(host='old')
+
+        results = []
+        thread = threading.Thread(target=lambda: results.append(conf.url))
+        thread.start()
+        started.wait()
+        conf.host = 'new'
+        proceed.set()
+        thread.join()
+
+        self.assertEqual(['http://old'], results)
+        self.assertEqual('http://new', conf.url)
+
+    def test_value_set_while_computed_is_not_overwritten(self):
+        started, proceed = threading.Event(), threading.Event()
+        def compute(s, k):
+            started.set()
+            proceed.wait()
+            return 'computed'
+        SlowConfig = type('SlowConfig', (dolfin.Config,), {})
+        SlowConfig.register_func_default('x', compute)
+        conf = SlowConfig()
+
+        results = []
+        thread = threading.Thread(target=lambda: results.append(conf['x']))
+        thread.start()
+        started.wait()
+        conf['x'] = 'explicit'
+        proceed.set()
+        thread.join()
+
+        self.assertEqual(['explicit'], results)
+        self.assertEqual('explicit', conf['x'])
+
+
+class ReloadableConfigTest(unittest.TestCase):
+    ""
+
+    def setUp(self):
+        import tempfile
+        fd, self.conf_path = tempfile.mkstemp(suffix='.conf')
+        os.close(fd)
+        self.write(dict(foo='bar', fix=dict(bug=1, inf=2)), age=True)
+
+    def tearDown(self):
+        os.remove(self.conf_path)
+
+    def write(self, document, age=False):
+        import json
+        with open(self.conf_path, 'w') as f:
+            json.dump(document, f)
+        mtime = time.time() - (3600 if age else 0)
+        os.utime(self.conf_path, (mtime, mtime))
+
+    def test_reload_swaps_in_changed_settings(self):
+        handle = dolfin.ReloadableConfig(self.conf_path, spam='egg')
+        old = handle.config
+        self.assertEqual('bar', handle.foo)
+
+        self.write(dict(foo='baz', fix=dict(bug=1, inf=3), new=True))
+        self.assertEqual(set(['foo', 'fix.inf', 'new']), handle.reload())
+        self.assertIsNot(old, handle.config)
+        self.assertEqual('bar', old.foo)
+        self.assertEqual('baz', handle.foo)
+        self.assertEqual(3, handle['fix'].inf)
+        self.assertEqual('egg', handle.config.spam)
+        self.assertEqual(set(), handle.reload())
+
+    def test_subscribers_are_notified_of_changed_keys(self):
+        handle = dolfin.ReloadableConfig(self.conf_path)
+        notices = []
+        handle.subscribe(lambda conf, changed: notices.append(
+            (conf.foo, changed)))
+
+        os.utime(self.conf_path, None)
+        handle.reload()
+        self.write(dict(foo='baz', fix=dict(bug=1, inf=2)))
+        handle.reload()
+        self.assertEqual([('baz', set(['foo']))], notices)
+
+    def test_unparsable_file_keeps_current_settings(self):
+        handle = dolfin.ReloadableConfig(self.conf_path)
+        with open(self.conf_path, 'w') as f:
+            f.write('{"foo": ')
+        self.assertEqual(set(), handle.reload())
+        self.assertEqual('bar', handle.foo)
+
+    def test_func_defaults_are_not_computed_again(self):
+        del CountingConfig.calls[:]
+        handle = dolfin.ReloadableConfig(self.conf_path, CountingConfig)
+        self.assertEqual('computed', handle.secret)
+
+        self.write(dict(foo='baz'))
+        handle.reload()
+        self.assertEqual('computed', handle.secret)
+        self.assertEqual(['secret'], CountingConfig.calls)
+
+    def test_eager_func_defaults_are_not_computed_again(self):
+        calls = []
+        EagerConfig = type('EagerConfig', (dolfin.Config,), dict(_eager=True))
+        EagerConfig.register_func_default('secret',
+            lambda s, k: calls.append(k) or 'computed')
+        EagerConfig.register_func_default('greeting',
+            lambda s, k: calls.append(k) or 'hello %s' % s.foo)
+        handle = dolfin.ReloadableConfig(self.conf_path, EagerConfig)
+
+        self.write(dict(foo='baz'))
+        handle.reload()
+        self.assertEqual(['secret', 'greeting', 'greeting'], calls)
+        self.assertEqual('computed', dict.get(handle.config, 'secret'))
+        self.assertEqual('hello baz', dict.get(handle.config, 'greeting'))
+
+    def test_func_defaults_are_computed_again_when_dependency_changes(self):
+        DerivedConfig = type('DerivedConfig', (dolfin.Config,), {})
+        DerivedConfig.register_func_default('greeting',
+            lambda s, k: 'hello %s' % s.foo)
+        DerivedConfig.register_func_default('bug',
+            lambda s, k: 'bug %s' % s.fix.bug)
+        handle = dolfin.ReloadableConfig(self.conf_path, DerivedConfig)
+        self.assertEqual('hello bar', handle.greeting)
+        old_bug = handle.bug
+
+        self.write(dict(foo='baz', fix=dict(bug=1, inf=2)))
+        handle.reload()
+        self.assertEqual('hello baz', handle.greeting)
+        self.assertIs(old_bug, handle.bug)
+
+    def test_readers_never_see_partial_state(self):
+        handle = dolfin.ReloadableConfig(self.conf_path)
+        self.write(dict(foo='v0', fix=dict(bug='v0', inf='v0')))
+        handle.reload()
+
+        stopped, errors = threading.Event(), []
+        def read():
+            while not stopped.is_set():
+                conf = handle.config
+                if not (conf.foo == conf.fix.bug == conf.fix.inf):
+                    errors.append(conf)
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        for i in range(1, 10):
+            v = 'v%d' % i
+            self.write(dict(foo=v, fix=dict(bug=v, inf=v)))
+            handle.reload()
+        stopped.set()
+        for reader in readers:
+            reader.join()
+        self.assertEqual([], errors)
+
+    def wait_for_reload(self, handle):
+        notices = threading.Event()
+        handle.subscribe(lambda conf, changed: notices.set())
+        with handle:
+            time.sleep(0.2)
+            self.write(dict(foo='watched'))
+            self.assertTrue(notices.wait(5))
+        self.assertEqual('watched', handle.foo)
+
+    def test_watcher_reloads_changed_file(self):
+        self.wait_for_reload(
+            dolfin.ReloadableConfig(self.conf_path, interval=0.05))
+
+    def test_watcher_falls_back_to_polling(self):
+        inotify_watch = dolfin._inotify_watch
+        dolfin._inotify_watch = lambda dirpath: None
+        try:
+            self.wait_for_reload(
+                dolfin.ReloadableConfig(self.conf_path, interval=0.05))
+        finally:
+            dolfin._inotify_watch = inotify_watch
+
+
+class SnapshotConfigTest(unittest.TestCase):
+    ""
+
+    def setUp(self):
+        import tempfile
+        self.cache_dir = tempfile.mkdtemp()
+        self.conf_path = os.path.join(self.cache_dir, 'app.conf')
+        self.write('{"foo": "bar", "fix": {"bug": [1, 2]}}', age=True)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.cache_dir)
+
+    def write(self, content, age=False):
+        with open(self.conf_path, 'w') as f:
+            f.write(content)
+        if age:
+            past = time.time() - 3600
+            os.utime(self.conf_path, (past, past))
+
+    def load(self, snapshot=True):
+        return dolfin._load_document(self.conf_path, snapshot)
+
+    def tamper(self, snapshot=True):
+        # replaces the snapshot's document keeping its header to tell
+        # whether the snapshot or the file was loaded
+        import marshal, struct
+        path = dolfin._snapshot_path(self.conf_path, snapshot)
+        with open(path, 'rb') as f:
+            length, = struct.unpack('<I', f.read(4))
+            header = f.read(length)
+        with open(path, 'wb') as f:
+            f.write(struct.pack('<I', length) + header)
+            marshal.dump(dict(foo='snapshot'), f)
+
+    def test_snapshot_is_written_next_to_file(self):
+        self.assertEqual(dict(foo='bar', fix=dict(bug=[1, 2])), self.load())
+        self.assertTrue(os.path.exists(self.conf_path + '.snapshot'))
+
+        self.tamper()
+        self.assertEqual('snapshot', self.load()['foo'])
+
+    def test_snapshot_is_written_to_cache_directory(self):
+        snapshot_dir = os.path.join(self.cache_dir, 'snapshots')
+        os.makedirs(snapshot_dir)
+        self.load(snapshot_dir)
+        self.assertEqual(1, len(os.listdir(snapshot_dir)))
+
+        self.tamper(snapshot_dir)
+        self.assertEqual('snapshot', self.load(snapshot_dir)['foo'])
+
+    def test_modified_file_rebuilds_snapshot(self):
+        self.load()
+        self.tamper()
+        self.write('{"foo": "baz"}')
+        self.assertEqual(dict(foo='baz'), self.load())
+        self.assertEqual(dict(foo='baz'), self.load())
+
+    def test_touched_file_keeps_snapshot_if_hash_matches(self):
+        self.load()
+        self.tamper()
+        os.utime(self.conf_path, None)
+        self.assertEqual('snapshot', self.load()['foo'])
+
+    def test_corrupt_snapshot_is_rebuilt(self):
+        self.load()
+        with open(self.conf_path + '.snapshot', 'wb') as f:
+            f.write(b'garbage')
+        self.assertEqual('bar', self.load()['foo'])
+        self.assertEqual('bar', self.load()['foo'])
+
+    def test_config_can_opt_into_snapshots(self):
+        SnapshotConfig = type('SnapshotConfig', (dolfin.Config,),
+                              dict(_snapshot=self.cache_dir))
+        dolfin.Config.cache_clear()
+        conf = SnapshotConfig(self.conf_path)
+        self.assertEqual([1, 2], conf.fix.bug)
+        self.assertEqual(2, len(os.listdir(self.cache_dir)))
+
+    def test_config_snapshot_holds_storage_objects(self):
+        SnapshotConfig = type('SnapshotConfig', (dolfin.Config,),
+                              dict(_snapshot=True))
+        dolfin.Config.cache_clear()
+        SnapshotConfig(self.conf_path)
+        self.assertTrue(os.path.exists(self.conf_path + '.storage.snapshot'))
+
+        dolfin.Config.cache_clear()
+        document = dolfin._load_document(self.conf_path, True, storage=True)
+        self.assertIsInstance(document, dolfin._PickledStorage)
+        fix = document.load()['fix']
+        self.assertIs(dolfin.Storage, type(fix))
+        self.assertEqual(dict(bug=[1, 2]), fix)
+
+    def test_configs_built_from_storage_snapshot_are_independent(self):
+        SnapshotConfig = type('SnapshotConfig', (dolfin.Config,),
+                              dict(_snapshot=True))
+        dolfin.Config.cache_clear()
+        SnapshotConfig(self.conf_path)
+        dolfin.Config.cache_clear()
+        conf, other = SnapshotConfig(self.conf_path), SnapshotConfig(
+            self.conf_path)
+        conf.fix.bug.append(3)
+        conf.fix.mix = 'baz'
+        self.assertEqual(dict(bug=[1, 2]), other.fix)
+        self.assertEqual('app.conf', other.meta.name)
+
+
+class IndexedConfig(dolfin.Config):
+    _indexed = True
+
+
+class IndexedConfigTest(TempRepositoryTest):
+    ""
+    base_dir = os.path.join(os.path.dirname(__file__), 'data')
+
+    def load(self, content):
+        self.write('app.conf', content)
+        conf_path = os.path.join(self.working_dir, 'app.conf')
+        past = time.time() - 3600
+        os.utime(conf_path, (past, past))
+        return IndexedConfig(conf_path)
+
+    def test_accessed_keys_match_eager_loading(self):
+        conf_path = os.path.join(self.base_dir, 'complex.conf')
+        eager, conf = dolfin.Config(conf_path), IndexedConfig(conf_path)
+        self.assertEqual(set(eager), set(conf))
+        for key in eager:
+            self.assertEqual(eager[key], conf[key])
+        self.assertIsInstance(conf.fix.mix[1].all, dolfin.Storage)
+        self.assertEqual('complex.conf', conf.meta.name)
+        self.assertEqual(self.base_dir, conf.meta.path)
+
+    def test_copies_and_comparisons_match_eager_loading(self):
+        conf_path = os.path.join(self.base_dir, 'complex.conf')
+        eager = dolfin.Config(conf_path)
+        self.assertEqual(dict(eager), dict(IndexedConfig(conf_path)))
+        self.assertEqual(dict(eager), {**IndexedConfig(conf_path)})
+        self.assertEqual(IndexedConfig(conf_path), eager)
+        self.assertEqual(eager, IndexedConfig(conf_path))
+        self.assertEqual(IndexedConfig(conf_path), IndexedConfig(conf_path))
+        self.assertFalse(IndexedConfig(conf_path) != eager)
+        self.assertFalse('deferred' in repr(IndexedConfig(conf_path)))
+
+    def test_values_are_decoded_on_first_access(self):
+        conf = self.load(b'{"a": {"b": 1}, "c": [1, 2], "d": 3}')
+        index = dolfin._config_cache.load(
+            os.path.join(self.working_dir, 'app.conf'), indexed=True)
+        self.assertEqual({}, index._decoded)
+        self.assertEqual(1, conf.a.b)
+        self.assertEqual(['a'], list(index._decoded))
+        self.assertIs(conf.a, conf.a)
+
+    def test_scans_strings_escapes_and_scalars(self):
+        conf = self.load(b'\xef\xbb\xbf { "k\\"1" : "v}]\\"," ,\n'
+                         b'"k2":{"x":"{[","y":[true,null,{}]},'
+                         b'"k3":-1.5e3 , "k4":false,"k5":[]}')
+        self.assertEqual('v}]",', conf['k"1'])
+        self.assertEqual(dict(x='{[', y=[True, None, {}]), conf.k2)
+        self.assertEqual(-1500.0, conf.k3)
+        self.assertIs(False, conf.k4)
+        self.assertEqual([], conf.k5)
+
+    def test_constructor_settings_override_file(self):
+        self.write('app.conf', b'{"foo": "bar", "baz": 1}')
+        conf = IndexedConfig(os.path.join(self.working_dir, 'app.conf'),
+                             foo='qux')
+        self.assertEqual('qux', conf.foo)
+        self.assertEqual(1, conf.get('baz'))
+
+    def test_empty_object_has_only_meta(self):
+        self.assertEqual(['meta'], list(self.load(b' {} ')))
+
+    def test_invalid_document_raises(self):
+        for content in (b'', b'[1]', b'{"a" 1}', b'{"a": [1}', b'{"a": 1',
+                        b'{"a": 1}}'):
+            self.assertRaises(ValueError, self.load, content)
+
+
+class OverlayConfigTest(unittest.TestCase):
+    ""
+    base_dir = os.path.join(os.path.dirname(__file__), 'data')
+
+    def test_overlay_is_converted_with_settings_of_layers(self):
+        import json
+        conf = dolfin.OverlayConfig(os.path.join(self.base_dir, 'simple.conf'),
+                                    baz=dict(spam='egg'))
+        expected = dict(foo='bar', baz=dict(quux='norf', spam='egg'),
+                        meta=dict(name='simple.conf', path=self.base_dir))
+
+        made = dolfin.Storage.make(conf)
+        self.assertIs(dolfin.Storage, type(made))
+        self.assertIs(dolfin.Storage, type(made.baz))
+        self.assertEqual(expected, made)
+
+        plain = conf.to_dict()
+        self.assertIs(dict, type(plain))
+        self.assertIs(dict, type(plain['baz']))
+        self.assertEqual(expected, json.loads(json.dumps(plain)))
+
+    def test_storage_overlay_resolves_from_topmost_layer(self):
+        bottom = dict(foo='bar', baz=dict(quux='norf', spam='egg'), n=1)
+        top = dict(foo='qux', baz=dict(spam='ham'))
+        obj = dolfin.StorageOverlay(bottom, top, n=2)
+        self.assertEqual('qux', obj.foo)
+        self.assertEqual(2, obj.n)
+        self.assertIsInstance(obj.baz, dolfin.Storage)
+        self.assertEqual(dict(quux='norf', spam='ham'), obj.baz)
+        self.assertEqual(set(['foo', 'baz', 'n']), set(obj))
+        self.assertEqual(3, len(obj))
+
+    def test_storage_overlay_never_modifies_layers(self):
+        bottom = dict(foo='bar', baz=dict(quux='norf'), lst=[dict(a=1)])
+        obj = dolfin.StorageOverlay(bottom)
+        obj.foo = 'changed'
+        obj.baz.quux = 'changed'
+        obj.lst.append('changed')
+        obj.lst[0].a = 2
+        del obj['baz']
+
+        self.assertEqual(dict(foo='bar', baz=dict(quux='norf'),
+                              lst=[dict(a=1)]), bottom)
+        self.assertEqual('changed', obj.foo)
+        self.assertNotIn('baz', obj)
+        self.assertIsNone(obj.baz)
+        self.assertEqual([dict(a=2), 'changed'], obj.lst)
+
+    def test_nested_overlays_follow_changes_in_layers(self):
+        base = dolfin.OverlayConfig(db=dict(host='a', port=1))
+        req = base.overlay(x=1)
+        self.assertEqual('a', req.db.host)
+        self.assertIs(req.db, req.db)
+
+        base['db'] = dolfin.Storage(host='b', port=1)
+        self.assertEqual('b', req.db.host)
+        req.db.port = 2
+        base['db'] = dolfin.Storage(host='c', port=1)
+        self.assertEqual(dict(host='c', port=2), req.db)
+        self.assertEqual(1, base.db.port)
+
+        empty = {}
+        obj = dolfin.StorageOverlay(dict(d=dict(a=1)), dict(d=empty))
+        self.assertEqual(dict(a=1), obj.d)
+        empty['b'] = 2
+        self.assertEqual(dict(a=1, b=2), obj.d)
+
+    def test_non_dict_value_shadows_lower_dicts(self):
+        obj = dolfin.StorageOverlay(dict(a=dict(b=1)), dict(a=5))
+        self.assertEqual(5, obj.a)
+        obj = dolfin.StorageOverlay(dict(a=5), dict(a=dict(b=1)))
+        self.assertEqual(dict(b=1), obj.a)
+
+    def test_config_layers_file_environment_and_settings(self):
+        EnvConfig = type('EnvConfig', (dolfin.OverlayConfig,),
+                         dict(_env_prefix='DOLFIN_TEST_'))
+        EnvConfig.register_defaults(foo='default', level=0)
+        os.environ['DOLFIN_TEST_FIX__BUG'] = '[9]'
+        os.environ['DOLFIN_TEST_LEVEL'] = 'warn'
+        try:
+            conf_path = os.path.join(self.base_dir, 'complex.conf')
+            conf = EnvConfig(conf_path, baz='override')
+        finally:
+            del os.environ['DOLFIN_TEST_FIX__BUG']
+            del os.environ['DOLFIN_TEST_LEVEL']
+
+        self.assertIsInstance(conf, dolfin.Config)
+        self.assertEqual('bar', conf.foo)
+        self.assertEqual('warn', conf.level)
+        self.assertEqual('override', conf.baz)
+        self.assertEqual([9], conf.fix.bug)
+        self.assertEqual([2, 'details go here'], conf.fix.inf)
+        self.assertEqual('complex.conf', conf.meta.name)
+
+    def test_config_matches_copying_config(self):
+        conf_path = os.path.join(self.base_dir, 'complex.conf')
+        self.assertEqual(dolfin.Config(conf_path),
+                         dolfin.OverlayConfig(conf_path))
+
+    def test_overlay_derives_config_without_modifying_base(self):
+        conf_path = os.path.join(self.base_dir, 'simple.conf')
+        base = dolfin.OverlayConfig(conf_path)
+        request = base.overlay(foo='request', baz=dict(user='bob'))
+        request.baz.quux = 'changed'
+
+        self.assertIsInstance(request, dolfin.OverlayConfig)
+        self.assertEqual('request', request.foo)
+        self.assertEqual(dict(quux='changed', user='bob'), request.baz)
+        self.assertEqual('bar', base.foo)
+        self.assertEqual(dict(quux='norf'), base.baz)
+
+    def test_func_defaults_are_kept_in_top_layer(self):
+        FuncConfig = type('FuncConfig', (dolfin.OverlayConfig,), {})
+        FuncConfig.register_func_default('url',
+            lambda s, k: 'http://%s' % s.host)
+        conf = FuncConfig(host='localhost')
+        self.assertEqual('http://localhost', conf.url)
+        self.assertEqual('http://x', conf.overlay(host='x').url)
+        self.assertEqual('http://localhost', conf.overlay(port=1).url)
+        conf.url = 'http://set'
+        self.assertEqual('http://set', conf.overlay(host='x').url)
+        request = conf.overlay()
+        del request['url']
+        self.assertIsNone(request.url)
+        del request['host']
+        self.assertEqual('http://set', conf.url)
+
+
+class ConfigPathTest(unittest.TestCase):
+    ""
+    base_dir = os.path.join(os.path.dirname(__file__), 'data')
+
+    def setUp(self):
+        self.conf_path = os.path.join(self.base_dir, 'complex.conf')
+
+    def test_path_with_list_indices(self):
+        conf = dolfin.Config(self.conf_path)
+        self.assertEqual(11, conf.get_path('fix.mix.1.all.name'))
+        self.assertEqual(11, conf.get_path('fix.mix[1].all.name'))
+        self.assertEqual(5, conf.get_path('fix.mix[1].inf[-1]'))
+        self.assertEqual('bar', conf.get_path('foo'))
+        self.assertEqual(11, conf.fix.get_path('mix[1].all.name'))
+
+    def test_missing_path_gives_default(self):
+        conf = dolfin.Config(self.conf_path)
+        self.assertIsNone(conf.get_path('fix.nope.name'))
+        self.assertEqual('d', conf.get_path('fix.mix[9].all', 'd'))
+        self.assertEqual('d', conf.get_path('fix.mix.all', 'd'))
+        self.assertEqual('d', conf.get_path('foo.bar', 'd'))
+
+    def test_integer_key_looks_up_dict(self):
+        storage = dolfin.Storage.make({'a': {'0': 'zero'}})
+        self.assertEqual('zero', storage.get_path('a.0'))
+
+    def test_invalid_path_causes_error(self):
+        for path in ('', 'a..b', 'a[x]', 'a[0'):
+            with self.assertRaises(ValueError):
+                dolfin.Storage.compile_path(path)
+
+    def test_compiled_path_is_reused(self):
+        accessor = dolfin.Config.compile_path('fix.mix[1].all.name')
+        self.assertIs(accessor, dolfin.Config.compile_path(
+            'fix.mix[1].all.name'))
+        self.assertEqual(11, accessor(dolfin.Config(self.conf_path)))
+        self.assertEqual('d', accessor(dolfin.Config(), 'd'))
+
+    def test_path_applies_config_defaults(self):
+        PathConfig = type('PathConfig', (dolfin.Config,), {})
+        PathConfig.register_defaults(db=dict(host='localhost'))
+        PathConfig.register_func_default('url',
+            lambda s, k: 'http://%s' % s.get_path('db.host'))
+        conf = PathConfig()
+        self.assertEqual('localhost', conf.get_path('db.host'))
+        self.assertEqual('http://localhost', conf.get_path('url'))
+        conf.db = dict(host='example.com')
+        self.assertEqual('http://example.com', conf.get_path('url'))
+
+    def test_path_within_lazy_indexed_and_overlay_configs(self):
+        for conf_type in (LazyConfig, IndexedConfig, dolfin.OverlayConfig):
+            conf = conf_type(self.conf_path)
+            self.assertEqual(11, conf.get_path('fix.mix[1].all.name'))
+            self.assertEqual('norf', conf.get_path('baz[1]'))
+
+        overlay = dolfin.OverlayConfig(self.conf_path).overlay(
+            fix=dict(bug='fixed'))
+        self.assertEqual('fixed', overlay.get_path('fix.bug'))
+        self.assertEqual(11, overlay.get_path('fix.mix[1].all.name'))
+        del overlay['foo']
+        self.assertEqual('d', overlay.get_path('foo', 'd'))
+
+
+class SchemaConfigTest(unittest.TestCase):
+    ""
+    base_dir = os.path.join(os.path.dirname(__file__), 'data')
+
+    def setUp(self):
+        self.Tenant = dolfin.Config.compile_schema(dict(
+            name=str,
+            quota=(int, 0),
+            ratio=(float, 1),
+            hosts=[str],
+            limits=dict(cpu=float, mem=(int, 512)),
+            labels=(dict, None),
+        ), 'Tenant')
+
+    def test_schema_class_is_slotted(self):
+        tenant = self.Tenant.from_mapping(dict(
+            name='acme', hosts=['a', 'b'], limits=dict(cpu=2)))
+        self.assertIsInstance(tenant, dolfin.SchemaConfig)
+        self.assertFalse(hasattr(tenant, '__dict__'))
+        self.assertFalse(hasattr(tenant.limits, '__dict__'))
+        self.assertEqual('acme', tenant.name)
+        self.assertEqual(['a', 'b'], tenant.hosts)
+        self.assertEqual(2.0, tenant.limits.cpu)
+        self.assertIsInstance(tenant.limits.cpu, float)
+
+    def test_fields_take_defaults(self):
+        tenant = self.Tenant.from_mapping(dict(
+            name='acme', hosts=[], limits=dict(cpu=1.5)))
+        self.assertEqual(0, tenant.quota)
+        self.assertEqual(1.0, tenant.ratio)
+        self.assertEqual(512, tenant.limits.mem)
+        self.assertIsNone(tenant.labels)
+
+    def test_invalid_settings_cause_error(self):
+        valid = dict(name='acme', hosts=['a'], limits=dict(cpu=1))
+        for change, message in (
+                (dict(quota='1'), 'quota: expected int'),
+                (dict(quota=True), 'quota: expected int'),
+                (dict(hosts=['a', 1]), 'hosts[1]: expected str'),
+                (dict(limits=dict()), 'limits.cpu: missing'),
+                (dict(limits=[]), 'limits: expected a mapping'),
+                (dict(spam=1), 'unknown settings: spam')):
+            with self.assertRaises(dolfin.ConfigError) as ctx:
+                self.Tenant.from_mapping(dict(valid, **change))
+            self.assertIn(message, str(ctx.exception))
+
+    def test_invalid_schema_causes_error(self):
+        for fields in (dict(to_storage=str), dict(_private=str),
+                       dict(hosts=[str, int]), dict(quota=5)):
+            with self.assertRaises(ValueError):
+                dolfin.Config.compile_schema(fields)
+
+    def test_conversion_to_storage(self):
+        settings = dict(name='acme', quota=1, ratio=0.5, hosts=['a'],
+                        limits=dict(cpu=1.0, mem=1), labels=dict(tier='gold'))
+        tenant = self.Tenant.from_mapping(settings)
+        storage = tenant.to_storage()
+        self.assertIsInstance(storage.limits, dolfin.Storage)
+        self.assertEqual(settings, storage)
+        self.assertEqual('gold', storage.labels.tier)
+        self.assertEqual(tenant, self.Tenant.from_mapping(storage))
+
+    def test_schema_loads_file_with_config_type_defaults(self):
+        SchemaBase = type('SchemaBase', (dolfin.Config,), {})
+        SchemaBase.register_defaults(level='info')
+        SchemaBase.register_func_default('greeting',
+            lambda s, k: 'hello %s' % s.foo)
+        Complex = SchemaBase.compile_schema(dict(
+            foo=str, baz=[str], level=str, greeting=str, port=(int, 80),
+            fix=dict(bug=list, inf=list, mix=list)))
+        self.assertEqual('SchemaBaseSchema', Complex.__name__)
+
+        conf = Complex(os.path.join(self.base_dir, 'complex.conf'), port=8080)
+        self.assertEqual('bar', conf.foo)
+        self.assertEqual(['quux', 'norf'], conf.baz)
+        self.assertEqual('info', conf.level)
+        self.assertEqual('hello bar', conf.greeting)
+        self.assertEqual(8080, conf.port)
+        self.assertEqual(11, conf.fix.mix[1].all.name)
+
+    def test_func_defaults_read_a_config_in_dependency_order(self):
+        ServiceBase = type('ServiceBase', (dolfin.Config,), {})
+        ServiceBase.register_func_default('url',
+            lambda conf, key: 'http://%s:%s' % (conf.host, conf['port']))
+        ServiceBase.register_func_default('host',
+            lambda conf, key: conf.get('name', 'local') + '.example.com')
+        Service = ServiceBase.compile_schema(dict(
+            url=str, host=str, port=(int, 80), db=dict(name=str)))
+
+        service = Service(db=dict(name='main'))
+        self.assertEqual('local.example.com', service.host)
+        self.assertEqual('http://local.example.com:80', service.url)
+        self.assertIsInstance(service.db, dolfin.SchemaConfig)
+        self.assertEqual('http://api:8080',
+                         Service(host='api', port=8080, db=dict(name='m')).url)
+
+
+class FrozenConfigTest(unittest.TestCase):
+    ""
+    base_dir = os.path.join(os.path.dirname(__file__), 'data')
+
+    def test_freeze_materializes_defaults(self):
+        FreezingConfig = type('FreezingConfig', (dolfin.Config,), {})
+        FreezingConfig.register_defaults(level='info')
+        FreezingConfig.register_func_default('greeting',
+            lambda s, k: 'hello %s' % s.foo)
+        conf = FreezingConfig(os.path.join(self.base_dir, 'complex.conf'))
+        frozen = conf.freeze()
+
+        self.assertIsInstance(frozen, dolfin.FrozenStorage)
+        self.assertEqual('info', frozen.level)
+        self.assertEqual('hello bar', frozen.greeting)
+        self.assertEqual(11, frozen.get_path('fix.mix[1].all.name'))
+        conf.foo = 'changed'
+        self.assertEqual('bar', frozen.foo)
+
+    def test_freeze_lazy_and_overlay_configs(self):
+        conf_path = os.path.join(self.base_dir, 'complex.conf')
+        PlainConfig = type('PlainConfig', (dolfin.Config,), {})
+        expected = PlainConfig(conf_path).freeze()
+        self.assertEqual(expected, LazyConfig(conf_path).freeze())
+        self.assertEqual(expected, IndexedConfig(conf_path).freeze())
+        overlay = dolfin.OverlayConfig(conf_path).overlay(foo='baz')
+        self.assertEqual(expected.evolve(foo='baz'), overlay.freeze())
+
+
+class PicklingConfig(dolfin.Config):
+    pass
+
+
+class SharedConfigTest(unittest.TestCase):
+    ""
+    base_dir = os.path.join(os.path.dirname(__file__), 'data')
+
+    def setUp(self):
+        PicklingConfig.register_defaults(level='info')
+        self.addCleanup(PicklingConfig._defaults.clear)
+        self.conf = PicklingConfig(os.path.join(self.base_dir, 'complex.conf'))
+
+    def publish(self, path=None):
+        segment = self.conf.publish(path)
+        self.addCleanup(segment.unlink)
+        return segment
+
+    def test_pickling_keeps_type_meta_and_defaults(self):
+        import pickle
+        self.conf.port = 80
+        loaded = pickle.loads(pickle.dumps(self.conf))
+        PicklingConfig._defaults.clear()
+
+        self.assertIs(PicklingConfig, type(loaded))
+        self.assertEqual('complex.conf', loaded.meta.name)
+        self.assertEqual('info', loaded.level)
+        self.assertEqual(80, loaded.port)
+        self.assertEqual(11, loaded.fix.mix[1].all.name)
+
+    def test_published_config_reads_like_storage(self):
+        shared = self.publish().config
+        self.assertIsInstance(shared, PicklingConfig)
+        self.assertIsInstance(shared, dolfin.SharedConfig)
+        self.assertEqual('bar', shared.foo)
+        self.assertEqual(('quux', 'norf'), shared.baz)
+        self.assertEqual(11, shared.fix.mix[1].all.name)
+        self.assertEqual(11, shared.get_path('fix.mix[1].all.name'))
+        self.assertEqual('info', shared.level)
+        self.assertEqual('complex.conf', shared.meta.name)
+        self.assertIsNone(shared.missing)
+        self.assertNotIn('missing', shared)
+        self.assertEqual(set(['foo', 'baz', 'fix', 'meta', 'level']),
+                         set(shared))
+        self.assertEqual(self.conf.freeze(), shared)
+        self.assertIsInstance(shared.fix, dolfin.SharedStorage)
+
+    def test_published_config_is_read_only(self):
+        shared = self.publish().config
+        for modify in (lambda c: setattr(c, 'foo', 1),
+                       lambda c: c.__setitem__('foo', 1),
+                       lambda c: c.__delitem__('foo'),
+                       lambda c: c.update(foo=1),
+                       lambda c: c.__ior__(dict(foo=1)),
+                       lambda c: c.pop('foo'),
+                       lambda c: c.setdefault('new', 1),
+                       lambda c: c.clear()):
+            self.assertRaises(TypeError, modify, shared)
+            self.assertRaises(TypeError, modify, shared.fix)
+        self.assertEqual('bar', shared.foo)
+
+    def test_memory_mapped_file(self):
+        import tempfile
+        path = os.path.join(tempfile.mkdtemp(), 'complex.shm')
+        self.addCleanup(os.rmdir, os.path.dirname(path))
+        segment = self.publish(path)
+        self.assertEqual(path, segment.name)
+        self.assertEqual('bar', dolfin.SharedConfig.attach(path).foo)
+
+    def test_pickled_shared_config_attaches_to_segment(self):
+        import pickle
+        segment = self.publish()
+        loaded = pickle.loads(pickle.dumps(segment.config))
+        self.assertIs(segment.config, loaded)
+        fix = pickle.loads(pickle.dumps(segment.config.fix))
+        self.assertIsInstance(fix, dolfin.SharedStorage)
+        self.assertEqual(self.conf.freeze().fix, fix)
+
+    def test_other_process_attaches_by_name(self):
+        import subprocess
+        segment = self.publish()
+        code = ('import dolfin; c = dolfin.SharedConfig.attach(%r); '
+                'print(c.fix.mix[1].all.name, c.level)' % segment.name)
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(
+            os.path.abspath(dolfin.__file__)))
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         env=env)
+        self.assertEqual(b'11 info', output.strip())
+
+    def test_published_config_converts_and_compares_like_storage(self):
+        import json
+        shared = self.publish().config
+        expected = json.loads(json.dumps(self.conf.to_dict()))
+
+        self.assertEqual(expected, json.loads(json.dumps(shared.to_dict())))
+        made = dolfin.Storage.make(shared)
+        self.assertIs(dolfin.Storage, type(made.fix))
+        self.assertEqual(11, made.fix.mix[1].all.name)
+        self.assertTrue(shared == self.conf)
+        self.assertTrue(self.conf == shared)
+        self.assertFalse(shared != self.conf)
+        self.assertEqual(dict(bug=[1, 'details go here'],
+                              inf=[2, 'details go here'],
+                              mix=self.conf.fix.mix), shared.fix)
+        self.assertNotEqual(dict(self.conf, foo='qux'), shared)
+
+    def test_func_default_is_computed_once_for_published_config(self):
+        calls, barrier = [], threading.Barrier(16)
+        shared = self.publish().config
+        type(shared).register_func_default('token',
+            lambda s, k: calls.append(k) or time.sleep(0.05) or object())
+        self.addCleanup(type(shared)._func_defaults.clear)
+
+        results = []
+        def read():
+            barrier.wait()
+            results.append(shared.token)
+        threads = [threading.Thread(target=read) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(['token'], calls)
+        self.assertTrue(all(result is shared.token for result in results))
+
+
+class JsonBackendTest(unittest.TestCase):
+    ""
+    base_dir = os.path.join(os.path.dirname(__file__), 'data')
+
+    def setUp(self):
+        previous = dolfin._json_backend
+        self.addCleanup(setattr, dolfin, '_json_backend', previous)
+        self.addCleanup(dolfin.Config.cache_clear)
+        self.conf_path = os.path.join(self.base_dir, 'complex.conf')
+        self.decoded = []
+
+    def decoder(self, data):
+        import json
+        self.decoded.append(data)
+        return json.loads(data)
+
+    def test_fastest_installed_backend_is_selected(self):
+        decoder = dolfin.set_json_backend()
+        for name in ('orjson', 'ujson', 'json'):
+            try:
+                module = __import__(name)
+                break
+            except ImportError:
+                continue
+        self.assertIs(module.loads, decoder)
+        self.assertIs(decoder, dolfin._json_decoder())
+
+    def test_selected_backend_decodes_files(self):
+        dolfin.Config.cache_clear()
+        dolfin.set_json_backend(self.decoder)
+        conf = dolfin.Config(self.conf_path)
+        self.assertEqual(1, len(self.decoded))
+        self.assertEqual(11, conf.fix.mix[1].all.name)
+
+    def test_config_type_backend_overrides_selected_one(self):
+        BackendConfig = type('BackendConfig', (dolfin.Config,),
+                             dict(_json_backend=self.decoder))
+        conf = BackendConfig(self.conf_path)
+        BackendConfig(self.conf_path)
+        self.assertEqual(1, len(self.decoded))
+        self.assertEqual('bar', conf.foo)
+        self.assertEqual('bar', dolfin.Config(self.conf_path).foo)
+        self.assertEqual(1, len(self.decoded))
+
+    def test_standard_library_is_fallback(self):
+        def strict(data):
+            raise ValueError('unsupported')
+        self.assertEqual(dict(a=float('inf')), dolfin.Storage.load(
+            b'{"a": Infinity}', strict))
+        self.assertRaises(ValueError, dolfin.Storage.load, b'{"a": ', strict)
+
+
+class ConfigLoadTest(unittest.TestCase):
+    ""
+    base_dir = os.path.join(os.path.dirname(__file__), 'data')
+
+    def test_load_builds_storage_directly(self):
+        storage = dolfin.Storage.load(b'{"a": {"b": [1, {"c": 2}]}}')
+        self.assertIsInstance(storage.a, dolfin.Storage)
+        self.assertIsInstance(storage.a.b[1], dolfin.Storage)
+        self.assertEqual(2, storage.a.b[1].c)
+
+    def test_load_config_from_bytes_and_text(self):
+        for source in (b'{"foo": "bar", "fix": {"bug": 1}}',
+                       u'{"foo": "bar", "fix": {"bug": 1}}'):
+            conf = dolfin.Config.load(source, spam=dict(egg=1))
+            self.assertIsInstance(conf, dolfin.Config)
+            self.assertEqual('bar', conf.foo)
+            self.assertEqual(1, conf.fix.bug)
+            self.assertIsInstance(conf.spam, dolfin.Storage)
+            self.assertIsNone(conf.meta.name)
+
+    def test_load_config_from_file_objects(self):
+        import io
+        conf = dolfin.Config.load(io.BytesIO(b'{"foo": "bar"}'), foo='baz')
+        self.assertEqual('baz', conf.foo)
+        with open(os.path.join(self.base_dir, 'complex.conf'), 'rb') as f:
+            conf = dolfin.Config.load(f)
+        self.assertEqual('complex.conf', conf.meta.name)
+        self.assertEqual(11, conf.fix.mix[1].all.name)
+
+    def test_loaded_config_types_keep_their_behaviour(self):
+        LoadConfig = type('LoadConfig', (dolfin.Config,), {})
+        LoadConfig.register_defaults(level='info')
+        self.assertEqual('info', LoadConfig.load(b'{}').level)
+        OverlayLoad = type('OverlayLoad', (dolfin.OverlayConfig,), {})
+        OverlayLoad.register_defaults(level='info')
+        conf = OverlayLoad.load(b'{"fix": {"bug": 1}}', fix=dict(inf=2))
+        self.assertEqual('info', conf.level)
+        self.assertEqual(dict(bug=1, inf=2), conf.fix)
+
+    def test_invalid_sources_cause_error(self):
+        self.assertRaises(TypeError, dolfin.Config.load, 42)
+        self.assertRaises(ValueError, dolfin.Config.load, b'[1, 2]')
+        self.assertRaises(ValueError, dolfin.Config.load, b'{"foo": ')
+
+
+class StatsConfig(dolfin.Config):
+    pass
+
+StatsConfig.register_defaults(timeout=30)
+StatsConfig.register_func_default('token',
+    lambda s, k: time.sleep(0.01) or 'computed-%s' % s.timeout)
+
+
+class StatsOverlayConfig(dolfin.OverlayConfig):
+    pass
+
+StatsOverlayConfig.register_defaults(timeout=30)
+
+
+class ConfigStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = dolfin.ConfigStats()
+
+    def tearDown(self):
+        self.stats.stop()
+
+    def _reads(self):
+        return dict((r['key'], r) for r in self.stats.as_dict()['reads'])
+
+    def test_nothing_is_counted_unless_started(self):
+        config = StatsConfig(host='localhost')
+        config.host
+        with self.stats:
+            config.host
+        config.host
+        self.assertEqual(1, self._reads()['host']['reads'])
+
+    def test_counts_reads_by_source(self):
+        with self.stats:
+            config = StatsConfig(host='localhost', db=dict(name='main'))
+            for _ in range(3):
+                config.host
+            config['timeout'], config['timeout']
+            config.token, config.token
+            config.nothing
+        reads = self._reads()
+        self.assertEqual(dict(type='StatsConfig', key='host', reads=3,
+                              materialized=3, default=0, func_default=0,
+                              missing=0), reads['host'])
+        # the func default of token reads timeout as well
+        self.assertEqual((3, 1, 2), (reads['timeout']['reads'],
+                                     reads['timeout']['default'],
+                                     reads['timeout']['materialized']))
+        self.assertEqual((1, 1), (reads['token']['func_default'],
+                                  reads['token']['materialized']))
+        self.assertEqual(1, reads['nothing']['missing'])
+
+    def test_times_func_defaults(self):
+        with self.stats:
+            StatsConfig().token
+        timing = self.stats.as_dict()['func_defaults'][0]
+        self.assertEqual(('token', 1), (timing['key'], timing['count']))
+        self.assertTrue(timing['seconds'] >= 0.01)
+        self.assertEqual(timing['seconds'], timing['max_seconds'])
+        # the func default read timeout, counted as any other read
+        self.assertEqual(1, self._reads()['timeout']['default'])
+
+    def test_counts_attributes_of_nested_sections(self):
+        config = StatsConfig(db=dict(name='main'))
+        with self.stats:
+            config.db.name, config.db.port
+        attributes = self.stats.as_dict()['attributes']
+        self.assertEqual([dict(type='Storage', key='name', reads=1, missing=0),
+                          dict(type='Storage', key='port', reads=1, missing=1)],
+                         sorted(attributes, key=lambda a: a['key']))
+
+    def test_warns_about_missing_keys(self):
+        import warnings
+        config = StatsConfig(db=dict(name='main'))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with dolfin.ConfigStats(warn_missing=True):
+                config['nothing'], config.db.port, config.db.name
+        self.assertEqual(['StatsConfig.nothing is missing and read as None',
+                          'Storage.port is missing and read as None'],
+                         [str(w.message) for w in caught])
+
+    def test_missing_key_warnings_point_at_the_caller(self):
+        import warnings
+        config = StatsConfig(db=dict(name='main'))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with dolfin.ConfigStats(warn_missing=True):
+                config.nothing
+                config['nothing']
+                config.db.port
+                config.get_path('nothing.port')
+        self.assertEqual([__file__] * 4, [w.filename for w in caught])
+
+    def test_counts_path_reads(self):
+        config = StatsConfig(db=dict(name='main'))
+        with self.stats:
+            config.get_path('db.name'), config.get_path('timeout')
+        reads = self._reads()
+        self.assertEqual(1, reads['db']['materialized'])
+        self.assertEqual(1, reads['timeout']['default'])
+
+    def test_counts_overlay_reads_of_defaults_as_defaults(self):
+        config = StatsOverlayConfig(host='localhost')
+        with self.stats:
+            config.timeout, config['timeout'], config.host
+        reads = self._reads()
+        self.assertEqual((2, 0), (reads['timeout']['default'],
+                                  reads['timeout']['materialized']))
+        self.assertEqual(1, reads['host']['materialized'])
+
+    def test_report_and_export(self):
+        import json, tempfile
+        with self.stats:
+            config = StatsConfig(host='localhost')
+            config.host, config.token, config.nothing
+        report = self.stats.report()
+        self.assertTrue('StatsConfig.host' in report)
+        self.assertTrue('missing keys read: StatsConfig.nothing' in report)
+
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            self.stats.export(path)
+            with open(path) as f:
+                self.assertEqual(self.stats.as_dict(), json.load(f))
+        finally:
+            os.remove(path)
+
+
 class FakeCommand(dolfin.Command):
     
     prog = 'fake'
@@ -341,3 +2053,496 @@ class CommandTest(unittest.TestCase):
             '_create_parser' in cmd.register and
             '_handle' in cmd.register
         )
+
+
+SUBCOMMAND_SOURCE = '''
+import dolfin
+
+class %(cls)s(dolfin.SubCommand):
+    """%(help)s
+
+    Longer description of %(name)s.
+    """
+
+    def __init__(self, parent):
+        super(%(cls)s, self).__init__(parent)
+        self._subparser.add_argument('--count', type=int, default=1)
+
+    def __call__(self, args):
+        return '%(name)s x%%d' %% args.count
+'''
+
+
+class RegistryCommand(FakeCommand):
+
+    def _handle(self, args):
+        self.register.add('_handle')
+        if getattr(args, 'func', None):
+            return args.func(args)
+        return super(RegistryCommand, self)._handle(args)
+
+
+class SubCommandRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.working_dir = tempfile.mkdtemp()
+        self.package = 'lazycmds%d' % id(self)
+        package_dir = os.path.join(self.working_dir, self.package)
+        os.mkdir(package_dir)
+        open(os.path.join(package_dir, '__init__.py'), 'w').close()
+        for name in ('serve', 'stop'):
+            with open(os.path.join(package_dir, name + '.py'), 'w') as f:
+                f.write(SUBCOMMAND_SOURCE % dict(
+                    cls=name.title() + 'Command', name=name,
+                    help='%ss the server' % name.title()))
+        sys.path.insert(0, self.working_dir)
+
+    def tearDown(self):
+        import shutil
+        sys.path.remove(self.working_dir)
+        for module in [m for m in sys.modules if m.startswith(self.package)]:
+            del sys.modules[module]
+        shutil.rmtree(self.working_dir)
+
+    def _registry(self, **kwargs):
+        registry = dolfin.SubCommandRegistry(**kwargs)
+        for name in ('serve', 'stop'):
+            registry.register(name, '%s.%s:%sCommand'
+                              % (self.package, name, name.title()))
+        return registry
+
+    def _command(self, registry):
+        cmd = RegistryCommand()
+        cmd.subcommands = registry
+        return cmd
+
+    def _imported(self):
+        return sorted(m.split('.')[-1] for m in sys.modules
+                      if m.startswith(self.package + '.'))
+
+    def test_only_selected_subcommand_is_imported(self):
+        registry = self._registry()
+        for name in ('serve', 'stop'):
+            registry.register(name, registry._entries[name][0], 'help')
+        cmd = self._command(registry)
+        args = registry.parse_args(cmd, cmd._create_parser(),
+                                   ['-p', '8080', 'serve', '--count', '3'])
+
+        self.assertEqual(['serve'], self._imported())
+        self.assertEqual(8080, args.port)
+        self.assertEqual(3, args.count)
+        self.assertEqual('serve x3', args.func(args))
+
+    def test_unselected_subcommands_are_not_imported_without_cache(self):
+        cmd = self._command(self._registry())
+        output = []
+        cmd._execute = lambda args: output.append(cmd._handle(args))
+        cmd.run_from_argv(['stop'])
+        self.assertEqual(['stop x1'], output)
+        self.assertEqual(['stop'], self._imported())
+
+    def test_runs_selected_subcommand_from_argv(self):
+        cmd = self._command(self._registry())
+        output = []
+        cmd._execute = lambda args: output.append(cmd._handle(args))
+        cmd.run_from_argv(['stop'])
+        self.assertEqual(['stop x1'], output)
+
+    def test_top_level_help_lists_subcommands(self):
+        cmd = self._command(self._registry())
+        cmd.subcommands.add_placeholders(cmd._create_parser())
+        help_text = cmd._create_parser().format_help()
+        self.assertTrue('Serves the server' in help_text)
+        self.assertTrue('Stops the server' in help_text)
+
+    def test_cached_metadata_avoids_imports(self):
+        cache_path = os.path.join(self.working_dir, 'commands.json')
+        registry = self._registry(cache_path=cache_path)
+        parser = self._command(registry)._create_parser()
+        registry.add_placeholders(parser)
+        parser.format_help()
+        self.assertTrue(os.path.exists(cache_path))
+        for module in [m for m in sys.modules if m.startswith(self.package)]:
+            del sys.modules[module]
+
+        cmd = self._command(self._registry(cache_path=cache_path))
+        cmd.subcommands.add_placeholders(cmd._create_parser())
+        help_text = cmd._create_parser().format_help()
+        self.assertTrue('Serves the server' in help_text)
+        self.assertTrue('Stops the server' in help_text)
+        self.assertEqual([], self._imported())
+
+    def test_stale_metadata_is_refreshed(self):
+        cache_path = os.path.join(self.working_dir, 'commands.json')
+        registry = self._registry(cache_path=cache_path)
+        self.assertEqual('Serves the server', registry.help('serve'))
+        registry._save_metadata()
+
+        module_path = os.path.join(self.working_dir, self.package, 'serve.py')
+        with open(module_path, 'w') as f:
+            f.write(SUBCOMMAND_SOURCE % dict(
+                cls='ServeCommand', name='serve', help='Runs the server now'))
+        for module in [m for m in sys.modules if m.startswith(self.package)]:
+            del sys.modules[module]
+        self.assertEqual('Runs the server now',
+                         self._registry(cache_path=cache_path).help('serve'))
+
+    def test_subcommand_help_uses_its_own_parser(self):
+        cmd = self._command(self._registry())
+        args = cmd.subcommands.parse_args(cmd, cmd._create_parser(), ['serve'])
+        help_text = args.func._subparser.format_help()
+        self.assertTrue('fake serve' in help_text)
+        self.assertTrue('--count' in help_text)
+
+    def test_subcommand_parser_reuses_the_command_prog(self):
+        cmd = self._command(self._registry())
+        parser = cmd._create_parser()
+        created = []
+        cmd._create_parser = lambda: created.append(1)
+        args = cmd.subcommands.parse_args(cmd, parser, ['serve'])
+        self.assertEqual([], created)
+        self.assertEqual('%s serve' % parser.prog, args.func._subparser.prog)
+
+    def test_without_subcommand_parses_common_options(self):
+        registry = dolfin.SubCommandRegistry()
+        registry.register('serve', self.package + '.serve:ServeCommand', 'h')
+        cmd = self._command(registry)
+        args = cmd.subcommands.parse_args(cmd, cmd._create_parser(), ['-s'])
+        self.assertTrue(args.show)
+        self.assertFalse(hasattr(args, 'func'))
+        self.assertEqual([], self._imported())
+
+    def test_registers_classes_directly(self):
+        class EchoCommand(dolfin.SubCommand):
+            """Echoes"""
+            def __call__(self, args):
+                return 'echo'
+        registry = dolfin.SubCommandRegistry()
+        registry.register('echo', EchoCommand)
+        cmd = self._command(registry)
+        args = registry.parse_args(cmd, cmd._create_parser(), ['echo'])
+        self.assertEqual('Echoes', registry.help('echo'))
+        self.assertEqual('echo', args.func(args))
+
+
+class ServerCommand(FakeCommand):
+
+    def __init__(self):
+        super(ServerCommand, self).__init__()
+        self.loaded_by = os.getpid()    # as for its imports and configs
+
+    def _create_parser(self):
+        if self.p is None:
+            p = super(ServerCommand, self)._create_parser()
+            p.add_argument('--exit', type=int, default=None)
+            p.add_argument('--fail', action='store_true')
+            p.add_argument('--crash', action='store_true')
+        return self.p
+
+    def _handle(self, args):
+        sys.stderr.write('cwd=%s\n' % os.getcwd())
+        if args.fail:
+            raise dolfin.CommandError('failed as asked')
+        if args.crash:
+            raise RuntimeError('crashed as asked')
+        if args.exit is not None:
+            sys.exit(args.exit)
+        return 'pid=%d loaded_by=%d var=%s' % (
+            os.getpid(), self.loaded_by, os.environ.get('DOLFIN_TEST_VAR'))
+
+
+class CommandServerTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.working_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.working_dir, 'tool.sock')
+        self.server_pid = None
+
+    def tearDown(self):
+        import shutil, signal
+        if self.server_pid:
+            os.kill(self.server_pid, signal.SIGTERM)
+            os.waitpid(self.server_pid, 0)
+        shutil.rmtree(self.working_dir)
+
+    def _start_server(self, **kwargs):
+        server = dolfin.CommandServer(ServerCommand(), self.path, **kwargs)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        server._listener.close()
+        self.server_pid = pid
+
+    def _run(self, argv, fallback=None):
+        import tempfile
+        with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+            stdin = os.open(os.devnull, os.O_RDONLY)
+            try:
+                code = dolfin.run_client(self.path, argv, fallback,
+                                         (stdin, out.fileno(), err.fileno()))
+            finally:
+                os.close(stdin)
+            out.seek(0)
+            err.seek(0)
+            return code, out.read().decode(), err.read().decode()
+
+    def test_relays_output_and_exit_code(self):
+        self._start_server()
+        code, out, err = self._run(['-p', '8080'])
+        self.assertEqual(0, code)
+        self.assertTrue(out.startswith('\npid='))
+        self.assertTrue('cwd=' in err)
+
+    def test_runs_each_request_in_a_forked_child(self):
+        self._start_server()
+        pids = set()
+        for _ in range(3):
+            out = self._run([])[1]
+            fields = dict(f.split('=') for f in out.split())
+            self.assertEqual(str(os.getpid()), fields['loaded_by'])
+            pids.add(fields['pid'])
+        self.assertEqual(3, len(pids))
+        self.assertFalse(str(self.server_pid) in pids)
+
+    def test_relays_exit_codes_and_errors(self):
+        self._start_server()
+        self.assertEqual(3, self._run(['--exit', '3'])[0])
+        code, _, err = self._run(['--fail'])
+        self.assertEqual(1, code)
+        self.assertTrue('Error: failed as asked' in err)
+        code, _, err = self._run(['--crash'])
+        self.assertEqual(1, code)
+        self.assertTrue('RuntimeError: crashed as asked' in err)
+        self.assertEqual(2, self._run(['--port', 'abc'])[0])
+
+    def test_uses_environment_and_directory_of_client(self):
+        self._start_server()
+        cwd = os.getcwd()
+        os.environ['DOLFIN_TEST_VAR'] = 'from-client'
+        os.chdir(self.working_dir)
+        try:
+            code, out, err = self._run([])
+        finally:
+            os.chdir(cwd)
+            del os.environ['DOLFIN_TEST_VAR']
+        self.assertTrue('var=from-client' in out)
+        self.assertTrue('cwd=%s' % os.path.realpath(self.working_dir)
+                        in err.replace(self.working_dir,
+                                       os.path.realpath(self.working_dir)))
+
+    def test_falls_back_to_running_in_process(self):
+        calls = []
+        def fallback(argv):
+            calls.append(argv)
+            sys.exit(4)
+        self.assertEqual(4, self._run(['-s'], fallback)[0])
+        self.assertEqual([['-s']], calls)
+
+        open(self.path, 'w').close()    # stale socket of a killed server
+        self.assertEqual(0, self._run([], calls.append)[0])
+        self.assertRaises(dolfin.CommandError, self._run, [])
+
+    def test_idle_connection_does_not_block_others(self):
+        import socket
+        self._start_server(request_timeout=0.5)
+        idle = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        idle.connect(self.path)
+        try:
+            started = time.time()
+            self.assertEqual(0, self._run([])[0])
+            self.assertTrue(time.time() - started < 0.5)
+            idle.settimeout(5)
+            self.assertEqual(b'', idle.recv(1))    # dropped once timed out
+        finally:
+            idle.close()
+
+    def test_replaces_stale_socket_but_not_live_server(self):
+        import socket
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.path)
+        stale.close()
+        self._start_server()
+        self.assertEqual(0, self._run(['-s'])[0])
+        self.assertRaises(dolfin.CommandError, dolfin.CommandServer,
+                          ServerCommand(), self.path)
+
+
+class BatchCommand(FakeCommand):
+
+    def _create_parser(self):
+        if self.p is None:
+            p = super(BatchCommand, self)._create_parser()
+            p.add_argument('name')
+            p.add_argument('--fail', action='store_true')
+            p.add_argument('--crash', action='store_true')
+        return self.p
+
+    def _handle(self, args):
+        if args.fail:
+            raise dolfin.CommandError('cannot process %s' % args.name)
+        if args.crash:
+            raise ValueError('bad %s' % args.name)
+        return '%s:%s' % (args.name, args.port or 80)
+
+
+class BatchCommandTest(unittest.TestCase):
+
+    lines = ['# header comment', 'alpha -p 8080', '', 'beta --fail',
+             '"gamma delta"  # trailing comment', 'epsilon --crash',
+             '--port abc', 'zeta "unbalanced']
+
+    def _expected(self):
+        return [(2, 'alpha:8080', None),
+                (4, None, 'cannot process beta'),
+                (5, 'gamma delta:80', None),
+                (6, None, 'ValueError: bad epsilon'),
+                (7, None, "fake: error: argument -p/--port: invalid int "
+                          "value: 'abc'"),
+                (8, None, 'ValueError: No closing quotation')]
+
+    def test_collects_outputs_and_errors_per_line(self):
+        results = list(BatchCommand().iter_batch(self.lines))
+        self.assertEqual(self._expected(),
+                         [(r.lineno, r.output, r.error) for r in results])
+        self.assertEqual(['gamma delta'], results[2].argv)
+
+    def test_help_is_an_output(self):
+        result = list(BatchCommand().iter_batch(['--help']))[0]
+        self.assertEqual(None, result.error)
+        self.assertTrue(result.output.startswith('usage: fake'))
+
+    def test_runs_lines_across_process_pool(self):
+        lines = self.lines * 50
+        expected = list(BatchCommand().iter_batch(lines))
+        ordered = list(BatchCommand().iter_batch(lines, jobs=2, chunksize=7))
+        self.assertEqual(expected, ordered)
+        streamed = list(BatchCommand().iter_batch(lines, jobs=3, ordered=False,
+                                                  chunksize=5))
+        self.assertEqual(sorted(expected), sorted(streamed))
+
+    def test_run_batch_reports_summary_without_exiting(self):
+        import contextlib, io, tempfile
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(self.lines))
+        out, err = io.StringIO(), io.StringIO()
+        try:
+            with contextlib.redirect_stdout(out), \
+                    contextlib.redirect_stderr(err):
+                summary = BatchCommand().run_batch(path)
+        finally:
+            os.remove(path)
+        self.assertEqual((6, 4), summary[:2])
+        self.assertEqual('alpha:8080\ngamma delta:80\n', out.getvalue())
+        self.assertTrue('Error: line 4: cannot process beta\n'
+                        in err.getvalue())
+        self.assertTrue('6 lines, 4 failed in' in err.getvalue())
+
+
+class TimedCommand(FakeCommand):
+    profile_options = True
+
+
+class ProfileCommand(TimedCommand):
+
+    def _create_parser(self):
+        if self.p is None:
+            p = super(ProfileCommand, self)._create_parser()
+            p.add_argument('--profile', default='default')
+        return self.p
+
+    def _handle(self, args):
+        return "profile='%s'" % args.profile
+
+
+class CommandTimingsTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.working_dir = tempfile.mkdtemp()
+        self.timings_path = os.path.join(self.working_dir, 'timings.jsonl')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.working_dir)
+
+    def _run(self, cmd, argv):
+        import contextlib, io
+        out, err = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            cmd.run_from_argv(argv)
+        return out.getvalue(), err.getvalue()
+
+    def _records(self):
+        import json
+        with open(self.timings_path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_reports_phases_without_passing_options_to_parser(self):
+        out, err = self._run(TimedCommand(), ['--timings', '-s'])
+        self.assertTrue("server='80:localhost'" in out)
+        for phase in ('create_parser', 'parse_args', 'handle_default_args',
+                      'handle', 'total'):
+            self.assertTrue('\n  %s ' % phase in err, phase)
+
+    def test_appends_json_records(self):
+        for _ in range(2):
+            self._run(TimedCommand(), ['--timings=' + self.timings_path, '-s'])
+        records = self._records()
+        self.assertEqual(2, len(records))
+        record = records[0]
+        self.assertEqual(('fake', ['-s'], 0),
+                         (record['prog'], record['argv'], record['exit_code']))
+        self.assertEqual(['create_parser', 'parse_args',
+                          'handle_default_args', 'handle'],
+                         [p for p in record['phases'] if p != 'startup'])
+        self.assertAlmostEqual(record['total'], sum(
+            p['seconds'] for p in record['phases'].values()))
+
+    def test_records_failed_runs(self):
+        self.assertRaises(SystemExit, self._run, TimedCommand(),
+                          ['--timings=' + self.timings_path, '--port', 'x'])
+        record = self._records()[0]
+        self.assertEqual(2, record['exit_code'])
+        self.assertFalse('handle' in record['phases'])
+
+    def test_writes_profile_and_memory_peaks(self):
+        import pstats
+        profile_path = os.path.join(self.working_dir, 'run.prof')
+        self._run(TimedCommand(), ['--profile', profile_path,
+                                  '--profile-memory', '-s',
+                                  '--timings=' + self.timings_path])
+        stats = pstats.Stats(profile_path)
+        self.assertTrue(any(name == '_handle'
+                            for _, _, name in stats.stats))
+        phases = self._records()[0]['phases']
+        self.assertTrue(phases['create_parser']['memory_peak'] > 0)
+
+    def test_options_are_opt_in(self):
+        self.assertRaises(SystemExit, self._run, FakeCommand(), ['--timings'])
+        self.assertEqual(({}, ['-s', '--', '--timings']),
+                         dolfin._profile_options(['-s', '--', '--timings']))
+        self.assertRaises(SystemExit, self._run, TimedCommand(), ['--profile'])
+
+    def test_options_declared_by_the_command_are_left_to_it(self):
+        cwd = os.getcwd()
+        os.chdir(self.working_dir)
+        try:
+            out, err = self._run(ProfileCommand(), ['--profile', 'prod', '-s'])
+            self.assertEqual([], os.listdir(self.working_dir))
+            self.assertTrue("profile='prod'" in out)
+            self.assertFalse('timings:' in err)
+
+            out, err = self._run(ProfileCommand(), [
+                '--profile', 'prod', '--timings=' + self.timings_path])
+            self.assertTrue("profile='prod'" in out)
+            record = self._records()[0]
+            self.assertEqual(['--profile', 'prod'], record['argv'])
+            self.assertEqual(['timings.jsonl'], os.listdir(self.working_dir))
+        finally:
+            os.chdir(cwd)